@@ -1,17 +1,30 @@
 -- Drop tables in reverse order of dependencies
-DROP TABLE IF EXISTS ledger_entries CASCADE;
+DROP VIEW IF EXISTS ledger_entries CASCADE;
+DROP TABLE IF EXISTS ledger_gold CASCADE;
+DROP TABLE IF EXISTS ledger_ml CASCADE;
+DROP TABLE IF EXISTS ledger_potions CASCADE;
+DROP TABLE IF EXISTS ledger_capacity CASCADE;
+DROP TABLE IF EXISTS ledger_transactions CASCADE;
 DROP TABLE IF EXISTS capacity_upgrade_thresholds CASCADE;
 DROP TABLE IF EXISTS strategy_thresholds CASCADE;
 DROP TABLE IF EXISTS strategy_transitions CASCADE;
+DROP TABLE IF EXISTS current_strategy CASCADE;
+DROP TABLE IF EXISTS ledger_balances CASCADE;
+DROP TABLE IF EXISTS ledger_checkpoints CASCADE;
+DROP TABLE IF EXISTS ledger_snapshots CASCADE;
 DROP TABLE IF EXISTS active_strategy CASCADE;
 DROP TABLE IF EXISTS block_potion_priorities CASCADE;
 DROP TABLE IF EXISTS strategy_time_blocks CASCADE;
 DROP TABLE IF EXISTS barrel_purchases CASCADE;
 DROP TABLE IF EXISTS barrel_details CASCADE; 
 DROP TABLE IF EXISTS barrel_visits CASCADE;
+DROP TABLE IF EXISTS checkout_journal CASCADE;
+DROP TABLE IF EXISTS processed_orders CASCADE;
+DROP TABLE IF EXISTS sales_rollup CASCADE;
 DROP TABLE IF EXISTS cart_items CASCADE;
 DROP TABLE IF EXISTS carts CASCADE;
 DROP TABLE IF EXISTS customers CASCADE;
+DROP TABLE IF EXISTS customer_identities CASCADE;
 DROP TABLE IF EXISTS customer_visits CASCADE;
 DROP TABLE IF EXISTS current_game_time CASCADE;
 DROP TABLE IF EXISTS game_time CASCADE;
@@ -20,6 +33,10 @@ DROP TABLE IF EXISTS strategies CASCADE;
 DROP TABLE IF EXISTS time_blocks CASCADE;
 DROP TABLE IF EXISTS potions CASCADE;
 DROP VIEW IF EXISTS current_state CASCADE;
+DROP FUNCTION IF EXISTS sync_current_strategy CASCADE;
+DROP FUNCTION IF EXISTS write_ledger_entry CASCADE;
+DROP FUNCTION IF EXISTS ledger_open_epoch CASCADE;
+DROP SEQUENCE IF EXISTS ledger_entry_id_seq CASCADE;
 
 -- Core game time tracking
 CREATE TABLE game_time (
@@ -93,12 +110,23 @@ CREATE TABLE strategies (
     max_potions_per_sku INT NOT NULL
 );
 
--- Initial insert for PREMIUM strategy
+-- Strategy activation history (append-only log)
 CREATE TABLE active_strategy (
     active_strategy_id SERIAL PRIMARY KEY,
     strategy_id INT REFERENCES strategies(strategy_id),
     activated_at TIMESTAMPTZ DEFAULT NOW(),
-    game_time_id INT REFERENCES game_time(time_id)
+    game_time_id INT REFERENCES game_time(time_id),
+    tick_id INT REFERENCES current_game_time(id)  -- game_time ids repeat every week
+);
+
+-- Single-row pointer to the active strategy, kept in sync by trigger
+CREATE TABLE current_strategy (
+    singleton BOOLEAN PRIMARY KEY DEFAULT true CHECK (singleton),
+    active_strategy_id INT NOT NULL REFERENCES active_strategy(active_strategy_id),
+    strategy_id INT NOT NULL REFERENCES strategies(strategy_id),
+    game_time_id INT REFERENCES game_time(time_id),
+    tick_id INT REFERENCES current_game_time(id),
+    activated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
 -- Strategy transitions with inventory and capacity thresholds
@@ -199,19 +227,30 @@ CREATE TABLE customer_visits (
     visit_record_id SERIAL PRIMARY KEY,
     visit_id INT NOT NULL,            -- This is the order_id
     time_id INT REFERENCES game_time(time_id),
-    customers JSONB NOT NULL,
+    customer_count INT NOT NULL DEFAULT 0,
+    customers JSONB,                  -- Raw payload, only kept in 'json' mode
+    customers_gz BYTEA,               -- zlib-compressed payload, 'compressed' mode
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- One row per distinct adventurer, keyed by a 64-bit hash of (name, class)
+CREATE TABLE customer_identities (
+    identity_id SERIAL PRIMARY KEY,
+    identity_hash BIGINT NOT NULL UNIQUE,
+    customer_name TEXT NOT NULL,
+    character_class TEXT NOT NULL,
+    first_seen_time_id INT REFERENCES game_time(time_id),
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
+-- Narrow per-visit fact row referencing the identity
 CREATE TABLE customers (
     customer_id SERIAL PRIMARY KEY,
     visit_record_id INT REFERENCES customer_visits(visit_record_id),
     visit_id INT NOT NULL,
     time_id INT REFERENCES game_time(time_id),
-    customer_name TEXT NOT NULL,
-    character_class TEXT NOT NULL,
-    level INT NOT NULL CHECK (level >= 1 AND level <= 20),
-    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    identity_id INT NOT NULL REFERENCES customer_identities(identity_id),
+    level INT NOT NULL CHECK (level >= 1 AND level <= 20)
 );
 
 -- Cart system
@@ -245,6 +284,44 @@ CREATE TABLE cart_items (
     UNIQUE(cart_id, potion_id)
 );
 
+-- Units and gold sold per potion per tick, a tick being (ledger epoch, time_id).
+-- Incremented at checkout so demand reads never scan cart_items.
+CREATE TABLE sales_rollup (
+    epoch_id INT NOT NULL,
+    time_id INT NOT NULL REFERENCES game_time(time_id),
+    potion_id INT NOT NULL REFERENCES potions(potion_id),
+    units_sold INT NOT NULL DEFAULT 0 CHECK (units_sold >= 0),
+    gold INT NOT NULL DEFAULT 0 CHECK (gold >= 0),
+    PRIMARY KEY (epoch_id, time_id, potion_id)
+);
+
+-- Checkout results by cart, replayed on retried checkouts
+CREATE TABLE checkout_journal (
+    cart_id INT PRIMARY KEY REFERENCES carts(cart_id),
+    idempotency_key TEXT UNIQUE,
+    status TEXT NOT NULL CHECK (status IN ('PENDING', 'COMPLETED')),
+    payment TEXT,
+    time_id INT REFERENCES game_time(time_id),
+    total_potions INT,
+    total_gold INT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ,
+    CONSTRAINT completed_has_totals CHECK (
+        status = 'PENDING' OR
+        (total_potions IS NOT NULL AND total_gold IS NOT NULL AND completed_at IS NOT NULL)
+    )
+);
+
+-- Delivery responses by endpoint and order_id, replayed on retried deliveries
+CREATE TABLE processed_orders (
+    endpoint TEXT NOT NULL,
+    order_id INT NOT NULL,
+    response JSONB,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    processed_at TIMESTAMPTZ,
+    PRIMARY KEY (endpoint, order_id)
+);
+
 -- Capacity upgrade threshold system
 CREATE TABLE capacity_upgrade_thresholds (
     threshold_id SERIAL PRIMARY KEY,
@@ -264,8 +341,76 @@ CREATE TABLE capacity_upgrade_thresholds (
 );
 
 -- Ledger system
-CREATE TABLE ledger_entries (
-    entry_id INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+-- Ledger totals as of the latest tick, refreshed as the clock advances and
+-- read by strategy transitions. Ledger writes never update this row.
+-- epoch_id is the open ledger epoch that new entries are written to;
+-- reset_generation counts admin resets, so every worker can tell when
+-- history it has cached was truncated.
+CREATE TABLE ledger_balances (
+    singleton BOOLEAN PRIMARY KEY DEFAULT true CHECK (singleton),
+    epoch_id INT NOT NULL DEFAULT 1,
+    reset_generation INT NOT NULL DEFAULT 0,
+    gold BIGINT NOT NULL DEFAULT 0,
+    total_potions BIGINT NOT NULL DEFAULT 0,
+    total_ml BIGINT NOT NULL DEFAULT 0,
+    ml_capacity_units BIGINT NOT NULL DEFAULT 0,
+    potion_capacity_units BIGINT NOT NULL DEFAULT 0
+);
+
+-- Closing balances of each sealed epoch, cumulative over all earlier epochs
+CREATE TABLE ledger_checkpoints (
+    epoch_id INT PRIMARY KEY,
+    sealed_time_id INT REFERENCES game_time(time_id),
+    entry_count BIGINT NOT NULL DEFAULT 0,
+    gold BIGINT NOT NULL DEFAULT 0,
+    red_ml BIGINT NOT NULL DEFAULT 0,
+    green_ml BIGINT NOT NULL DEFAULT 0,
+    blue_ml BIGINT NOT NULL DEFAULT 0,
+    dark_ml BIGINT NOT NULL DEFAULT 0,
+    total_potions BIGINT NOT NULL DEFAULT 0,
+    potion_capacity_units BIGINT NOT NULL DEFAULT 0,
+    ml_capacity_units BIGINT NOT NULL DEFAULT 0,
+    archive_prefix TEXT,  -- set once the epoch's entries leave the live ledger
+    sealed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Balances as the clock advanced to each tick, for point-in-time state reads
+CREATE TABLE ledger_snapshots (
+    tick_id INT PRIMARY KEY REFERENCES current_game_time(id),
+    time_id INT REFERENCES game_time(time_id),
+    epoch_id INT NOT NULL,
+    through_entry_id BIGINT NOT NULL DEFAULT 0,  -- later entries all have higher ids
+    gold BIGINT NOT NULL DEFAULT 0,
+    red_ml BIGINT NOT NULL DEFAULT 0,
+    green_ml BIGINT NOT NULL DEFAULT 0,
+    blue_ml BIGINT NOT NULL DEFAULT 0,
+    dark_ml BIGINT NOT NULL DEFAULT 0,
+    total_potions BIGINT NOT NULL DEFAULT 0,
+    potion_capacity_units BIGINT NOT NULL DEFAULT 0,
+    ml_capacity_units BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Open epoch for new ledger entries. Writers hold the ledger advisory lock
+-- shared until commit; sealing and snapshots take it exclusive, so they wait
+-- for in-flight writers and later writers see the next epoch. No row is locked.
+CREATE OR REPLACE FUNCTION ledger_open_epoch() RETURNS INT AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock_shared(hashtext('ledger_epoch'));
+    RETURN COALESCE((SELECT epoch_id FROM ledger_balances), 1);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Entry ids for the partitioned ledger; identity columns on partitioned
+-- tables need PostgreSQL 17
+CREATE SEQUENCE ledger_entry_id_seq;
+
+-- Ledger entry headers; change amounts live in the typed streams below.
+-- Every ledger table is partitioned by epoch (one game week each) so sealed
+-- epochs can be detached.
+CREATE TABLE ledger_transactions (
+    entry_id INT NOT NULL DEFAULT nextval('ledger_entry_id_seq'),
+    epoch_id INT NOT NULL DEFAULT ledger_open_epoch(),
     time_id INT REFERENCES game_time(time_id),
     entry_type TEXT NOT NULL CHECK (
         entry_type IN (
@@ -283,41 +428,125 @@ CREATE TABLE ledger_entries (
     barrel_purchase_id INT REFERENCES barrel_purchases(purchase_id),
     cart_id INT REFERENCES carts(cart_id),
     potion_id INT REFERENCES potions(potion_id),
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (entry_id, epoch_id)
+) PARTITION BY LIST (epoch_id);
+
+CREATE TABLE ledger_gold (
+    entry_id INT NOT NULL,
+    epoch_id INT NOT NULL,
+    time_id INT,
+    gold_change INT NOT NULL,
+    PRIMARY KEY (entry_id, epoch_id)
+) PARTITION BY LIST (epoch_id);
+
+CREATE TABLE ledger_ml (
+    entry_id INT NOT NULL,
+    epoch_id INT NOT NULL,
+    time_id INT,
     color_id INT REFERENCES color_definitions(color_id),
-    
-    -- Change amounts
-    gold_change INT,
-    ml_change INT,
-    potion_change INT,
+    ml_change INT NOT NULL,
+    PRIMARY KEY (entry_id, epoch_id)
+) PARTITION BY LIST (epoch_id);
+
+CREATE TABLE ledger_potions (
+    entry_id INT NOT NULL,
+    epoch_id INT NOT NULL,
+    time_id INT,
+    potion_id INT REFERENCES potions(potion_id),
+    potion_change INT NOT NULL,
+    PRIMARY KEY (entry_id, epoch_id)
+) PARTITION BY LIST (epoch_id);
+
+CREATE TABLE ledger_capacity (
+    entry_id INT NOT NULL,
+    epoch_id INT NOT NULL,
+    time_id INT,
     ml_capacity_change INT,
     potion_capacity_change INT,
-    
-    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-);
-
--- View ledgers
+    PRIMARY KEY (entry_id, epoch_id)
+) PARTITION BY LIST (epoch_id);
+
+-- Partitions for later epochs are created as earlier ones are sealed
+CREATE TABLE ledger_transactions_e1 PARTITION OF ledger_transactions FOR VALUES IN (1);
+CREATE TABLE ledger_gold_e1 PARTITION OF ledger_gold FOR VALUES IN (1);
+CREATE TABLE ledger_ml_e1 PARTITION OF ledger_ml FOR VALUES IN (1);
+CREATE TABLE ledger_potions_e1 PARTITION OF ledger_potions FOR VALUES IN (1);
+CREATE TABLE ledger_capacity_e1 PARTITION OF ledger_capacity FOR VALUES IN (1);
+
+-- Wide ledger shape over the typed streams; inserts are split by trigger
+CREATE VIEW ledger_entries AS
+SELECT
+    lt.entry_id,
+    lt.epoch_id,
+    lt.time_id,
+    lt.entry_type,
+    lt.barrel_purchase_id,
+    lt.cart_id,
+    lt.potion_id,
+    lm.color_id,
+    lg.gold_change,
+    lm.ml_change,
+    lp.potion_change,
+    lc.ml_capacity_change,
+    lc.potion_capacity_change,
+    lt.created_at
+FROM ledger_transactions lt
+LEFT JOIN ledger_gold lg ON lg.entry_id = lt.entry_id AND lg.epoch_id = lt.epoch_id
+LEFT JOIN ledger_ml lm ON lm.entry_id = lt.entry_id AND lm.epoch_id = lt.epoch_id
+LEFT JOIN ledger_potions lp ON lp.entry_id = lt.entry_id AND lp.epoch_id = lt.epoch_id
+LEFT JOIN ledger_capacity lc ON lc.entry_id = lt.entry_id AND lc.epoch_id = lt.epoch_id;
+
+-- View ledgers: last checkpoint plus each stream's entries in the open epoch
 CREATE VIEW current_state AS
-WITH ledger_totals AS (
+WITH last_checkpoint AS (
+    SELECT *
+    FROM ledger_checkpoints
+    WHERE epoch_id = (SELECT MAX(epoch_id) FROM ledger_checkpoints)
+),
+sealed AS (
+    SELECT COALESCE(MAX(epoch_id), 0) as epoch_id
+    FROM ledger_checkpoints
+),
+open_totals AS (
     SELECT
-        COALESCE(SUM(gold_change), 0) as gold,
-        COALESCE(SUM(CASE WHEN color_id = (SELECT color_id FROM color_definitions WHERE color_name = 'RED') 
-            THEN ml_change ELSE 0 END), 0) as red_ml,
-        COALESCE(SUM(CASE WHEN color_id = (SELECT color_id FROM color_definitions WHERE color_name = 'GREEN') 
-            THEN ml_change ELSE 0 END), 0) as green_ml,
-        COALESCE(SUM(CASE WHEN color_id = (SELECT color_id FROM color_definitions WHERE color_name = 'BLUE') 
-            THEN ml_change ELSE 0 END), 0) as blue_ml,
-        COALESCE(SUM(CASE WHEN color_id = (SELECT color_id FROM color_definitions WHERE color_name = 'DARK') 
-            THEN ml_change ELSE 0 END), 0) as dark_ml,
-        COALESCE(SUM(potion_change), 0) as total_potions,
-        COALESCE(SUM(potion_capacity_change), 0) as potion_capacity_units,
-        COALESCE(SUM(ml_capacity_change), 0) as ml_capacity_units
-    FROM ledger_entries
+        (SELECT COALESCE(SUM(gold_change), 0) FROM ledger_gold
+            WHERE epoch_id > (SELECT epoch_id FROM sealed)) as gold,
+        (SELECT COALESCE(SUM(ml_change), 0) FROM ledger_ml
+            WHERE epoch_id > (SELECT epoch_id FROM sealed)
+            AND color_id = (SELECT color_id FROM color_definitions WHERE color_name = 'RED')) as red_ml,
+        (SELECT COALESCE(SUM(ml_change), 0) FROM ledger_ml
+            WHERE epoch_id > (SELECT epoch_id FROM sealed)
+            AND color_id = (SELECT color_id FROM color_definitions WHERE color_name = 'GREEN')) as green_ml,
+        (SELECT COALESCE(SUM(ml_change), 0) FROM ledger_ml
+            WHERE epoch_id > (SELECT epoch_id FROM sealed)
+            AND color_id = (SELECT color_id FROM color_definitions WHERE color_name = 'BLUE')) as blue_ml,
+        (SELECT COALESCE(SUM(ml_change), 0) FROM ledger_ml
+            WHERE epoch_id > (SELECT epoch_id FROM sealed)
+            AND color_id = (SELECT color_id FROM color_definitions WHERE color_name = 'DARK')) as dark_ml,
+        (SELECT COALESCE(SUM(potion_change), 0) FROM ledger_potions
+            WHERE epoch_id > (SELECT epoch_id FROM sealed)) as total_potions,
+        (SELECT COALESCE(SUM(potion_capacity_change), 0) FROM ledger_capacity
+            WHERE epoch_id > (SELECT epoch_id FROM sealed)) as potion_capacity_units,
+        (SELECT COALESCE(SUM(ml_capacity_change), 0) FROM ledger_capacity
+            WHERE epoch_id > (SELECT epoch_id FROM sealed)) as ml_capacity_units
+),
+ledger_totals AS (
+    SELECT
+        o.gold + COALESCE(c.gold, 0) as gold,
+        o.red_ml + COALESCE(c.red_ml, 0) as red_ml,
+        o.green_ml + COALESCE(c.green_ml, 0) as green_ml,
+        o.blue_ml + COALESCE(c.blue_ml, 0) as blue_ml,
+        o.dark_ml + COALESCE(c.dark_ml, 0) as dark_ml,
+        o.total_potions + COALESCE(c.total_potions, 0) as total_potions,
+        o.potion_capacity_units + COALESCE(c.potion_capacity_units, 0) as potion_capacity_units,
+        o.ml_capacity_units + COALESCE(c.ml_capacity_units, 0) as ml_capacity_units
+    FROM open_totals o
+    LEFT JOIN last_checkpoint c ON true
 ),
 active_strat AS (
     SELECT strategy_id
-    FROM active_strategy
-    ORDER BY activated_at DESC
-    LIMIT 1
+    FROM current_strategy
 )
 SELECT 
     gold,
@@ -339,15 +568,90 @@ CREATE INDEX idx_game_time_day_hour ON game_time(in_game_day, in_game_hour);
 CREATE INDEX idx_barrel_visits_time ON barrel_visits(time_id);
 CREATE INDEX idx_barrel_purchases_time ON barrel_purchases(time_id);
 CREATE INDEX idx_barrel_purchases_success ON barrel_purchases(purchase_success);
+CREATE INDEX idx_barrel_purchases_created ON barrel_purchases(created_at);
 CREATE INDEX idx_cart_items_potion ON cart_items(potion_id);
 CREATE INDEX idx_customer_visits_visit_id ON customer_visits(visit_id);
 CREATE INDEX idx_customers_visit_id ON customers(visit_id);
+CREATE INDEX idx_customers_lookup ON customers(visit_record_id, identity_id, level);
+CREATE INDEX idx_customers_identity ON customers(identity_id);
 CREATE INDEX idx_carts_visit_id ON carts(visit_id);
 CREATE INDEX idx_cart_items_visit_id ON cart_items(visit_id);
-CREATE INDEX idx_ledger_entries_entry_type ON ledger_entries (entry_type);
-CREATE INDEX idx_ledger_entries_gold_change ON ledger_entries (gold_change) WHERE gold_change IS NOT NULL;
+CREATE INDEX idx_ledger_transactions_entry_type ON ledger_transactions (entry_type);
+CREATE INDEX idx_ledger_transactions_created ON ledger_transactions (created_at);
+CREATE INDEX idx_ledger_gold_epoch ON ledger_gold (epoch_id, time_id) INCLUDE (gold_change);
+CREATE INDEX idx_ledger_ml_color ON ledger_ml (epoch_id, color_id, time_id) INCLUDE (ml_change);
+CREATE INDEX idx_ledger_potions_potion ON ledger_potions (epoch_id, potion_id, time_id) INCLUDE (potion_change);
+CREATE INDEX idx_ledger_capacity_epoch ON ledger_capacity (epoch_id, time_id) INCLUDE (ml_capacity_change, potion_capacity_change);
 CREATE INDEX idx_strategy_time_blocks_lookup ON strategy_time_blocks(strategy_id, time_block_id, day_name);
 CREATE INDEX idx_potion_sales_time ON cart_items(time_id, potion_id);
+CREATE INDEX idx_active_strategy_activated ON active_strategy(activated_at DESC);
+
+-- Keep current_strategy pointing at the latest activation
+CREATE OR REPLACE FUNCTION sync_current_strategy() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO current_strategy (
+        singleton, active_strategy_id, strategy_id, game_time_id, tick_id, activated_at
+    ) VALUES (
+        true, NEW.active_strategy_id, NEW.strategy_id, NEW.game_time_id, NEW.tick_id, NEW.activated_at
+    )
+    ON CONFLICT (singleton) DO UPDATE SET
+        active_strategy_id = EXCLUDED.active_strategy_id,
+        strategy_id = EXCLUDED.strategy_id,
+        game_time_id = EXCLUDED.game_time_id,
+        tick_id = EXCLUDED.tick_id,
+        activated_at = EXCLUDED.activated_at;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_active_strategy_pointer
+AFTER INSERT ON active_strategy
+FOR EACH ROW EXECUTE FUNCTION sync_current_strategy();
+
+-- Split each ledger entry into its typed streams. The epoch, and with it the
+-- ledger lock, is taken before the entry id is drawn.
+CREATE OR REPLACE FUNCTION write_ledger_entry() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.epoch_id := ledger_open_epoch();
+
+    INSERT INTO ledger_transactions (
+        epoch_id, time_id, entry_type, barrel_purchase_id, cart_id, potion_id
+    ) VALUES (
+        NEW.epoch_id, NEW.time_id, NEW.entry_type, NEW.barrel_purchase_id, NEW.cart_id, NEW.potion_id
+    )
+    RETURNING entry_id, created_at
+    INTO NEW.entry_id, NEW.created_at;
+
+    IF NEW.gold_change IS NOT NULL THEN
+        INSERT INTO ledger_gold (entry_id, epoch_id, time_id, gold_change)
+        VALUES (NEW.entry_id, NEW.epoch_id, NEW.time_id, NEW.gold_change);
+    END IF;
+
+    IF NEW.ml_change IS NOT NULL THEN
+        INSERT INTO ledger_ml (entry_id, epoch_id, time_id, color_id, ml_change)
+        VALUES (NEW.entry_id, NEW.epoch_id, NEW.time_id, NEW.color_id, NEW.ml_change);
+    END IF;
+
+    IF NEW.potion_change IS NOT NULL THEN
+        INSERT INTO ledger_potions (entry_id, epoch_id, time_id, potion_id, potion_change)
+        VALUES (NEW.entry_id, NEW.epoch_id, NEW.time_id, NEW.potion_id, NEW.potion_change);
+    END IF;
+
+    IF NEW.ml_capacity_change IS NOT NULL OR NEW.potion_capacity_change IS NOT NULL THEN
+        INSERT INTO ledger_capacity (
+            entry_id, epoch_id, time_id, ml_capacity_change, potion_capacity_change
+        ) VALUES (
+            NEW.entry_id, NEW.epoch_id, NEW.time_id,
+            NEW.ml_capacity_change, NEW.potion_capacity_change
+        );
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_ledger_entries_write
+INSTEAD OF INSERT ON ledger_entries
+FOR EACH ROW EXECUTE FUNCTION write_ledger_entry();
 
 -- Populate game_time with all day/hour combinations and their references
 INSERT INTO game_time
@@ -494,7 +798,7 @@ VALUES
 -- PREMIUM to PENETRATION (requires any of: 250 gold, 5 potions, or 500 ml)
 ((SELECT strategy_id FROM strategies WHERE name = 'PREMIUM'),
  (SELECT strategy_id FROM strategies WHERE name = 'PENETRATION'),
- 250, 5, 500, 1, 1, true),
+ 250, 5, 500, 1, 1, false),
 
 -- PENETRATION to TIERED (only checks capacity)
 ((SELECT strategy_id FROM strategies WHERE name = 'PENETRATION'),
@@ -782,4 +1086,11 @@ INSERT INTO ledger_entries (
     potion_capacity_change
 )
 VALUES 
-(1, 'ADMIN_CHANGE', 100, 1, 1);
\ No newline at end of file
+(1, 'ADMIN_CHANGE', 100, 1, 1);
+
+-- Balances as of the first tick
+INSERT INTO ledger_balances (
+    gold, total_potions, total_ml, ml_capacity_units, potion_capacity_units
+)
+SELECT gold, total_potions, total_ml, ml_capacity_units, potion_capacity_units
+FROM current_state;
\ No newline at end of file
@@ -0,0 +1,324 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+class AnalyticsStore:
+    """
+    Local DuckDB copy of the ledger, sold cart lines and barrel purchases for
+    reporting. Each sync appends rows past a per-source high-water mark, read
+    from a read-only snapshot, so reports never run on the serving database.
+    Epochs must be synced before they are archived out of the live ledger.
+    """
+
+    # Rows created up to this many seconds before the previous sync are
+    # re-read, whatever their id, so rows whose transaction committed after a
+    # later id was synced are still picked up. Stored ids are skipped. A row
+    # whose transaction was already open longer than this at a sync is lost.
+    REREAD_SECONDS = 600
+
+    # Rows fetched per server-side cursor round trip
+    BATCH_ROWS = 5000
+
+    TABLES = {
+        'ledger_entries': """
+            CREATE TABLE IF NOT EXISTS ledger_entries (
+                entry_id BIGINT PRIMARY KEY,
+                epoch_id INTEGER,
+                time_id INTEGER,
+                entry_type VARCHAR,
+                barrel_purchase_id INTEGER,
+                cart_id INTEGER,
+                potion_id INTEGER,
+                color_id INTEGER,
+                gold_change INTEGER,
+                ml_change INTEGER,
+                potion_change INTEGER,
+                ml_capacity_change INTEGER,
+                potion_capacity_change INTEGER
+            )
+        """,
+        'cart_items': """
+            CREATE TABLE IF NOT EXISTS cart_items (
+                entry_id BIGINT PRIMARY KEY,
+                item_id INTEGER,
+                cart_id INTEGER,
+                potion_id INTEGER,
+                sku VARCHAR,
+                epoch_id INTEGER,
+                time_id INTEGER,
+                quantity INTEGER,
+                unit_price INTEGER,
+                line_total INTEGER
+            )
+        """,
+        'barrel_purchases': """
+            CREATE TABLE IF NOT EXISTS barrel_purchases (
+                purchase_id BIGINT PRIMARY KEY,
+                visit_id INTEGER,
+                barrel_id INTEGER,
+                time_id INTEGER,
+                sku VARCHAR,
+                color_id INTEGER,
+                quantity INTEGER,
+                total_cost INTEGER,
+                ml_added INTEGER
+            )
+        """
+    }
+
+    # Incremental sources: rows past :after_id or created since :reread_since, ordered
+    # by the id in their first column. Cart lines are keyed by their POTION_SOLD entry,
+    # which only exists once the cart has checked out.
+    SOURCES = {
+        'ledger_entries': """
+            SELECT
+                entry_id, epoch_id, time_id, entry_type, barrel_purchase_id,
+                cart_id, potion_id, color_id, gold_change, ml_change,
+                potion_change, ml_capacity_change, potion_capacity_change
+            FROM ledger_entries
+            WHERE entry_id > :after_id
+            OR created_at >= :reread_since
+            ORDER BY entry_id
+        """,
+        'cart_items': """
+            SELECT
+                le.entry_id, ci.item_id, ci.cart_id, ci.potion_id, p.sku,
+                le.epoch_id, le.time_id, ci.quantity, ci.unit_price, ci.line_total
+            FROM ledger_entries le
+            JOIN cart_items ci ON ci.cart_id = le.cart_id AND ci.potion_id = le.potion_id
+            JOIN potions p ON p.potion_id = ci.potion_id
+            WHERE le.entry_type = 'POTION_SOLD'
+            AND (le.entry_id > :after_id OR le.created_at >= :reread_since)
+            ORDER BY le.entry_id
+        """,
+        'barrel_purchases': """
+            SELECT
+                bp.purchase_id, bp.visit_id, bp.barrel_id, bp.time_id, bd.sku,
+                bp.color_id, bp.quantity, bp.total_cost, bp.ml_added
+            FROM barrel_purchases bp
+            JOIN barrel_details bd ON bd.barrel_id = bp.barrel_id
+            WHERE (bp.purchase_id > :after_id OR bp.created_at >= :reread_since)
+            AND bp.purchase_success = TRUE
+            ORDER BY bp.purchase_id
+        """
+    }
+
+    # Small dimensions replaced wholesale on every sync
+    DIMENSIONS = {
+        'game_time': """
+            SELECT time_id, in_game_day, in_game_hour FROM game_time
+        """,
+        'time_blocks': """
+            SELECT block_id, name, start_hour, end_hour FROM time_blocks
+        """,
+        'color_definitions': """
+            SELECT color_id, color_name FROM color_definitions
+        """
+    }
+
+    DIMENSION_TABLES = {
+        'game_time': "time_id INTEGER, in_game_day VARCHAR, in_game_hour INTEGER",
+        'time_blocks': "block_id INTEGER, name VARCHAR, start_hour INTEGER, end_hour INTEGER",
+        'color_definitions': "color_id INTEGER, color_name VARCHAR"
+    }
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Opens the DuckDB file, creating its tables on first use."""
+        # Optional dependency, only needed where analytics run
+        import duckdb
+
+        duck = duckdb.connect(self.path)
+        for ddl in self.TABLES.values():
+            duck.execute(ddl)
+        for table, columns in self.DIMENSION_TABLES.items():
+            duck.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+        duck.execute("""
+            CREATE TABLE IF NOT EXISTS sync_marks (
+                source VARCHAR PRIMARY KEY,
+                high_water BIGINT NOT NULL
+            )
+        """)
+        duck.execute("ALTER TABLE sync_marks ADD COLUMN IF NOT EXISTS synced_at DOUBLE")
+        return duck
+
+    def get_marks(self) -> Dict[str, int]:
+        """Returns the high-water mark of each incremental source."""
+        with self._lock:
+            duck = self.connect()
+            try:
+                return self.read_marks(duck)
+            finally:
+                duck.close()
+
+    def read_marks(self, duck) -> Dict[str, int]:
+        """Reads high-water marks on an open store connection."""
+        marks = dict(duck.execute(
+            "SELECT source, high_water FROM sync_marks"
+        ).fetchall())
+        return {source: marks.get(source, 0) for source in self.SOURCES}
+
+    def read_sync_times(self, duck) -> Dict[str, Optional[float]]:
+        """Reads when each source was last synced, in epoch seconds."""
+        synced = dict(duck.execute(
+            "SELECT source, synced_at FROM sync_marks"
+        ).fetchall())
+        return {source: synced.get(source) for source in self.SOURCES}
+
+    @classmethod
+    def reread_since(cls, conn, synced_at: Optional[float]):
+        """
+        Returns the created_at bound of a source's re-read window as the
+        dialect stores it: timestamps on PostgreSQL, epoch seconds on SQLite.
+        """
+        if synced_at is None:
+            return None
+
+        since = synced_at - cls.REREAD_SECONDS
+        if conn.dialect.name == 'postgresql':
+            return datetime.fromtimestamp(since, timezone.utc)
+        return int(since)
+
+    def sync(self, conn) -> Dict[str, int]:
+        """
+        Appends new source rows read on conn and refreshes the dimensions,
+        committing the store in one transaction. Returns rows added per source.
+        """
+        started = time.time()
+        with self._lock:
+            duck = self.connect()
+            try:
+                duck.begin()
+                marks = self.read_marks(duck)
+                synced_at = self.read_sync_times(duck)
+                added = {}
+
+                for source, query in self.SOURCES.items():
+                    added[source], high_water = self.append(
+                        duck,
+                        conn,
+                        source,
+                        query,
+                        marks[source],
+                        self.reread_since(conn, synced_at[source])
+                    )
+                    duck.execute(
+                        "INSERT OR REPLACE INTO sync_marks (source, high_water, synced_at) VALUES (?, ?, ?)",
+                        [source, max(marks[source], high_water), started]
+                    )
+
+                for table, query in self.DIMENSIONS.items():
+                    rows = conn.execute(sqlalchemy.text(query)).all()
+                    duck.execute(f"DELETE FROM {table}")
+                    if rows:
+                        placeholders = ", ".join("?" for _ in rows[0])
+                        duck.executemany(
+                            f"INSERT INTO {table} VALUES ({placeholders})",
+                            [tuple(row) for row in rows]
+                        )
+
+                duck.commit()
+            except Exception:
+                duck.rollback()
+                raise
+            finally:
+                duck.close()
+
+        logger.info(f"Analytics sync added {added}")
+        return added
+
+    def append(self, duck, conn, table: str, query: str, after_id: int, reread_since=None) -> tuple:
+        """
+        Streams rows past after_id or created since reread_since into table,
+        skipping stored ids. Returns rows added and the highest id read.
+        """
+        before = duck.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        result = conn.execution_options(
+            stream_results=True,
+            yield_per=self.BATCH_ROWS
+        ).execute(
+            sqlalchemy.text(query),
+            {"after_id": after_id, "reread_since": reread_since}
+        )
+        columns = ", ".join(result.keys())
+        placeholders = ", ".join("?" for _ in result.keys())
+
+        high_water = after_id
+        for partition in result.partitions():
+            duck.executemany(
+                f"INSERT OR IGNORE INTO {table} ({columns}) VALUES ({placeholders})",
+                [tuple(row) for row in partition]
+            )
+            high_water = partition[-1][0]
+
+        after = duck.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        return after - before, high_water
+
+    def query(self, sql: str, params: Optional[list] = None) -> List[dict]:
+        """Runs a read query against the store and returns rows as dicts."""
+        with self._lock:
+            duck = self.connect()
+            try:
+                cursor = duck.execute(sql, params or [])
+                columns = [column[0] for column in cursor.description]
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            finally:
+                duck.close()
+
+    def profit_per_tick(self, from_epoch_id: Optional[int] = None) -> List[dict]:
+        """Returns gold in, gold out and net profit per tick (epoch, time_id)."""
+        return self.query("""
+            SELECT
+                epoch_id,
+                time_id,
+                COALESCE(SUM(gold_change) FILTER (WHERE gold_change > 0), 0) as gold_in,
+                COALESCE(-SUM(gold_change) FILTER (WHERE gold_change < 0), 0) as gold_out,
+                COALESCE(SUM(gold_change), 0) as profit
+            FROM ledger_entries
+            WHERE gold_change IS NOT NULL
+            AND (? IS NULL OR epoch_id >= ?)
+            GROUP BY epoch_id, time_id
+            ORDER BY epoch_id, time_id
+        """, [from_epoch_id, from_epoch_id])
+
+    def sales_per_block(self) -> List[dict]:
+        """Returns potions sold and gold earned per time block and sku."""
+        return self.query("""
+            SELECT
+                tb.name as block,
+                ci.sku,
+                SUM(ci.quantity) as potions_sold,
+                SUM(ci.line_total) as gold
+            FROM cart_items ci
+            JOIN game_time gt ON gt.time_id = ci.time_id
+            JOIN time_blocks tb ON gt.in_game_hour BETWEEN tb.start_hour AND tb.end_hour
+            GROUP BY tb.block_id, tb.name, ci.sku
+            ORDER BY tb.block_id, potions_sold DESC, ci.sku
+        """)
+
+    def ml_usage(self) -> List[dict]:
+        """Returns ml bought, bottled and adjusted per color."""
+        return self.query("""
+            SELECT
+                cd.color_name as color,
+                COALESCE(SUM(le.ml_change) FILTER (WHERE le.entry_type = 'BARREL_PURCHASE'), 0) as ml_bought,
+                COALESCE(-SUM(le.ml_change) FILTER (WHERE le.entry_type = 'POTION_BOTTLED'), 0) as ml_bottled,
+                COALESCE(SUM(le.ml_change) FILTER (
+                    WHERE le.entry_type NOT IN ('BARREL_PURCHASE', 'POTION_BOTTLED')
+                ), 0) as ml_adjusted
+            FROM color_definitions cd
+            LEFT JOIN ledger_entries le ON le.color_id = cd.color_id
+            GROUP BY cd.color_id, cd.color_name
+            ORDER BY cd.color_id
+        """)
+
+analytics_store = AnalyticsStore(os.environ.get("ANALYTICS_DB_PATH", "analytics.duckdb"))
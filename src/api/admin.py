@@ -1,9 +1,16 @@
 import sqlalchemy
 import logging
+from enum import Enum
+from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from src.api import auth
 from src import database as db
-from src.utilities import TimeManager, LedgerManager
+from src.analytics import analytics_store
+from src.retry import retry_metrics
+from src.utilities import (
+    TimeManager, LedgerManager, StrategyManager, ExportManager, DemandForecaster
+)
 
 logger = logging.getLogger(__name__)
 
@@ -13,42 +20,53 @@ router = APIRouter(
     dependencies=[Depends(auth.get_api_key)],
 )
 
+class export_format(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
 @router.post("/reset")
 def reset():
     """Reset the game state to initial values."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def reset_state(conn):
             # Get current time
             current_time = TimeManager.get_current_time(conn)
             logger.debug("Starting game state reset")
             
-            # Clear current state
+            # Clear current state. ledger_balances keeps its epoch so epoch ids keep
+            # counting up past archived epochs; its totals are refreshed below.
             conn.execute(sqlalchemy.text("""
                 TRUNCATE TABLE active_strategy CASCADE;
                 TRUNCATE TABLE current_game_time CASCADE;
-                TRUNCATE TABLE ledger_entries CASCADE;
+                TRUNCATE TABLE ledger_transactions, ledger_gold, ledger_ml,
+                    ledger_potions, ledger_capacity CASCADE;
+                TRUNCATE TABLE ledger_checkpoints;
+                TRUNCATE TABLE sales_rollup;
             """))
+            LedgerManager.create_partitions(conn, LedgerManager.get_open_epoch(conn))
             
             # Reset potion quantities
             conn.execute(sqlalchemy.text(
                 "UPDATE potions SET current_quantity = 0"
             ))
             
-            # Record current time
-            conn.execute(
+            # Record current time and its empty balance snapshot
+            tick_id = conn.execute(
                 sqlalchemy.text("""
                     INSERT INTO current_game_time (
                         game_time_id, current_day, current_hour
                     )
                     VALUES (:time_id, :day, :hour)
+                    RETURNING id
                 """),
                 {
                     "time_id": current_time['time_id'],
                     "day": current_time['day'],
                     "hour": current_time['hour']
                 }
-            )
+            ).scalar_one()
+            LedgerManager.record_snapshot(conn, tick_id, current_time['time_id'])
+            LedgerManager.record_reset(conn)
             
             # Create initial gold and capacity ledger entry
             LedgerManager.create_admin_entry(conn, current_time['time_id'])
@@ -60,20 +78,178 @@ def reset():
                 )
             ).scalar_one()
             
-            conn.execute(
-                sqlalchemy.text("""
-                    INSERT INTO active_strategy (strategy_id, game_time_id)
-                    VALUES (:strategy_id, :game_time_id)
-                """),
-                {
-                    "strategy_id": premium_id,
-                    "game_time_id": current_time['time_id']
-                }
+            StrategyManager.activate_strategy(
+                conn,
+                premium_id,
+                current_time['time_id'],
+                tick_id
             )
             
             logger.info("Successfully reset game state")
             return {"success": True}
+
+        result = db.run_in_transaction(reset_state, "admin.reset")
+
+        # Publish only after commit so readers never cache an uncommitted strategy
+        StrategyManager.invalidate_cache()
+        return result
             
     except Exception as e:
         logger.error(f"Failed to reset game state: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to reset game state")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to reset game state")
+
+@router.get("/metrics/retries")
+def get_retry_metrics():
+    """Get transaction retry counts per endpoint operation."""
+    return retry_metrics.snapshot()
+
+@router.get("/metrics/replica")
+def get_replica_metrics():
+    """Get read replica routing counts and last observed lag."""
+    return db.replica_router.snapshot()
+
+@router.get("/ledger/checkpoints")
+def get_ledger_checkpoints():
+    """Get open ledger epoch and closing balances of sealed epochs."""
+    try:
+        def read_checkpoints(conn):
+            checkpoints = conn.execute(
+                sqlalchemy.text("""
+                    SELECT *
+                    FROM ledger_checkpoints
+                    ORDER BY epoch_id
+                """)
+            ).mappings().all()
+
+            return {
+                "open_epoch": LedgerManager.get_open_epoch(conn),
+                "checkpoints": [dict(row) for row in checkpoints]
+            }
+
+        return db.run_read_only(read_checkpoints, "admin.ledger_checkpoints")
+
+    except Exception as e:
+        logger.error(f"Failed to get ledger checkpoints: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to get ledger checkpoints")
+
+@router.get("/demand/forecast")
+def get_demand_forecast():
+    """Get smoothed units sold per potion, day and time block."""
+    try:
+        def read_forecast(conn):
+            forecast = DemandForecaster.get_forecast(conn)
+            return [
+                {
+                    "potion_id": potion_id,
+                    "day": day,
+                    "time_block_id": time_block_id,
+                    "units": round(units, 2)
+                }
+                for (potion_id, day, time_block_id), units in sorted(forecast.items())
+            ]
+
+        return db.run_read_only(read_forecast, "admin.demand_forecast")
+
+    except Exception as e:
+        logger.error(f"Failed to get demand forecast: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to get demand forecast")
+
+@router.post("/ledger/epochs/{epoch_id}/archive")
+def archive_ledger_epoch(epoch_id: int):
+    """Move a sealed ledger epoch's entries out of the live ledger."""
+    try:
+        def archive_epoch(conn):
+            archive_prefix = LedgerManager.archive_epoch(conn, epoch_id)
+            return {"epoch_id": epoch_id, "archive_prefix": archive_prefix}
+
+        return db.run_in_transaction(archive_epoch, "admin.archive_ledger_epoch")
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to archive ledger epoch {epoch_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to archive ledger epoch")
+
+def stream_export(
+    name: str,
+    query: str,
+    format: export_format,
+    from_time_id: Optional[int],
+    to_time_id: Optional[int]
+) -> StreamingResponse:
+    """Stream an export query from a read-only snapshot as a file download."""
+    if from_time_id is not None and to_time_id is not None and from_time_id > to_time_id:
+        raise HTTPException(status_code=400, detail="from_time_id must not exceed to_time_id")
+
+    def export_rows(conn):
+        return ExportManager.stream(conn, query, format.value, from_time_id, to_time_id)
+
+    return StreamingResponse(
+        db.stream_on_replica(export_rows),
+        media_type=ExportManager.MEDIA_TYPES[format.value],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{format.value}"'}
+    )
+
+@router.get("/export/ledger")
+def export_ledger(
+    format: export_format = export_format.ndjson,
+    from_time_id: Optional[int] = None,
+    to_time_id: Optional[int] = None
+):
+    """Stream live ledger entries, optionally within a time_id range."""
+    return stream_export("ledger", ExportManager.LEDGER_QUERY, format, from_time_id, to_time_id)
+
+@router.get("/export/orders")
+def export_orders(
+    format: export_format = export_format.ndjson,
+    from_time_id: Optional[int] = None,
+    to_time_id: Optional[int] = None
+):
+    """Stream checked out cart lines and barrel purchases, optionally within a time_id range."""
+    return stream_export("orders", ExportManager.ORDERS_QUERY, format, from_time_id, to_time_id)
+
+@router.post("/analytics/sync")
+def sync_analytics():
+    """
+    Append new ledger, sale and barrel rows to the local analytics store.
+    Rows are synced by id and re-read if created within
+    AnalyticsStore.REREAD_SECONDS before the previous sync, so a row whose
+    transaction was open longer than that when a sync ran is never picked up.
+    """
+    try:
+        added = db.run_on_replica(analytics_store.sync, "admin.analytics_sync")
+        return {"added": added, "high_water": analytics_store.get_marks()}
+
+    except Exception as e:
+        logger.error(f"Failed to sync analytics store: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to sync analytics store")
+
+@router.get("/analytics/profit")
+def get_profit_per_tick(from_epoch_id: Optional[int] = None):
+    """Get gold in, gold out and net profit per tick from the analytics store."""
+    try:
+        return analytics_store.profit_per_tick(from_epoch_id)
+
+    except Exception as e:
+        logger.error(f"Failed to get profit per tick: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to get profit per tick")
+
+@router.get("/analytics/sales")
+def get_sales_per_block():
+    """Get potions sold and gold earned per time block and sku from the analytics store."""
+    try:
+        return analytics_store.sales_per_block()
+
+    except Exception as e:
+        logger.error(f"Failed to get sales per block: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to get sales per block")
+
+@router.get("/analytics/ml")
+def get_ml_usage():
+    """Get ml bought, bottled and adjusted per color from the analytics store."""
+    try:
+        return analytics_store.ml_usage()
+
+    except Exception as e:
+        logger.error(f"Failed to get ml usage: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to get ml usage")
@@ -1,11 +1,13 @@
+import os
 import sqlalchemy
 import logging
+from enum import Enum
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from src.api import auth
 from src import database as db
-from src.utilities import BarrelManager, TimeManager
+from src.utilities import BarrelManager, JointPlanner, OrderManager, RequestContext
 
 logger = logging.getLogger('test_barrels.barrels')
 #logger = logging.getLogger(__name__)
@@ -27,42 +29,73 @@ class BarrelPurchase(BaseModel):
     sku: str
     quantity: int
 
+class plan_engine(str, Enum):
+    needs = "needs"
+    joint = "joint"
+
+# Engine used when a plan request does not name one
+try:
+    DEFAULT_PLAN_ENGINE = plan_engine(os.environ.get("BARREL_PLAN_ENGINE", "needs"))
+except ValueError:
+    logger.warning(
+        f"Unknown BARREL_PLAN_ENGINE {os.environ['BARREL_PLAN_ENGINE']!r}, "
+        f"falling back to {plan_engine.needs.value}"
+    )
+    DEFAULT_PLAN_ENGINE = plan_engine.needs
+
 @router.post("/plan")
-def get_wholesale_purchase_plan(wholesale_catalog: List[Barrel]):
-    """Plan barrel purchases based on future needs and strategy constraints."""
+def get_wholesale_purchase_plan(
+    wholesale_catalog: List[Barrel],
+    engine: Optional[plan_engine] = None
+):
+    """
+    Plan barrel purchases based on future needs and strategy constraints.
+    The joint engine buys only ml the arrival block's recipes can bottle.
+    """
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
-            # Convert Pydantic models to dicts
-            catalog_dicts = [barrel.dict() for barrel in wholesale_catalog]
+        # Convert Pydantic models to dicts
+        catalog_dicts = [barrel.dict() for barrel in wholesale_catalog]
 
-            # Log wholesale catalog
-            logger.debug(f"Wholesale catalog: {catalog_dicts}")
-            
-            # Get current time
-            current_time = TimeManager.get_current_time(conn)
-            time_id = current_time['time_id']
-            
-            # Record catalog first
-            visit_id = BarrelManager.record_catalog(
+        # Log wholesale catalog
+        logger.debug(f"Wholesale catalog: {catalog_dicts}")
+
+        def record_catalog(conn):
+            ctx = RequestContext(conn)
+            return BarrelManager.record_catalog(
                 conn, 
                 catalog_dicts,
-                time_id
-            )
-            
-            logger.debug(f"Recorded wholesale catalog with visit_id: {visit_id}")
-            
-            # Plan purchases
-            purchases = BarrelManager.plan_barrel_purchases(
-                conn,
-                catalog_dicts,
-                time_id
+                ctx.time_id,
+                ctx
             )
+
+        # Record catalog first
+        visit_id = db.run_in_transaction(record_catalog, "barrels.record_catalog")
+        logger.debug(f"Recorded wholesale catalog with visit_id: {visit_id}")
+
+        def plan_purchases(conn):
+            ctx = RequestContext(conn)
+            if (engine or DEFAULT_PLAN_ENGINE) is plan_engine.joint:
+                plan = JointPlanner.plan(conn, catalog_dicts, ctx.time_id, ctx)
+                logger.debug(
+                    f"Joint plan expects {plan['potions']} potions for {plan['gold']} gold: "
+                    f"{plan['bottling']}"
+                )
+                purchases = plan['barrels']
+            else:
+                purchases = BarrelManager.plan_barrel_purchases(
+                    conn,
+                    catalog_dicts,
+                    ctx.time_id,
+                    ctx
+                )
             
             return [
                 BarrelPurchase(sku=p['sku'], quantity=p['quantity']) 
                 for p in purchases
             ]
+
+        # Plan purchases from a read-only snapshot
+        return db.run_read_only(plan_purchases, "barrels.plan")
             
     except Exception as e:
         logger.error(f"Purchase planning failed: {str(e)}")
@@ -75,19 +108,21 @@ def get_wholesale_purchase_plan(wholesale_catalog: List[Barrel]):
 def post_deliver_barrels(barrels_delivered: List[Barrel], order_id: int):
     """Process delivery of barrels with strategy constraints."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def deliver_barrels(conn):
+            # Replay stored response for a retried order
+            stored = OrderManager.claim_order(conn, "barrels.deliver", order_id)
+            if stored is not None:
+                return stored
+
             # Convert Pydantic models to dicts
             barrel_dicts = [barrel.dict() for barrel in barrels_delivered]
 
             logger.debug(f"Processing barrel delivery order {order_id}: {barrel_dicts}")
 
             # Get current time and state
-            current_time = TimeManager.get_current_time(conn)
-            time_id = current_time['time_id']
-            state = conn.execute(sqlalchemy.text(
-                "SELECT * FROM current_state"
-            )).mappings().one()
+            ctx = RequestContext(conn)
+            time_id = ctx.time_id
+            state = ctx.state
 
             # Validate total costs and capacity
             total_cost = sum(b['price'] * b['quantity'] for b in barrel_dicts)
@@ -133,7 +168,11 @@ def post_deliver_barrels(barrels_delivered: List[Barrel], order_id: int):
                 f"Completed delivery order {order_id} - "
                 f"total cost: {total_cost}, total ml: {total_ml}"
             )
-            return {"success": True}
+            response = {"success": True}
+            OrderManager.complete_order(conn, "barrels.deliver", order_id, response)
+            return response
+
+        return db.run_in_transaction(deliver_barrels, "barrels.deliver")
             
     except HTTPException:
         raise
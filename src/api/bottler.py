@@ -1,11 +1,10 @@
-import sqlalchemy
 import logging
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from typing import List
 from src.api import auth
 from src import database as db
-from src.utilities import BottlerManager, TimeManager
+from src.utilities import BottlerManager, OrderManager, RequestContext
 
 logger = logging.getLogger(__name__)
 
@@ -23,15 +22,13 @@ class PotionInventory(BaseModel):
 def get_bottle_plan():
     """Plan potion bottling based on future resources and priorities."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def plan_bottling(conn):
             # Get current state
-            state = conn.execute(sqlalchemy.text(
-                "SELECT * FROM current_state"
-            )).mappings().one()
+            ctx = RequestContext(conn)
+            state = ctx.state
             
             # Get priorities and calculate plan
-            priorities = BottlerManager.get_bottling_priorities(conn)
+            priorities = BottlerManager.get_bottling_priorities(conn, ctx)
             
             bottling_plan = BottlerManager.calculate_possible_potions(
                 priorities,
@@ -51,6 +48,8 @@ def get_bottle_plan():
                 ) 
                 for b in bottling_plan
             ]
+
+        return db.run_read_only(plan_bottling, "bottler.plan")
             
     except Exception as e:
         logger.error(f"Failed to create bottling plan: {str(e)}")
@@ -63,11 +62,14 @@ def get_bottle_plan():
 def post_deliver_bottles(potions_delivered: List[PotionInventory], order_id: int):
     """Process potion bottling."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
-            state = conn.execute(sqlalchemy.text(
-                "SELECT * FROM current_state"
-            )).mappings().one()
+        def deliver_bottles(conn):
+            # Replay stored response for a retried order
+            stored = OrderManager.claim_order(conn, "bottler.deliver", order_id)
+            if stored is not None:
+                return stored
+
+            ctx = RequestContext(conn)
+            state = ctx.state
             
             logger.debug(
                 f"Processing bottling order {order_id} "
@@ -99,21 +101,29 @@ def post_deliver_bottles(potions_delivered: List[PotionInventory], order_id: int
                     detail="Insufficient ml"
                 )
             
+            # Lock every delivered potion in SKU order before any ledger write
+            BottlerManager.lock_potions(
+                conn,
+                [potion.potion_type for potion in potions_delivered]
+            )
+
             # Process bottling
-            current_time = TimeManager.get_current_time(conn)
-            
             for potion in potions_delivered:
                 BottlerManager.process_bottling(
                     conn,
                     potion.dict(),
-                    current_time['time_id']
+                    ctx.time_id
                 )
             
             logger.info(
                 f"Successfully bottled {total_potions} potions "
                 f"for order {order_id}"
             )
-            return {"success": True}
+            response = {"success": True}
+            OrderManager.complete_order(conn, "bottler.deliver", order_id, response)
+            return response
+
+        return db.run_in_transaction(deliver_bottles, "bottler.deliver")
             
     except HTTPException:
         raise
@@ -1,8 +1,8 @@
 import sqlalchemy
 import logging
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from enum import Enum
 from datetime import datetime
 from src.api import auth
@@ -42,22 +42,26 @@ class search_sort_order(str, Enum):
 def post_visits(visit_id: int, customers: List[Customer]):
     """Record customers visiting the shop."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def record_visit(conn):
             customers_dicts = [customer.dict() for customer in customers]
 
             current_time = TimeManager.get_current_time(conn)
             time_id = current_time['time_id']
             
-            CartManager.record_customer_visit(
+            return CartManager.record_customer_visit(
                 conn, 
                 visit_id, 
                 customers_dicts, 
                 time_id
             )
-            
-            logger.info(f"Recorded visit for {len(customers)} customers")
-            return {"success": True}
+
+        visit_index = db.run_in_transaction(record_visit, "carts.visits")
+
+        # Publish only after commit so carts never reference rolled back customers
+        CartManager.cache_visit_index(visit_index)
+
+        logger.info(f"Recorded visit for {len(customers)} customers")
+        return {"success": True}
             
     except Exception as e:
         logger.error(f"Failed to record customer visit: {str(e)}")
@@ -67,30 +71,20 @@ def post_visits(visit_id: int, customers: List[Customer]):
 def create_cart(new_cart: Customer):
     """Create new cart for customer."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def open_cart(conn):
             current_time = TimeManager.get_current_time(conn)
             time_id = current_time['time_id']
             
-            visit_id = conn.execute(
-                sqlalchemy.text("""
-                    SELECT visit_id 
-                    FROM customer_visits 
-                    ORDER BY created_at DESC 
-                    LIMIT 1
-                    """
-                )
-            ).scalar_one()
-            
             cart_id = CartManager.create_cart(
                 conn, 
                 new_cart.dict(), 
-                time_id,
-                visit_id
+                time_id
             )
             
             logger.info(f"Created cart {cart_id} for customer {new_cart.customer_name}")
             return {"cart_id": cart_id}
+
+        return db.run_in_transaction(open_cart, "carts.create")
             
     except Exception as e:
         logger.error(f"Failed to create cart: {str(e)}")
@@ -100,8 +94,7 @@ def create_cart(new_cart: Customer):
 def set_item_quantity(cart_id: int, item_sku: str, cart_item: CartItem):
     """Add or update item quantity in cart."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def update_item(conn):
             cart = CartManager.validate_cart_status(conn, cart_id)
             current_time = TimeManager.get_current_time(conn)
             time_id = current_time['time_id']
@@ -120,6 +113,8 @@ def set_item_quantity(cart_id: int, item_sku: str, cart_item: CartItem):
                 f"quantity: {cart_item.quantity}"
             )
             return {"success": True}
+
+        return db.run_in_transaction(update_item, "carts.set_item_quantity")
             
     except HTTPException:
         raise
@@ -128,12 +123,16 @@ def set_item_quantity(cart_id: int, item_sku: str, cart_item: CartItem):
         raise HTTPException(status_code=500, detail="Failed to update item")
 
 @router.post("/{cart_id}/checkout")
-def checkout(cart_id: int, cart_checkout: CartCheckout):
-    """Process cart checkout."""
+def checkout(
+    cart_id: int,
+    cart_checkout: CartCheckout,
+    idempotency_key: Optional[str] = Header(default=None)
+):
+    """Process cart checkout. Retries replay the journaled result."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
-            cart = CartManager.validate_cart_status(conn, cart_id)
+        def checkout_cart(conn):
+            # process_checkout replays a journaled result itself
+            CartManager.validate_cart_status(conn, cart_id)
             current_time = TimeManager.get_current_time(conn)
             time_id = current_time['time_id']
             
@@ -141,7 +140,8 @@ def checkout(cart_id: int, cart_checkout: CartCheckout):
                 conn,
                 cart_id,
                 cart_checkout.payment,
-                time_id
+                time_id,
+                idempotency_key
             )
             
             logger.info(
@@ -150,6 +150,8 @@ def checkout(cart_id: int, cart_checkout: CartCheckout):
             )
 
             return result
+
+        return db.run_in_transaction(checkout_cart, "carts.checkout")
             
     except HTTPException:
         raise
@@ -192,7 +194,7 @@ def search_orders(
     try:
         # Determine primary sort column
         if sort_col is search_sort_options.customer_name:
-            order_by_column = "cu.customer_name"
+            order_by_column = "ident.customer_name"
         elif sort_col is search_sort_options.item_sku:
             order_by_column = "p.sku"
         elif sort_col is search_sort_options.line_item_total:
@@ -220,12 +222,13 @@ def search_orders(
             SELECT
                 ci.item_id as line_item_id,
                 p.sku as item_sku,
-                cu.customer_name,
+                ident.customer_name,
                 ci.line_total as line_item_total,
                 c.checked_out_at as timestamp
             FROM cart_items ci
             JOIN carts c ON ci.cart_id = c.cart_id
             JOIN customers cu ON c.customer_id = cu.customer_id
+            JOIN customer_identities ident ON cu.identity_id = ident.identity_id
             JOIN potions p ON ci.potion_id = p.potion_id
             WHERE c.checked_out = true
         """
@@ -234,7 +237,7 @@ def search_orders(
 
         # Add filters
         if customer_name:
-            query += " AND LOWER(cu.customer_name) LIKE LOWER(:customer_name)"
+            query += " AND LOWER(ident.customer_name) LIKE LOWER(:customer_name)"
             params["customer_name"] = f"%{customer_name}%"
         if potion_sku:
             query += " AND LOWER(p.sku) LIKE LOWER(:potion_sku)"
@@ -246,48 +249,46 @@ def search_orders(
         params["limit"] = limit
         params["offset"] = offset
 
-        # Execute query
-        engine = db.get_engine()
-        with engine.begin() as conn:
-            results = list(
-                conn.execute(
-                    sqlalchemy.text(query),
-                    params
-                ).mappings().all()
-            )
-
-        # Format results
-        formatted_results = [
-            {
-                "line_item_id": row["line_item_id"],
-                "item_sku": row["item_sku"],
-                "customer_name": row["customer_name"],
-                "line_item_total": row["line_item_total"],
-                "timestamp": row["timestamp"].isoformat()
-            }
-            for row in results
-        ]
-
-        # Determine if there is a next page
+        # Count query determines if there is a next page
         total_items_query = f"""
             SELECT COUNT(*) FROM cart_items ci
             JOIN carts c ON ci.cart_id = c.cart_id
             JOIN customers cu ON c.customer_id = cu.customer_id
+            JOIN customer_identities ident ON cu.identity_id = ident.identity_id
             JOIN potions p ON ci.potion_id = p.potion_id
             WHERE c.checked_out = true
         """
         # Apply the same filters to count query
         if customer_name:
-            total_items_query += " AND LOWER(cu.customer_name) LIKE LOWER(:customer_name)"
+            total_items_query += " AND LOWER(ident.customer_name) LIKE LOWER(:customer_name)"
         if potion_sku:
             total_items_query += " AND LOWER(p.sku) LIKE LOWER(:potion_sku)"
 
-        engine = db.get_engine()
-        with engine.begin() as conn:
-            total_items = conn.execute(
+        # Page and count come from the same read-only snapshot, on the replica if healthy
+        def run_search(conn):
+            rows = conn.execute(
+                sqlalchemy.text(query),
+                params
+            ).mappings().all()
+            total = conn.execute(
                 sqlalchemy.text(total_items_query),
                 params
             ).scalar()
+            return list(rows), total
+
+        results, total_items = db.run_on_replica(run_search, "carts.search")
+
+        # Format results
+        formatted_results = [
+            {
+                "line_item_id": row["line_item_id"],
+                "item_sku": row["item_sku"],
+                "customer_name": row["customer_name"],
+                "line_item_total": row["line_item_total"],
+                "timestamp": row["timestamp"].isoformat()
+            }
+            for row in results
+        ]
 
         has_next = offset + limit < total_items
         has_previous = page_number > 0
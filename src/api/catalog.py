@@ -20,8 +20,7 @@ class CatalogItem(BaseModel):
 def get_catalog():
     """Get available potions for sale, maximum 6 items."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def build_catalog(conn):
             items = CatalogManager.get_available_potions(conn)
             
             if items:
@@ -42,6 +41,8 @@ def get_catalog():
                 )
                 for item in items
             ]
+
+        return db.run_on_replica(build_catalog, "catalog")
             
     except Exception as e:
         logger.error(f"Failed to generate catalog: {str(e)}")
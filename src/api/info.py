@@ -3,7 +3,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from src.api import auth
 from src import database as db
-from src.utilities import TimeManager
+from src.utilities import StrategyManager, TimeManager
 
 logger = logging.getLogger(__name__)
 
@@ -30,11 +30,16 @@ def post_time(timestamp: Timestamp):
                 detail="Invalid game time values"
             )
         
-        engine = db.get_engine()
-        with engine.begin() as conn:
-            TimeManager.record_time(conn, timestamp.day, timestamp.hour)
+        def record_time(conn):
+            transitioned = TimeManager.record_time(conn, timestamp.day, timestamp.hour)
             logger.info(f"Successfully recorded time - day: {timestamp.day}, hour: {timestamp.hour}")
-            return {"success": True}
+            return transitioned
+
+        if db.run_in_transaction(record_time, "info.current_time"):
+            # Publish only after commit so readers never cache an uncommitted strategy
+            StrategyManager.invalidate_cache()
+
+        return {"success": True}
             
     except HTTPException:
         raise
@@ -1,10 +1,11 @@
 import sqlalchemy
 import logging
+from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from src.api import auth
 from src import database as db
-from src.utilities import InventoryManager, TimeManager
+from src.utilities import InventoryManager, LedgerManager, OrderManager, StrategyManager, TimeManager
 
 logger = logging.getLogger(__name__)
 
@@ -22,8 +23,7 @@ class CapacityPurchase(BaseModel):
 def get_inventory():
     """Get current inventory state."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def read_inventory(conn):
             state = InventoryManager.get_inventory_state(conn)
             logger.debug(f"Retrieved inventory state - gold: {state['gold']}, "
                          f"total ml: {state['total_ml']}, "
@@ -34,6 +34,8 @@ def get_inventory():
                 "ml_in_barrels": state['total_ml'],
                 "gold": state['gold']
             }
+
+        return db.run_on_replica(read_inventory, "inventory.audit")
             
     except Exception as e:
         logger.error(f"Failed to get inventory state: {str(e)}")
@@ -42,12 +44,32 @@ def get_inventory():
             detail="Failed to get inventory"
         )
 
+@router.get("/state")
+def get_inventory_state_at(time_id: Optional[int] = None):
+    """
+    Get gold, ml per color, potions and capacity as of the end of the latest
+    tick at time_id, or of the current tick when time_id is omitted.
+    """
+    try:
+        def read_state(conn):
+            return LedgerManager.get_state_at(conn, time_id)
+
+        return db.run_on_replica(read_state, "inventory.state")
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to get inventory state at time {time_id}: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to get inventory state"
+        )
+
 @router.post("/plan")
 def get_capacity_plan():
     """Get capacity purchase plan. Called once per day."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def plan_capacity(conn):
             state = InventoryManager.get_inventory_state(conn)
             plan = InventoryManager.get_capacity_purchase_plan(conn, state)
             logger.debug(f"Generated capacity plan: {plan}")
@@ -56,6 +78,8 @@ def get_capacity_plan():
                 potion_capacity=plan['potion_capacity'],
                 ml_capacity=plan['ml_capacity']
             )
+
+        return db.run_read_only(plan_capacity, "inventory.plan")
             
     except Exception as e:
         logger.error(f"Failed to get capacity plan: {str(e)}")
@@ -68,8 +92,12 @@ def get_capacity_plan():
 def deliver_capacity_plan(capacity_purchase: CapacityPurchase, order_id: int):
     """Process capacity purchase delivery. Called once per day."""
     try:
-        engine = db.get_engine()
-        with engine.begin() as conn:
+        def deliver_capacity(conn):
+            # Replay stored response for a retried order
+            stored = OrderManager.claim_order(conn, "inventory.deliver", order_id)
+            if stored is not None:
+                return stored
+
             current_time = TimeManager.get_current_time(conn)
             
             logger.debug(
@@ -86,7 +114,15 @@ def deliver_capacity_plan(capacity_purchase: CapacityPurchase, order_id: int):
                 current_time['time_id']
             )
             
-            return {"success": True}
+            response = {"success": True}
+            OrderManager.complete_order(conn, "inventory.deliver", order_id, response)
+            return response
+
+        response = db.run_in_transaction(deliver_capacity, "inventory.deliver")
+
+        # An upgrade may have moved the strategy; publish only after commit
+        StrategyManager.invalidate_cache()
+        return response
             
     except HTTPException:
         raise
@@ -1,8 +1,34 @@
 import os
 import dotenv
+from pathlib import Path
 from sqlalchemy import create_engine
+from src.retry import RetryPolicy, default_retry_policy
+from src.replica import ReplicaRouter
 
 _engine = None
+_read_only_engine = None
+_replica_engine = None
+_replica_configured = False
+
+replica_router = ReplicaRouter(
+    max_lag_seconds=float(os.environ.get("REPLICA_MAX_LAG_SECONDS", "5"))
+)
+
+def get_worker_id() -> str:
+    """Gets pytest-xdist worker id, or 'main' when not running in parallel."""
+    return os.environ.get('PYTEST_XDIST_WORKER', 'main')
+
+def get_test_database_url() -> str:
+    """
+    Gets SQLite URL for the current test worker.
+    Uses a per-worker file when TEST_DB_DIR is set, otherwise a private in-memory database.
+    """
+    test_db_dir = os.environ.get('TEST_DB_DIR')
+    if test_db_dir:
+        db_dir = Path(test_db_dir)
+        db_dir.mkdir(parents=True, exist_ok=True)
+        return f"sqlite:///{db_dir / f'test_{get_worker_id()}.db'}"
+    return "sqlite:///:memory:"
 
 def get_engine():
     global _engine
@@ -10,9 +36,9 @@ def get_engine():
         testing = os.environ.get('TESTING') == 'true'
 
         if testing:
-            # Use SQLite test database
+            # Use SQLite test database isolated per worker
             _engine = create_engine(
-                "sqlite:///:memory:",
+                get_test_database_url(),
                 connect_args={"check_same_thread": False},
                 isolation_level="SERIALIZABLE",
                 pool_pre_ping=True
@@ -26,5 +52,98 @@ def get_engine():
                 isolation_level="READ COMMITTED",
                 pool_pre_ping=True
             )
-            
+
     return _engine
+
+def read_only_variant(engine):
+    """
+    Gets engine variant whose transactions are read-only snapshots.
+    On PostgreSQL these run at REPEATABLE READ with READ ONLY set, so they
+    take no row locks and never wait on writers. SQLite readers already
+    see a consistent snapshot, so the engine is used as-is.
+    """
+    if engine.dialect.name == 'postgresql':
+        return engine.execution_options(
+            isolation_level="REPEATABLE READ",
+            postgresql_readonly=True
+        )
+    return engine
+
+def get_read_only_engine():
+    """Gets read-only snapshot variant of the primary engine."""
+    global _read_only_engine
+    if _read_only_engine is None:
+        _read_only_engine = read_only_variant(get_engine())
+    return _read_only_engine
+
+def get_replica_engine():
+    """
+    Gets read-only engine for the read replica, or None when no replica is
+    configured. Uses TEST_REPLICA_URL under test, otherwise POSTGRES_REPLICA_URI.
+    """
+    global _replica_engine, _replica_configured
+    if not _replica_configured:
+        if os.environ.get('TESTING') == 'true':
+            replica_url = os.environ.get('TEST_REPLICA_URL')
+            connect_args = {"check_same_thread": False}
+        else:
+            dotenv.load_dotenv()
+            replica_url = os.environ.get('POSTGRES_REPLICA_URI')
+            connect_args = {}
+
+        if replica_url:
+            _replica_engine = read_only_variant(create_engine(
+                replica_url,
+                connect_args=connect_args,
+                pool_pre_ping=True
+            ))
+        _replica_configured = True
+
+    return _replica_engine
+
+def dispose_engine() -> None:
+    """Disposes the cached engine so the next get_engine call builds a new one."""
+    global _engine, _read_only_engine, _replica_engine, _replica_configured
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+    if _replica_engine is not None:
+        _replica_engine.dispose()
+        _replica_engine = None
+    _read_only_engine = None
+    _replica_configured = False
+    replica_router.reset()
+
+def run_in_transaction(work, operation: str = "transaction"):
+    """Runs work(conn) as one transaction unit under the shared retry policy."""
+    return default_retry_policy.run(get_engine(), work, operation)
+
+def run_read_only(work, operation: str = "read"):
+    """Runs work(conn) in a read-only snapshot transaction under the shared retry policy."""
+    return default_retry_policy.run(get_read_only_engine(), work, operation)
+
+def run_on_replica(work, operation: str = "replica_read"):
+    """
+    Runs read-only work(conn) on the read replica when it is configured and
+    within the lag threshold, otherwise as a read-only snapshot on the primary.
+    The engine is chosen again on every attempt, and a replica that drops its
+    connection is marked unhealthy so the retry falls back to the primary.
+    """
+    def choose_engine():
+        return replica_router.choose(get_read_only_engine(), get_replica_engine())
+
+    def on_retry(engine, kind):
+        if kind == RetryPolicy.DISCONNECT and engine is get_replica_engine():
+            replica_router.mark_unhealthy(f"connection dropped during {operation}")
+
+    return default_retry_policy.run(choose_engine, work, operation, on_retry)
+
+def stream_on_replica(work):
+    """
+    Yields from read-only work(conn) on the read replica when it is healthy,
+    otherwise in a read-only snapshot on the primary. Streams are not retried,
+    since rows already sent cannot be taken back.
+    """
+    engine = replica_router.choose(get_read_only_engine(), get_replica_engine())
+    with engine.connect() as conn:
+        yield from work(conn)
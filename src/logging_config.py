@@ -1,5 +1,6 @@
 from pathlib import Path
 import logging
+import os
 import shutil
 import sys
 from typing import Optional
@@ -20,10 +21,18 @@ class LoggingManager:
             self.production_format = "%(name)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s"
             self.test_format = "%(name)s - %(levelname)s - %(funcName)s:%(lineno)d - %(message)s"
             self.log_level = logging.DEBUG
-            self.test_logs_dir = Path(__file__).parent.parent / "test" / "test_logs"
+            self.test_logs_root = Path(__file__).parent.parent / "test" / "test_logs"
+            self.test_logs_dir = self.get_worker_logs_dir()
             self._initialized = True
             self.test_logs_dir.mkdir(parents=True, exist_ok=True)
 
+    def get_worker_logs_dir(self) -> Path:
+        """Get log directory for current test worker, separate per pytest-xdist worker"""
+        worker_id = os.environ.get('PYTEST_XDIST_WORKER')
+        if worker_id:
+            return self.test_logs_root / worker_id
+        return self.test_logs_root
+
     def setup_production_logging(self):
         """Configure logging for production environment"""
         # Clear any existing handlers
@@ -43,7 +52,7 @@ class LoggingManager:
     def setup_test_logging(self, test_name: str) -> logging.Logger:
         """Configure logging for test environment with proper file handling"""
         # Ensure test logs directory exists
-        self.test_logs_dir.mkdir(exist_ok=True)
+        self.test_logs_dir.mkdir(parents=True, exist_ok=True)
         
         # Create module-specific log file
         module_name = test_name.split('.')[-1] if '.' in test_name else test_name
@@ -79,10 +88,10 @@ class LoggingManager:
             logger.removeHandler(handler)
             
     def cleanup_test_directory(self):
-        """Clean up test logs directory between test runs"""
+        """Clean up this worker's test logs directory between test runs"""
         if self.test_logs_dir.exists():
-            shutil.rmtree(self.test_logs_dir)
-        self.test_logs_dir.mkdir(exist_ok=True)
+            shutil.rmtree(self.test_logs_dir, ignore_errors=True)
+        self.test_logs_dir.mkdir(parents=True, exist_ok=True)
 
 # Singleton instance
 logging_manager = LoggingManager()
\ No newline at end of file
@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+class ReplicaRouter:
+    """
+    Routes read-only work to a replica engine while its replication lag
+    stays under a threshold, falling back to the primary otherwise.
+    Lag is probed at most once per check interval and shared across threads.
+    """
+
+    # Replication status of the node; lag is derived from it in lag_from_status
+    POSTGRES_LAG_QUERY = """
+        SELECT
+            pg_is_in_recovery() as in_recovery,
+            EXISTS (
+                SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming'
+            ) as streaming,
+            pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() as caught_up,
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) as replay_age
+    """
+
+    def __init__(
+        self,
+        max_lag_seconds: float = 5.0,
+        check_interval: float = 1.0,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval = check_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._healthy = False
+        self._checked_at = None
+        self._last_lag = None
+        self._counters = {
+            'replica_reads': 0,
+            'primary_fallbacks': 0,
+            'lag_probe_failures': 0
+        }
+
+    @staticmethod
+    def lag_from_status(status: dict) -> float:
+        """
+        Returns replica lag in seconds from its replication status. A replica
+        that has replayed everything it received is only current while its
+        WAL receiver is streaming, since replay timestamps stop advancing while
+        the primary is idle; otherwise the replay timestamp's age is the lag.
+        A node that is not in recovery is not a replica and never current.
+        """
+        if not status['in_recovery']:
+            return float('inf')
+        if status['streaming'] and status['caught_up']:
+            return 0.0
+        if status['replay_age'] is None:
+            return float('inf')
+        return float(status['replay_age'])
+
+    def measure_lag(self, replica) -> float:
+        """Returns replica lag in seconds; SQLite replicas report no lag."""
+        if replica.dialect.name != 'postgresql':
+            return 0.0
+
+        with replica.connect() as conn:
+            return self.lag_from_status(conn.execute(
+                sqlalchemy.text(self.POSTGRES_LAG_QUERY)
+            ).mappings().one())
+
+    def replica_healthy(self, replica) -> bool:
+        """Checks replica lag against the threshold, reusing recent probes."""
+        now = self.clock()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return self._healthy
+
+        try:
+            lag = self.measure_lag(replica)
+            healthy = lag <= self.max_lag_seconds
+            if not healthy:
+                logger.warning(
+                    f"Replica lag {lag:.2f}s exceeds {self.max_lag_seconds}s, "
+                    f"routing reads to primary"
+                )
+        except Exception as e:
+            lag = None
+            healthy = False
+            self.increment('lag_probe_failures')
+            logger.warning(f"Replica lag probe failed, routing reads to primary: {str(e)}")
+
+        with self._lock:
+            self._healthy = healthy
+            self._checked_at = now
+            self._last_lag = lag
+
+        return healthy
+
+    def mark_unhealthy(self, reason: str) -> None:
+        """Routes reads to the primary until the next lag probe is due."""
+        logger.warning(f"Replica marked unhealthy, routing reads to primary: {reason}")
+        now = self.clock()
+        with self._lock:
+            self._healthy = False
+            self._checked_at = now
+
+    def choose(self, primary, replica: Optional[object]):
+        """Returns the engine to read from."""
+        if replica is not None and self.replica_healthy(replica):
+            self.increment('replica_reads')
+            return replica
+
+        if replica is not None:
+            self.increment('primary_fallbacks')
+        return primary
+
+    def increment(self, counter: str) -> None:
+        """Increments a routing counter."""
+        with self._lock:
+            self._counters[counter] += 1
+
+    def snapshot(self) -> Dict[str, object]:
+        """Returns routing counters and the last observed lag."""
+        with self._lock:
+            return {
+                **self._counters,
+                'replica_healthy': self._healthy,
+                'last_lag_seconds': self._last_lag,
+                'max_lag_seconds': self.max_lag_seconds
+            }
+
+    def reset(self) -> None:
+        """Clears counters and forces a fresh lag probe."""
+        with self._lock:
+            for name in self._counters:
+                self._counters[name] = 0
+            self._healthy = False
+            self._checked_at = None
+            self._last_lag = None
@@ -0,0 +1,165 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+class RetryMetrics:
+    """Thread-safe retry counters per operation."""
+
+    COUNTERS = (
+        'attempts',
+        'retries',
+        'serialization_failures',
+        'deadlocks',
+        'lock_timeouts',
+        'disconnects',
+        'exhausted',
+        'hard_failures'
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, int]] = {}
+
+    def increment(self, operation: str, counter: str, amount: int = 1) -> None:
+        """Increments a counter for an operation."""
+        with self._lock:
+            counters = self._counters.setdefault(
+                operation,
+                {name: 0 for name in self.COUNTERS}
+            )
+            counters[counter] += amount
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """Returns a copy of all counters, including totals across operations."""
+        with self._lock:
+            operations = {op: dict(c) for op, c in self._counters.items()}
+
+        totals = {name: 0 for name in self.COUNTERS}
+        for counters in operations.values():
+            for name, value in counters.items():
+                totals[name] += value
+
+        return {"totals": totals, "operations": operations}
+
+    def reset(self) -> None:
+        """Clears all counters."""
+        with self._lock:
+            self._counters.clear()
+
+class RetryPolicy:
+    """
+    Retries whole transaction units on transient database failures.
+    Serialization failures, deadlocks, lock timeouts and dropped connections
+    are retried with exponential backoff and full jitter. All other errors
+    are raised immediately.
+    """
+
+    SERIALIZATION_FAILURE = 'serialization_failures'
+    DEADLOCK = 'deadlocks'
+    LOCK_TIMEOUT = 'lock_timeouts'
+    DISCONNECT = 'disconnects'
+
+    # PostgreSQL SQLSTATE codes that are safe to retry
+    RETRYABLE_PGCODES = {
+        '40001': SERIALIZATION_FAILURE,
+        '40P01': DEADLOCK,
+        '55P03': LOCK_TIMEOUT
+    }
+
+    # SQLite reports lock contention only through the message
+    RETRYABLE_SQLITE_MESSAGES = (
+        'database is locked',
+        'database table is locked'
+    )
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 0.05,
+        max_delay: float = 2.0,
+        metrics: Optional[RetryMetrics] = None,
+        sleep: Callable[[float], None] = time.sleep
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics or RetryMetrics()
+        self.sleep = sleep
+
+    @classmethod
+    def classify_error(cls, error: BaseException) -> Optional[str]:
+        """Returns the retryable failure kind, or None for hard errors."""
+        if not isinstance(error, DBAPIError):
+            return None
+
+        if error.connection_invalidated:
+            return cls.DISCONNECT
+
+        pgcode = getattr(error.orig, 'pgcode', None)
+        if pgcode in cls.RETRYABLE_PGCODES:
+            return cls.RETRYABLE_PGCODES[pgcode]
+
+        message = str(error.orig).lower()
+        if any(m in message for m in cls.RETRYABLE_SQLITE_MESSAGES):
+            return cls.LOCK_TIMEOUT
+
+        return None
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given retry attempt."""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def run(
+        self,
+        engine,
+        work: Callable,
+        operation: str = "transaction",
+        on_retry: Optional[Callable[[object, str], None]] = None
+    ):
+        """
+        Runs work(conn) in a fresh transaction, retrying the whole unit on
+        transient failures. Returns the result of work. engine may be a
+        callable choosing the engine for each attempt; on_retry(engine, kind)
+        is called with the failed attempt's engine before each retry.
+        """
+        choose_engine = engine if callable(engine) else lambda: engine
+        for attempt in range(self.max_attempts):
+            self.metrics.increment(operation, 'attempts')
+            attempt_engine = choose_engine()
+            try:
+                with attempt_engine.begin() as conn:
+                    return work(conn)
+            except Exception as e:
+                kind = self.classify_error(e)
+                if kind is None:
+                    if isinstance(e, DBAPIError):
+                        self.metrics.increment(operation, 'hard_failures')
+                    raise
+
+                self.metrics.increment(operation, kind)
+                if attempt == self.max_attempts - 1:
+                    self.metrics.increment(operation, 'exhausted')
+                    logger.error(
+                        f"All {self.max_attempts} attempts failed for {operation}: {str(e)}"
+                    )
+                    raise
+
+                delay = self.backoff_delay(attempt)
+                self.metrics.increment(operation, 'retries')
+                logger.warning(
+                    f"Retry {attempt + 1}/{self.max_attempts - 1} for {operation} "
+                    f"after {kind} in {delay:.3f}s: {str(e)}"
+                )
+                if on_retry is not None:
+                    on_retry(attempt_engine, kind)
+                self.sleep(delay)
+
+# Shared policy for all endpoints
+retry_metrics = RetryMetrics()
+default_retry_policy = RetryPolicy(metrics=retry_metrics)
@@ -1,43 +1,354 @@
+import csv
+import hashlib
+import io
 import json
+import os
 import sqlalchemy
 import logging
+import threading
 import time
-from sqlalchemy.exc import OperationalError
+import weakref
+import zlib
 from fastapi import HTTPException
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional
 
 logger = logging.getLogger(__name__)
 
+class RequestContext:
+    """
+    Request-scoped cache of current time, active strategy and state.
+    Each value is loaded at most once per transaction, on first use.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._current_time = None
+        self._strategy = None
+        self._state = None
+
+    @property
+    def current_time(self) -> dict:
+        """Gets current time_id, day, and hour."""
+        if self._current_time is None:
+            self._current_time = TimeManager.get_current_time(self.conn)
+        return self._current_time
+
+    @property
+    def time_id(self) -> int:
+        """Gets current time_id."""
+        return self.current_time['time_id']
+
+    @property
+    def strategy(self) -> dict:
+        """Gets active strategy id, name and per-SKU limit."""
+        if self._strategy is None:
+            self._strategy = StrategyManager.get_active_strategy(self.conn)
+        return self._strategy
+
+    @property
+    def state(self) -> dict:
+        """Gets current ledger state."""
+        if self._state is None:
+            self._state = dict(self.conn.execute(
+                sqlalchemy.text("SELECT * FROM current_state")
+            ).mappings().one())
+        return self._state
+
+    def invalidate(self) -> None:
+        """Drops cached state and strategy after writes that change them."""
+        self._strategy = None
+        self._state = None
+
+class StrategyManager:
+    """Handles active strategy lookup and activation."""
+
+    # Upper bound on staleness when another process activates a strategy
+    CACHE_TTL = 5.0
+
+    _cache = None
+    _cache_loaded_at = 0.0
+    _cache_generation = 0
+    _cache_lock = threading.Lock()
+
+    # Transactions that activated a strategy read the pointer directly until they commit
+    _activating = weakref.WeakSet()
+
+    @classmethod
+    def get_active_strategy(cls, conn) -> dict:
+        """Gets active strategy from in-process cache or the current_strategy pointer."""
+        with cls._cache_lock:
+            activating = conn.get_transaction() in cls._activating
+            if (not activating and cls._cache is not None and
+                time.monotonic() - cls._cache_loaded_at < cls.CACHE_TTL):
+                return dict(cls._cache)
+            generation = cls._cache_generation
+
+        strategy = dict(conn.execute(
+            sqlalchemy.text("""
+                SELECT 
+                    s.strategy_id,
+                    s.name as strategy_name,
+                    s.max_potions_per_sku
+                FROM current_strategy cs
+                JOIN strategies s ON cs.strategy_id = s.strategy_id
+            """)
+        ).mappings().one())
+
+        # Skip caching uncommitted activations and reads that raced an invalidation
+        with cls._cache_lock:
+            if not activating and cls._cache_generation == generation:
+                cls._cache = strategy
+                cls._cache_loaded_at = time.monotonic()
+
+        return dict(strategy)
+
+    @classmethod
+    def invalidate_cache(cls) -> None:
+        """Drops cached active strategy."""
+        with cls._cache_lock:
+            cls._cache = None
+            cls._cache_generation += 1
+
+    @classmethod
+    def activate_strategy(
+        cls,
+        conn,
+        strategy_id: int,
+        time_id: int,
+        tick_id: Optional[int] = None
+    ) -> None:
+        """
+        Records strategy activation at a tick; trigger moves the current_strategy
+        pointer. Callers publish it with invalidate_cache() once the transaction
+        commits.
+        """
+        conn.execute(
+            sqlalchemy.text("""
+                INSERT INTO active_strategy (
+                    strategy_id,
+                    game_time_id,
+                    tick_id
+                ) VALUES (
+                    :strategy_id,
+                    :time_id,
+                    :tick_id
+                )
+            """),
+            {
+                "strategy_id": strategy_id,
+                "time_id": time_id,
+                "tick_id": tick_id
+            }
+        )
+        with cls._cache_lock:
+            cls._activating.add(conn.get_transaction())
+
+class TransitionEngine:
+    """
+    Evaluates strategy_transitions rules against ledger balances.
+    Rules are loaded into memory once; balances come from the ledger_balances
+    row refreshed each tick, so no transition check aggregates the ledger.
+    """
+
+    BALANCE_THRESHOLDS = (
+        ('gold_threshold', 'gold'),
+        ('potion_threshold', 'total_potions'),
+        ('ml_threshold', 'total_ml')
+    )
+
+    _rules = None
+    _rules_lock = threading.Lock()
+
+    @classmethod
+    def get_rules(cls, conn) -> Dict[int, dict]:
+        """Gets transition rules keyed by from_strategy_id, loading them on first use."""
+        with cls._rules_lock:
+            if cls._rules is not None:
+                return cls._rules
+
+        rows = conn.execute(
+            sqlalchemy.text("""
+                SELECT 
+                    from_strategy_id,
+                    to_strategy_id,
+                    gold_threshold,
+                    potion_threshold,
+                    ml_threshold,
+                    ml_capacity_threshold,
+                    potion_capacity_threshold,
+                    require_all_thresholds
+                FROM strategy_transitions
+            """)
+        ).mappings().all()
+
+        rules = {row['from_strategy_id']: dict(row) for row in rows}
+        with cls._rules_lock:
+            cls._rules = rules
+
+        return rules
+
+    @classmethod
+    def invalidate_rules(cls) -> None:
+        """Drops loaded transition rules."""
+        with cls._rules_lock:
+            cls._rules = None
+
+    @classmethod
+    def rule_met(cls, rule: dict, balances: dict) -> bool:
+        """
+        Checks a transition rule against balances. Capacity thresholds must
+        always be met; gold, potion and ml thresholds that are set must all
+        be met when require_all_thresholds, otherwise any one of them.
+        """
+        if (balances['ml_capacity_units'] < rule['ml_capacity_threshold'] or
+            balances['potion_capacity_units'] < rule['potion_capacity_threshold']):
+            return False
+
+        checks = [
+            balances[balance] >= rule[threshold]
+            for threshold, balance in cls.BALANCE_THRESHOLDS
+            if rule[threshold] is not None
+        ]
+        if not checks:
+            return True
+
+        return all(checks) if rule['require_all_thresholds'] else any(checks)
+
+    @classmethod
+    def evaluate(
+        cls,
+        conn,
+        time_id: int,
+        balances: Optional[dict] = None,
+        tick_id: Optional[int] = None
+    ) -> Optional[int]:
+        """
+        Fires the active strategy's transition if its thresholds are met by
+        balances, by default those of the latest tick. At most one strategy
+        change happens per tick, defaulting to the latest one. Returns new
+        strategy_id or None.
+        """
+        if tick_id is None:
+            tick_id = conn.execute(
+                sqlalchemy.text("SELECT MAX(id) FROM current_game_time")
+            ).scalar()
+
+        current = conn.execute(
+            sqlalchemy.text("""
+                SELECT strategy_id, tick_id
+                FROM current_strategy
+                FOR UPDATE
+            """)
+        ).mappings().one()
+
+        # Ticks, not game_time ids, which repeat every week
+        if current['tick_id'] == tick_id:
+            logger.debug(f"Strategy already changed at tick {tick_id}")
+            return None
+
+        rule = cls.get_rules(conn).get(current['strategy_id'])
+        if rule is None:
+            return None
+
+        if not cls.rule_met(rule, balances or LedgerManager.get_balances(conn)):
+            return None
+
+        StrategyManager.activate_strategy(conn, rule['to_strategy_id'], time_id, tick_id)
+        logger.info(
+            f"Transitioned strategy {rule['from_strategy_id']} -> "
+            f"{rule['to_strategy_id']} at time_id {time_id}"
+        )
+        return rule['to_strategy_id']
+
 class LedgerManager:
     """Handles ledger operations."""
 
-    MAX_RETRIES = 3
-    RETRY_DELAY = 0.1
+    EMPTY_BALANCES = {
+        'gold': 0,
+        'total_potions': 0,
+        'total_ml': 0,
+        'ml_capacity_units': 0,
+        'potion_capacity_units': 0
+    }
+
+    # Epoch-partitioned ledger tables: entry headers and their typed streams
+    LEDGER_TABLES = (
+        'ledger_transactions', 'ledger_gold', 'ledger_ml', 'ledger_potions', 'ledger_capacity'
+    )
+
+    # Closing balances carried by each sealed epoch's checkpoint
+    CHECKPOINT_BALANCES = (
+        'gold', 'red_ml', 'green_ml', 'blue_ml', 'dark_ml',
+        'total_potions', 'potion_capacity_units', 'ml_capacity_units'
+    )
 
     @staticmethod
-    def with_retry(func):
-        """Decorator to retry database operations on failure."""
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(LedgerManager.MAX_RETRIES):
-                try:
-                    return func(*args, **kwargs)
-                except OperationalError as e:
-                    last_error = e
-                    if attempt < LedgerManager.MAX_RETRIES - 1:
-                        logger.warning(
-                            f"Retry {attempt + 1}/{LedgerManager.MAX_RETRIES} "
-                            f"for admin operation: {str(e)}"
-                        )
-                        time.sleep(LedgerManager.RETRY_DELAY)
-                        continue
-                    logger.error(f"All retries failed: {str(last_error)}")
-                    raise
-            return None
-        return wrapper
-    
+    def get_balances(conn) -> dict:
+        """Gets ledger totals as of the latest tick from ledger_balances."""
+        result = conn.execute(
+            sqlalchemy.text("""
+                SELECT 
+                    gold,
+                    total_potions,
+                    total_ml,
+                    ml_capacity_units,
+                    potion_capacity_units
+                FROM ledger_balances
+            """)
+        ).mappings().first()
+        return dict(result) if result else dict(LedgerManager.EMPTY_BALANCES)
+
+    @classmethod
+    def refresh_balances(cls, conn) -> dict:
+        """
+        Sets ledger_balances to the ledger's current totals. Runs once per tick
+        instead of on every ledger write. Returns current_state.
+        """
+        state = dict(conn.execute(
+            sqlalchemy.text("SELECT * FROM current_state")
+        ).mappings().one())
+
+        conn.execute(
+            sqlalchemy.text(f"""
+                INSERT INTO ledger_balances (singleton, {", ".join(cls.EMPTY_BALANCES)})
+                VALUES (true, {", ".join(f":{balance}" for balance in cls.EMPTY_BALANCES)})
+                ON CONFLICT (singleton) DO UPDATE SET
+                    {", ".join(f"{balance} = EXCLUDED.{balance}" for balance in cls.EMPTY_BALANCES)}
+            """),
+            {balance: state[balance] for balance in cls.EMPTY_BALANCES}
+        )
+        return state
+
+    @staticmethod
+    def lock_ledger(conn, exclusive: bool = False) -> None:
+        """
+        Takes the ledger advisory lock until commit on PostgreSQL. Writers hold
+        it shared from their first entry; sealing and snapshots take it
+        exclusive to wait for in-flight writers. SQLite writers are serialized.
+        """
+        if conn.dialect.name != 'postgresql':
+            return
+
+        lock = "pg_advisory_xact_lock" if exclusive else "pg_advisory_xact_lock_shared"
+        conn.execute(sqlalchemy.text(f"SELECT {lock}(hashtext('ledger_epoch'))"))
+
+    @classmethod
+    def lock_state(cls, conn) -> dict:
+        """
+        Locks the balances row so gold and ml spenders check funds one at a
+        time, then reads live totals from current_state. Sales only add gold
+        and never take this lock. The ledger lock is taken first, as ledger
+        writes and ticks take it before the balances row.
+        """
+        cls.lock_ledger(conn)
+        conn.execute(
+            sqlalchemy.text("SELECT epoch_id FROM ledger_balances FOR UPDATE")
+        )
+        return dict(conn.execute(
+            sqlalchemy.text("SELECT * FROM current_state")
+        ).mappings().one())
+
     @classmethod
-    @with_retry
     def create_admin_entry(cls, conn, time_id: int) -> None:
         """Creates admin reset ledger entry with initial values."""
         conn.execute(
@@ -60,6 +371,407 @@ class LedgerManager:
         )
         logger.info("Created admin reset ledger entry with initial values")
 
+    @staticmethod
+    def get_open_epoch(conn) -> int:
+        """Gets ledger epoch that new entries are written to."""
+        epoch_id = conn.execute(
+            sqlalchemy.text("SELECT epoch_id FROM ledger_balances")
+        ).scalar()
+        return epoch_id or 1
+
+    @staticmethod
+    def get_reset_generation(conn) -> int:
+        """Gets the number of admin resets the ledger has been through."""
+        generation = conn.execute(
+            sqlalchemy.text("SELECT reset_generation FROM ledger_balances")
+        ).scalar()
+        return generation or 0
+
+    @staticmethod
+    def record_reset(conn) -> None:
+        """Bumps the reset generation after an admin reset truncates history."""
+        conn.execute(sqlalchemy.text(
+            "UPDATE ledger_balances SET reset_generation = reset_generation + 1"
+        ))
+
+    @staticmethod
+    def get_checkpoint(conn, epoch_id: Optional[int] = None) -> Optional[dict]:
+        """Gets a sealed epoch's checkpoint, or the latest one when epoch_id is None."""
+        result = conn.execute(
+            sqlalchemy.text("""
+                SELECT *
+                FROM ledger_checkpoints
+                WHERE epoch_id = COALESCE(
+                    :epoch_id,
+                    (SELECT MAX(epoch_id) FROM ledger_checkpoints)
+                )
+            """),
+            {"epoch_id": epoch_id}
+        ).mappings().first()
+
+        return dict(result) if result else None
+
+    @staticmethod
+    def sum_entries(
+        conn,
+        epoch_id: int,
+        from_time_id: Optional[int] = None,
+        to_time_id: Optional[int] = None,
+        after_entry_id: Optional[int] = None
+    ) -> dict:
+        """
+        Sums an epoch's entries into checkpoint balances, optionally within a
+        time_id range or past an entry id. Each balance reads only its own
+        typed stream.
+        """
+        window = """
+            epoch_id = :epoch_id
+            AND (:from_time_id IS NULL OR time_id >= :from_time_id)
+            AND (:to_time_id IS NULL OR time_id <= :to_time_id)
+            AND (:after_entry_id IS NULL OR entry_id > :after_entry_id)
+        """
+        ml_by_color = ",\n".join(
+            f"""
+                (SELECT COALESCE(SUM(ml_change), 0) FROM ledger_ml WHERE {window}
+                    AND color_id = (SELECT color_id FROM color_definitions WHERE color_name = '{color}')
+                ) as {color.lower()}_ml"""
+            for color in ('RED', 'GREEN', 'BLUE', 'DARK')
+        )
+
+        return dict(conn.execute(
+            sqlalchemy.text(f"""
+                SELECT
+                    (SELECT COUNT(*) FROM ledger_transactions WHERE {window}) as entry_count,
+                    (SELECT COALESCE(SUM(gold_change), 0) FROM ledger_gold WHERE {window}) as gold,
+                    {ml_by_color},
+                    (SELECT COALESCE(SUM(potion_change), 0) FROM ledger_potions WHERE {window}) as total_potions,
+                    (SELECT COALESCE(SUM(potion_capacity_change), 0) FROM ledger_capacity WHERE {window}) as potion_capacity_units,
+                    (SELECT COALESCE(SUM(ml_capacity_change), 0) FROM ledger_capacity WHERE {window}) as ml_capacity_units
+            """),
+            {
+                "epoch_id": epoch_id,
+                "from_time_id": from_time_id,
+                "to_time_id": to_time_id,
+                "after_entry_id": after_entry_id
+            }
+        ).mappings().one())
+
+    @classmethod
+    def create_partitions(cls, conn, epoch_id: int) -> None:
+        """
+        Creates an epoch's partition of every ledger table on PostgreSQL if it
+        is missing. Tables are attached after creation, which only takes a
+        SHARE UPDATE EXCLUSIVE lock on the parent and so never blocks ledger
+        reads or writes.
+        """
+        if conn.dialect.name != 'postgresql':
+            return
+
+        for table in cls.LEDGER_TABLES:
+            partition = f"{table}_e{epoch_id}"
+            exists = conn.execute(
+                sqlalchemy.text("SELECT to_regclass(:partition) IS NOT NULL"),
+                {"partition": partition}
+            ).scalar_one()
+            if exists:
+                continue
+
+            conn.execute(sqlalchemy.text(f"""
+                CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+            """))
+            conn.execute(sqlalchemy.text(f"""
+                ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES IN ({epoch_id})
+            """))
+
+    @classmethod
+    def seal_epoch(cls, conn, time_id: int) -> Optional[dict]:
+        """
+        Seals the open ledger epoch into a checkpoint of closing balances and
+        opens the next one, so balance reads only sum entries written since.
+        Returns the checkpoint, or None when the open epoch has no entries.
+        """
+        epoch_id = cls.get_open_epoch(conn)
+
+        # Create the next partitions, then wait for in-flight ledger writers
+        cls.create_partitions(conn, epoch_id + 1)
+        cls.lock_ledger(conn, exclusive=True)
+        locked_epoch = cls.get_open_epoch(conn)
+
+        if locked_epoch != epoch_id:
+            logger.info(f"Ledger epoch {epoch_id} already sealed")
+            return None
+
+        totals = cls.sum_entries(conn, epoch_id)
+        if totals['entry_count'] == 0:
+            return None
+
+        previous = cls.get_checkpoint(conn)
+        checkpoint = {
+            "epoch_id": epoch_id,
+            "sealed_time_id": time_id,
+            "entry_count": totals['entry_count'],
+            **{
+                balance: totals[balance] + (previous[balance] if previous else 0)
+                for balance in cls.CHECKPOINT_BALANCES
+            }
+        }
+
+        conn.execute(
+            sqlalchemy.text(f"""
+                INSERT INTO ledger_checkpoints (
+                    epoch_id, sealed_time_id, entry_count, {", ".join(cls.CHECKPOINT_BALANCES)}
+                ) VALUES (
+                    :epoch_id, :sealed_time_id, :entry_count,
+                    {", ".join(f":{balance}" for balance in cls.CHECKPOINT_BALANCES)}
+                )
+            """),
+            checkpoint
+        )
+        conn.execute(
+            sqlalchemy.text("UPDATE ledger_balances SET epoch_id = :next_epoch"),
+            {"next_epoch": epoch_id + 1}
+        )
+
+        logger.info(f"Sealed ledger epoch {epoch_id} with {totals['entry_count']} entries")
+        return checkpoint
+
+    @classmethod
+    def archive_epoch(cls, conn, epoch_id: int) -> str:
+        """
+        Moves a sealed epoch's entries out of the live ledger and returns the
+        prefix of the archive tables holding them, one per ledger table.
+        PostgreSQL detaches the epoch's partitions; other databases copy the
+        rows to archive tables and delete them.
+        """
+        checkpoint = cls.get_checkpoint(conn, epoch_id)
+        if checkpoint is None:
+            raise HTTPException(status_code=400, detail="Only sealed ledger epochs can be archived")
+        if checkpoint['archive_prefix']:
+            return checkpoint['archive_prefix']
+
+        archive_prefix = f"ledger_archive_e{epoch_id}_{int(time.time())}"
+
+        for table in cls.LEDGER_TABLES:
+            archive_table = f"{archive_prefix}_{table.removeprefix('ledger_')}"
+            if conn.dialect.name == 'postgresql':
+                conn.execute(sqlalchemy.text(f"""
+                    ALTER TABLE {table} DETACH PARTITION {table}_e{epoch_id}
+                """))
+                conn.execute(sqlalchemy.text(f"""
+                    ALTER TABLE {table}_e{epoch_id} RENAME TO {archive_table}
+                """))
+            else:
+                conn.execute(
+                    sqlalchemy.text(f"""
+                        CREATE TABLE {archive_table} AS
+                        SELECT * FROM {table} WHERE epoch_id = :epoch_id
+                    """),
+                    {"epoch_id": epoch_id}
+                )
+                conn.execute(
+                    sqlalchemy.text(f"DELETE FROM {table} WHERE epoch_id = :epoch_id"),
+                    {"epoch_id": epoch_id}
+                )
+
+        conn.execute(
+            sqlalchemy.text("""
+                UPDATE ledger_checkpoints
+                SET archive_prefix = :archive_prefix
+                WHERE epoch_id = :epoch_id
+            """),
+            {"archive_prefix": archive_prefix, "epoch_id": epoch_id}
+        )
+
+        logger.info(f"Archived ledger epoch {epoch_id} to {archive_prefix}_*")
+        return archive_prefix
+
+    @classmethod
+    def record_snapshot(cls, conn, tick_id: int, time_id: int) -> dict:
+        """
+        Records balances as the clock advances to a tick and refreshes
+        ledger_balances from them. The ledger lock is taken exclusive first,
+        so writes still in flight from the previous tick are part of the
+        snapshot and every later entry has a higher entry id.
+        """
+        cls.lock_ledger(conn, exclusive=True)
+
+        state = cls.refresh_balances(conn)
+        through_entry_id = conn.execute(
+            sqlalchemy.text("SELECT COALESCE(MAX(entry_id), 0) FROM ledger_transactions")
+        ).scalar_one()
+
+        snapshot = {
+            "tick_id": tick_id,
+            "time_id": time_id,
+            "epoch_id": cls.get_open_epoch(conn),
+            "through_entry_id": through_entry_id,
+            **{balance: state[balance] for balance in cls.CHECKPOINT_BALANCES}
+        }
+        conn.execute(
+            sqlalchemy.text(f"""
+                INSERT INTO ledger_snapshots (
+                    tick_id, time_id, epoch_id, through_entry_id, {", ".join(cls.CHECKPOINT_BALANCES)}
+                ) VALUES (
+                    :tick_id, :time_id, :epoch_id, :through_entry_id,
+                    {", ".join(f":{balance}" for balance in cls.CHECKPOINT_BALANCES)}
+                )
+            """),
+            snapshot
+        )
+        return snapshot
+
+    @classmethod
+    def get_state_at(cls, conn, time_id: Optional[int] = None) -> dict:
+        """
+        Gets balances as of the end of the latest tick at time_id, or of the
+        current tick when time_id is None. Past ticks are served by the snapshot
+        taken when the clock left them; the current tick replays the entries
+        written after the nearest earlier snapshot's last entry id, starting
+        from the latest checkpoint instead when an epoch was sealed since.
+        """
+        tick = conn.execute(
+            sqlalchemy.text("""
+                SELECT
+                    cgt.id as tick_id,
+                    gt.time_id,
+                    gt.in_game_day as day,
+                    gt.in_game_hour as hour
+                FROM current_game_time cgt
+                JOIN game_time gt ON cgt.game_time_id = gt.time_id
+                WHERE gt.time_id = COALESCE(:time_id, gt.time_id)
+                ORDER BY cgt.id DESC
+                LIMIT 1
+            """),
+            {"time_id": time_id}
+        ).mappings().first()
+
+        if not tick:
+            raise HTTPException(status_code=404, detail="No tick recorded at that time")
+
+        following = conn.execute(
+            sqlalchemy.text("""
+                SELECT *
+                FROM ledger_snapshots
+                WHERE tick_id > :tick_id
+                ORDER BY tick_id
+                LIMIT 1
+            """),
+            {"tick_id": tick['tick_id']}
+        ).mappings().first()
+
+        if following:
+            balances = {balance: following[balance] for balance in cls.CHECKPOINT_BALANCES}
+            source, replayed = "snapshot", 0
+        else:
+            base = conn.execute(
+                sqlalchemy.text("""
+                    SELECT *
+                    FROM ledger_snapshots
+                    WHERE tick_id <= :tick_id
+                    ORDER BY tick_id DESC
+                    LIMIT 1
+                """),
+                {"tick_id": tick['tick_id']}
+            ).mappings().first()
+
+            if not base:
+                raise HTTPException(status_code=404, detail="No balance snapshot at or before that time")
+
+            checkpoint = cls.get_checkpoint(conn)
+            if checkpoint and checkpoint['epoch_id'] >= base['epoch_id']:
+                balances = {balance: checkpoint[balance] for balance in cls.CHECKPOINT_BALANCES}
+                first_epoch, after_entry_id = checkpoint['epoch_id'] + 1, None
+            else:
+                balances = {balance: base[balance] for balance in cls.CHECKPOINT_BALANCES}
+                first_epoch, after_entry_id = base['epoch_id'], base['through_entry_id']
+
+            replayed = 0
+            for epoch_id in range(first_epoch, cls.get_open_epoch(conn) + 1):
+                totals = cls.sum_entries(conn, epoch_id, after_entry_id=after_entry_id)
+                for balance in cls.CHECKPOINT_BALANCES:
+                    balances[balance] += totals[balance]
+                replayed += totals['entry_count']
+            source = "replay"
+
+        return {
+            **dict(tick),
+            **balances,
+            "total_ml": sum(balances[color] for color in ('red_ml', 'green_ml', 'blue_ml', 'dark_ml')),
+            "max_potions": balances['potion_capacity_units'] * 50,
+            "max_ml": balances['ml_capacity_units'] * 10000,
+            "source": source,
+            "replayed_entries": replayed
+        }
+
+class OrderManager:
+    """Handles order_id idempotency for delivery endpoints."""
+
+    @staticmethod
+    def get_processed_response(conn, endpoint: str, order_id: int) -> Optional[dict]:
+        """Gets stored response for a processed order, or None."""
+        response = conn.execute(
+            sqlalchemy.text("""
+                SELECT response
+                FROM processed_orders
+                WHERE endpoint = :endpoint
+                AND order_id = :order_id
+            """),
+            {"endpoint": endpoint, "order_id": order_id}
+        ).scalar_one_or_none()
+
+        if response is None:
+            return None
+        return json.loads(response) if isinstance(response, str) else response
+
+    @classmethod
+    def claim_order(cls, conn, endpoint: str, order_id: int) -> Optional[dict]:
+        """
+        Claims an order for processing. Returns the stored response when the
+        order was already processed, otherwise None once claimed. A concurrent
+        delivery of the same order waits on the claim row.
+        """
+        stored = cls.get_processed_response(conn, endpoint, order_id)
+        if stored is not None:
+            logger.info(f"Order {order_id} for {endpoint} already processed, replaying response")
+            return stored
+
+        claimed = conn.execute(
+            sqlalchemy.text("""
+                INSERT INTO processed_orders (endpoint, order_id)
+                VALUES (:endpoint, :order_id)
+                ON CONFLICT DO NOTHING
+                RETURNING order_id
+            """),
+            {"endpoint": endpoint, "order_id": order_id}
+        ).first()
+
+        if claimed is None:
+            stored = cls.get_processed_response(conn, endpoint, order_id)
+            if stored is not None:
+                return stored
+            raise HTTPException(status_code=409, detail="Order already in progress")
+
+        return None
+
+    @staticmethod
+    def complete_order(conn, endpoint: str, order_id: int, response: dict) -> None:
+        """Stores response for a claimed order."""
+        conn.execute(
+            sqlalchemy.text("""
+                UPDATE processed_orders
+                SET 
+                    response = :response,
+                    processed_at = CURRENT_TIMESTAMP
+                WHERE endpoint = :endpoint
+                AND order_id = :order_id
+            """),
+            {
+                "endpoint": endpoint,
+                "order_id": order_id,
+                "response": json.dumps(response)
+            }
+        )
+
 class TimeManager:
     """Handles game time and strategy transitions."""
     
@@ -67,30 +779,20 @@ class TimeManager:
         'Hearthday', 'Crownday', 'Blesseday', 'Soulday',
         'Edgeday', 'Bloomday', 'Arcanaday'
     }
-    MAX_RETRIES = 3
-    RETRY_DELAY = 0.1
 
-    @staticmethod
-    def with_retry(func):
-        """Decorator to retry database operations on failure."""
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(TimeManager.MAX_RETRIES):
-                try:
-                    return func(*args, **kwargs)
-                except OperationalError as e:
-                    last_error = e
-                    if attempt < TimeManager.MAX_RETRIES - 1:
-                        logger.warning(
-                            f"Retry {attempt + 1}/{TimeManager.MAX_RETRIES} "
-                            f"for time recording: {str(e)}"
-                        )
-                        time.sleep(TimeManager.RETRY_DELAY)
-                        continue
-                    logger.error(f"All retries failed: {str(last_error)}")
-                    raise
-            return None
-        return wrapper
+    # First tick of a game week, when the open ledger epoch is sealed
+    WEEK_START = ('Hearthday', 0)
+
+    @classmethod
+    def starts_week(cls, previous_time_id: Optional[int], time_id: int, day: str, hour: int) -> bool:
+        """
+        Checks if a tick opens a new game week. game_time ids count up through
+        the week, so the clock wrapping below the previous tick's id crossed the
+        week start even if that tick was skipped. A repeated tick does not.
+        """
+        if previous_time_id is None:
+            return (day, hour) == cls.WEEK_START
+        return time_id < previous_time_id
 
     @staticmethod
     def get_current_time(conn) -> dict:
@@ -125,11 +827,11 @@ class TimeManager:
         return True
 
     @classmethod
-    @with_retry
     def record_time(cls, conn, day: str, hour: int) -> bool:
         """
-        Records current game time and processes strategy transitions.
-        Returns True if strategy transition occurred.
+        Records current game time, seals the ledger epoch when the clock
+        crosses into a new game week, snapshots balances and processes
+        strategy transitions. Returns True if strategy transition occurred.
         """
         # Get time_id for new time
         time_id = conn.execute(
@@ -141,9 +843,18 @@ class TimeManager:
             """),
             {"day": day, "hour": hour}
         ).scalar_one()
+
+        previous_time_id = conn.execute(
+            sqlalchemy.text("""
+                SELECT game_time_id
+                FROM current_game_time
+                ORDER BY id DESC
+                LIMIT 1
+            """)
+        ).scalar()
         
         # Record new time
-        conn.execute(
+        tick_id = conn.execute(
             sqlalchemy.text("""
                 INSERT INTO current_game_time (
                     game_time_id,
@@ -154,90 +865,20 @@ class TimeManager:
                     :day,
                     :hour
                 )
+                RETURNING id
             """),
             {
                 "time_id": time_id,
                 "day": day,
                 "hour": hour
             }
-        )
+        ).scalar_one()
 
-        # Get current strategy with lock
-        current_strategy = conn.execute(
-            sqlalchemy.text("""
-                SELECT s.name as strategy_name, s.strategy_id
-                FROM active_strategy ast
-                JOIN strategies s ON ast.strategy_id = s.strategy_id
-                ORDER BY ast.activated_at DESC
-                LIMIT 1
-                FOR UPDATE
-            """)
-        ).mappings().one()
-        
-        # Only check for transition if still in PREMIUM
-        if current_strategy['strategy_name'] == 'PREMIUM':
-            state = conn.execute(
-                sqlalchemy.text("""
-                    SELECT * 
-                    FROM current_state
-                    FOR UPDATE
-                """)
-            ).mappings().one()
-            
-            # Check if transition needed
-            should_transition = conn.execute(
-                sqlalchemy.text("""
-                    WITH transition_check AS (
-                        SELECT 
-                            st.to_strategy_id,
-                            CASE 
-                                WHEN :gold >= st.gold_threshold THEN true
-                                WHEN :total_potions >= st.potion_threshold THEN true
-                                WHEN :total_ml >= st.ml_threshold THEN true
-                                ELSE false
-                            END as should_transition
-                        FROM active_strategy ast
-                        JOIN strategies s ON ast.strategy_id = s.strategy_id
-                        JOIN strategy_transitions st ON ast.strategy_id = st.from_strategy_id
-                        WHERE s.name = 'PREMIUM'
-                        ORDER BY ast.activated_at DESC
-                        LIMIT 1
-                    )
-                    SELECT to_strategy_id, should_transition
-                    FROM transition_check
-                    WHERE should_transition = true
-                """),
-                {
-                    "gold": state['gold'],
-                    "total_potions": state['total_potions'],
-                    "total_ml": state['total_ml']
-                }
-            ).mappings().first()
+        if cls.starts_week(previous_time_id, time_id, day, hour):
+            LedgerManager.seal_epoch(conn, time_id)
+        LedgerManager.record_snapshot(conn, tick_id, time_id)
 
-            if should_transition:
-                new_strategy_id = should_transition['to_strategy_id']
-                
-                # Just record new strategy, no ledger entry needed
-                conn.execute(
-                    sqlalchemy.text("""
-                        INSERT INTO active_strategy (
-                            strategy_id,
-                            game_time_id
-                        ) VALUES (
-                            :strategy_id,
-                            :time_id
-                        )
-                    """),
-                    {
-                        "strategy_id": new_strategy_id,
-                        "time_id": time_id
-                    }
-                )
-                
-                logger.info(f"Successfully transitioned from PREMIUM to PENETRATION")
-                return True
-                
-        return False
+        return TransitionEngine.evaluate(conn, time_id, tick_id=tick_id) is not None
 
 class CatalogManager:
     """Handles catalog creation and potion availability."""
@@ -255,10 +896,7 @@ class CatalogManager:
                     FROM game_time gt 
                     CROSS JOIN (
                         SELECT strategy_id
-                        FROM active_strategy
-                        ORDER BY activated_at DESC
-                        LIMIT 1
-                        FOR UPDATE
+                        FROM current_strategy
                     ) ast
                     WHERE gt.time_id = (
                         SELECT bottling_time_id 
@@ -270,7 +908,6 @@ class CatalogManager:
                             LIMIT 1
                         )
                     )
-                    FOR UPDATE
                 ),
                 prioritized_potions AS (
                     SELECT 
@@ -317,52 +954,87 @@ class CatalogManager:
             )
         ).mappings().all()
 
+class BarrelCatalog:
+    """
+    Wholesale catalog parsed once into columns of size, color, ml, price,
+    quantity and ml per gold. Strategy and color selections are index lists
+    built on first use, so planners never rescan skus.
+    """
+
+    SIZES = ('MINI', 'SMALL', 'MEDIUM', 'LARGE')
+
+    # Barrel sizes each strategy buys, in preference order
+    STRATEGY_SIZES = {
+        'PREMIUM': ('SMALL',),
+        'PENETRATION': ('MEDIUM', 'SMALL')
+    }
+    DEFAULT_SIZES = ('LARGE', 'MEDIUM')
+
+    def __init__(self, barrels: list):
+        self.barrels = list(barrels)
+        self.sku = [b['sku'] for b in self.barrels]
+        self.size = [next((size for size in self.SIZES if size in sku), None) for sku in self.sku]
+        self.color = [next((color for color in BarrelManager.COLORS if color in sku), None) for sku in self.sku]
+        self.ml = [b['ml_per_barrel'] for b in self.barrels]
+        self.price = [b['price'] for b in self.barrels]
+        self.quantity = [b['quantity'] for b in self.barrels]
+        self.ml_per_gold = [ml / price if price else float('inf') for ml, price in zip(self.ml, self.price)]
+        self._selections = {}
+
+    @classmethod
+    def of(cls, catalog) -> 'BarrelCatalog':
+        """Returns catalog parsed, reusing it if it already is."""
+        return catalog if isinstance(catalog, cls) else cls(catalog)
+
+    def __len__(self) -> int:
+        return len(self.barrels)
+
+    def select(self, strategy: str, color: Optional[str] = None, ranked: bool = False) -> List[int]:
+        """
+        Indices of barrels the strategy buys, by size preference then catalog
+        order, or by most ml per gold when ranked. Optionally one color only.
+        """
+        key = (strategy, color, ranked)
+        if key not in self._selections:
+            sizes = self.STRATEGY_SIZES.get(strategy, self.DEFAULT_SIZES)
+            selected = [
+                i
+                for size in sizes
+                for i in range(len(self.barrels))
+                if self.size[i] == size and (color is None or self.color[i] == color)
+            ]
+            if ranked:
+                selected.sort(key=lambda i: -self.ml_per_gold[i])
+            self._selections[key] = selected
+        return self._selections[key]
+
+    def filter(self, strategy: str, color: Optional[str] = None, ranked: bool = False) -> List[dict]:
+        """Barrels the strategy buys, as selected by select()."""
+        return [self.barrels[i] for i in self.select(strategy, color, ranked)]
+
 class BarrelManager:
     """Handles barrel purchase planning and processing."""
 
-    MAX_RETRIES = 3
-    RETRY_DELAY = 0.1
+    COLORS = ('RED', 'GREEN', 'BLUE', 'DARK')
+
+    # Schedule blocks covered by each barrel plan; 1 plans only the arrival block
+    LOOKAHEAD_BLOCKS = int(os.environ.get("BARREL_LOOKAHEAD_BLOCKS", "1"))
+
+    # Weight of each horizon block relative to the block before it
+    LOOKAHEAD_DISCOUNT = 0.8
+
+    # Seconds the lookahead search may run before returning its best plan so far
+    LOOKAHEAD_TIME_BUDGET = 0.05
 
     @staticmethod
-    def with_retry(func):
-        """Decorator to retry database operations on failure."""
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(BarrelManager.MAX_RETRIES):
-                try:
-                    return func(*args, **kwargs)
-                except OperationalError as e:
-                    last_error = e
-                    if attempt < BarrelManager.MAX_RETRIES - 1:
-                        logger.warning(
-                            f"Retry {attempt + 1}/{BarrelManager.MAX_RETRIES} "
-                            f"for barrel purchase: {str(e)}"
-                        )
-                        time.sleep(BarrelManager.RETRY_DELAY)
-                        continue
-                    logger.error(f"All retries failed: {str(last_error)}")
-                    raise
-            return None
-        return wrapper
-    
-    @staticmethod
-    def record_catalog(conn, wholesale_catalog: list, time_id: int) -> int: 
+    def record_catalog(conn, wholesale_catalog: list, time_id: int, ctx: RequestContext = None) -> int: 
         """Records wholesale catalog excluding MINI barrels with batch insertion."""
-        # Get current strategy
-        current_strategy_row = conn.execute(
-            sqlalchemy.text("""
-                SELECT s.name as strategy_name
-                FROM active_strategy ast
-                JOIN strategies s ON ast.strategy_id = s.strategy_id
-                ORDER BY ast.activated_at DESC
-                LIMIT 1
-            """)
-        ).mappings().one()
-        
-        current_strategy = current_strategy_row['strategy_name']
+        ctx = ctx or RequestContext(conn)
+        current_strategy = ctx.strategy['strategy_name']
         
         # Filter barrels
-        valid_barrels = BarrelManager.filter_barrels_by_strategy(wholesale_catalog, current_strategy)
+        catalog = BarrelCatalog.of(wholesale_catalog)
+        valid_barrels = catalog.select(current_strategy)
         
         # Record visit
         visit_id = conn.execute(
@@ -376,8 +1048,9 @@ class BarrelManager:
         
         # Prepare data for batch insertion
         barrel_values = []
-        for barrel in valid_barrels:
-            color_name = barrel['sku'].split('_')[1]
+        for i in valid_barrels:
+            barrel = catalog.barrels[i]
+            color_name = catalog.color[i]
             barrel_values.append({
                 "visit_id": visit_id,
                 "sku": barrel["sku"],
@@ -416,23 +1089,19 @@ class BarrelManager:
         
         return visit_id
     
-    def get_future_block_priorities(conn, time_id: int) -> dict:
+    @staticmethod
+    def get_future_block_priorities(conn, time_id: int, ctx: RequestContext = None) -> dict:
         """Get time block and priorities for when barrels will arrive."""
         logger.debug("Getting future block priorities for barrel arrival")
+        ctx = ctx or RequestContext(conn)
 
         future_block = conn.execute(sqlalchemy.text("""
             WITH future_info AS (
                 SELECT 
                     gt.in_game_day,
                     gt.in_game_hour,
-                    ast.strategy_id
+                    :strategy_id as strategy_id
                 FROM game_time gt
-                CROSS JOIN (
-                    SELECT strategy_id 
-                    FROM active_strategy
-                    ORDER BY activated_at DESC
-                    LIMIT 1
-                ) ast
                 WHERE gt.time_id = (
                     SELECT barrel_time_id
                     FROM game_time
@@ -441,6 +1110,7 @@ class BarrelManager:
             )
             SELECT 
                 stb.block_id,
+                tb.block_id as time_block_id,
                 tb.name as block_name,
                 fi.in_game_day,
                 stb.buffer_multiplier,
@@ -454,7 +1124,10 @@ class BarrelManager:
                 AND fi.strategy_id = stb.strategy_id
                 AND fi.in_game_day = stb.day_name
             JOIN strategies s ON s.strategy_id = fi.strategy_id
-        """), {"time_id": time_id}).mappings().one()
+        """), {
+            "time_id": time_id,
+            "strategy_id": ctx.strategy['strategy_id']
+        }).mappings().one()
 
         logger.debug(
             f"Got future block info - "
@@ -466,78 +1139,116 @@ class BarrelManager:
         )
         
         return future_block
+
+    @staticmethod
+    def get_horizon_blocks(conn, time_id: int, blocks: int, ctx: RequestContext = None) -> List[dict]:
+        """
+        Gets the active strategy's next `blocks` schedule blocks, starting
+        with the block barrels bought now arrive in and wrapping at week end.
+        """
+        ctx = ctx or RequestContext(conn)
+
+        result = conn.execute(sqlalchemy.text("""
+            WITH arrival AS (
+                SELECT barrel_time_id as time_id
+                FROM game_time
+                WHERE time_id = :time_id
+            )
+            SELECT
+                stb.block_id,
+                tb.block_id as time_block_id,
+                tb.name as block_name,
+                gt.in_game_day,
+                stb.buffer_multiplier,
+                stb.dark_buffer_multiplier,
+                s.name as strategy_name,
+                MIN((gt.time_id - a.time_id + :ticks) % :ticks) as tick_offset
+            FROM game_time gt
+            CROSS JOIN arrival a
+            JOIN time_blocks tb
+                ON gt.in_game_hour BETWEEN tb.start_hour AND tb.end_hour
+            JOIN strategy_time_blocks stb
+                ON tb.block_id = stb.time_block_id
+                AND stb.strategy_id = :strategy_id
+                AND gt.in_game_day = stb.day_name
+            JOIN strategies s ON s.strategy_id = stb.strategy_id
+            GROUP BY
+                stb.block_id, tb.block_id, tb.name, gt.in_game_day,
+                stb.buffer_multiplier, stb.dark_buffer_multiplier, s.name
+            ORDER BY tick_offset
+            LIMIT :blocks
+        """), {
+            "time_id": time_id,
+            "strategy_id": ctx.strategy['strategy_id'],
+            "ticks": SalesManager.TICKS_PER_EPOCH,
+            "blocks": blocks
+        }).mappings().all()
+
+        return [dict(row) for row in result]
     
     @staticmethod
     def filter_barrels_by_strategy(barrels: list, strategy: str) -> list:
-        """Filter and sort barrels based on strategy restrictions."""
-        # Filter out MINI barrels first
-        valid_barrels = [b for b in barrels if not b['sku'].startswith('MINI')]
-        
-        if strategy == 'PREMIUM':
-            filtered = [b for b in valid_barrels if 'SMALL' in b['sku']]
-        elif strategy == 'PENETRATION':
-            medium = [b for b in valid_barrels if 'MEDIUM' in b['sku']]
-            small = [b for b in valid_barrels if 'SMALL' in b['sku']]
-            filtered = medium + small
-        else:
-            large = [b for b in valid_barrels if 'LARGE' in b['sku']]
-            medium = [b for b in valid_barrels if 'MEDIUM' in b['sku']]
-            filtered = large + medium
-                
-        return filtered
+        """Filter and sort barrels based on strategy restrictions, excluding MINI barrels."""
+        return BarrelCatalog.of(barrels).filter(strategy)
 
-    @staticmethod
-    def get_color_needs(conn, block: dict) -> dict:
-        """Calculate color needs based on future block priorities and current inventory."""
-        # Get current ml levels
-        current_levels = conn.execute(sqlalchemy.text("""
-            SELECT red_ml, green_ml, blue_ml, dark_ml
-            FROM current_state
-        """)).mappings().one()
-        
-        # Get base needs
-        base_needs = conn.execute(
+    @classmethod
+    def get_block_ml_needs(cls, conn, block: dict, total_potion_capacity: int) -> Dict[str, float]:
+        """Gets buffered ml per color to fill potion capacity with a block's blended mix."""
+        # Get block mix, blended with forecast demand
+        priorities = conn.execute(
             sqlalchemy.text("""
-                WITH current_cap AS (
-                    SELECT potion_capacity_units * 50 as total_potion_capacity
-                    FROM current_state
-                ),
-                block_needs AS (
-                    SELECT
-                        cd.color_name,
-                        SUM(
-                            CASE
-                                WHEN cd.color_name = 'RED' THEN p.red_ml
-                                WHEN cd.color_name = 'GREEN' THEN p.green_ml
-                                WHEN cd.color_name = 'BLUE' THEN p.blue_ml
-                                WHEN cd.color_name = 'DARK' THEN p.dark_ml
-                            END * bpp.sales_mix * 
-                            (SELECT total_potion_capacity FROM current_cap)
-                        ) as ml_needed
-                    FROM block_potion_priorities bpp
-                    JOIN potions p ON bpp.potion_id = p.potion_id
-                    CROSS JOIN color_definitions cd
-                    WHERE bpp.block_id = :block_id
-                    GROUP BY cd.color_name
-                )
-                SELECT color_name, ml_needed
-                FROM block_needs
-                WHERE ml_needed > 0
-                ORDER BY ml_needed DESC
+                SELECT
+                    bpp.potion_id,
+                    bpp.sales_mix,
+                    p.red_ml,
+                    p.green_ml,
+                    p.blue_ml,
+                    p.dark_ml
+                FROM block_potion_priorities bpp
+                JOIN potions p ON bpp.potion_id = p.potion_id
+                WHERE bpp.block_id = :block_id
             """),
             {"block_id": block['block_id']}
         ).mappings().all()
+        priorities = DemandForecaster.blend(
+            conn,
+            priorities,
+            block['in_game_day'],
+            block['time_block_id']
+        )
+
+        needs = {}
+        for color in cls.COLORS:
+            needed = sum(
+                (p[f"{color.lower()}_ml"] or 0) * p['sales_mix'] * total_potion_capacity
+                for p in priorities
+            )
+            buffer = block['dark_buffer_multiplier'] if color == 'DARK' else block['buffer_multiplier']
+            needs[color] = needed * buffer
+
+        return needs
+
+    @classmethod
+    def get_color_needs(cls, conn, block: dict, ctx: RequestContext = None) -> dict:
+        """Calculate color needs based on future block priorities and current inventory."""
+        ctx = ctx or RequestContext(conn)
+        
+        # Get current ml levels
+        current_levels = ctx.state
+
+        # Get buffered needs
+        block_needs = cls.get_block_ml_needs(
+            conn,
+            block,
+            current_levels['potion_capacity_units'] * 50
+        )
 
         # Calculate adjusted needs considering current inventory
         color_needs = {}
-        for need in base_needs:
-            color = need['color_name']
+        for color, total_need in sorted(block_needs.items(), key=lambda need: -need[1]):
+            if total_need <= 0:
+                continue
             current = current_levels[f"{color.lower()}_ml"]
-            needed = need['ml_needed']
-                
-            # Apply buffer and calculate adjusted need
-            buffer = block['dark_buffer_multiplier'] if color == 'DARK' else block['buffer_multiplier']
-            total_need = needed * buffer
             
             # Only add to needs if we actually need more
             if current < total_need:
@@ -553,29 +1264,51 @@ class BarrelManager:
     def plan_barrel_purchases(
         conn,
         wholesale_catalog: list,
-        time_id: int
+        time_id: int,
+        ctx: RequestContext = None,
+        lookahead_blocks: Optional[int] = None
     ) -> list:
-        """Plan purchases based on future needs and strategy."""
+        """
+        Plan purchases based on future needs and strategy. With more than one
+        lookahead block, purchases are optimized across that many schedule
+        blocks instead of only the arrival block.
+        """
+        ctx = ctx or RequestContext(conn)
+        lookahead_blocks = lookahead_blocks or BarrelManager.LOOKAHEAD_BLOCKS
+        catalog = BarrelCatalog.of(wholesale_catalog)
 
         # Get current state
-        state = conn.execute(sqlalchemy.text(
-            "SELECT * FROM current_state"
-        )).mappings().one()
-        
-        # Get future block info and priorities
-        future_block = BarrelManager.get_future_block_priorities(conn, time_id)
-
-        # Calculate color needs based on future block
-        color_needs = BarrelManager.get_color_needs(conn, future_block)
-        
-        # Plan purchases considering constraints
-        purchases = BarrelManager.calculate_purchase_quantities(
-            wholesale_catalog,
-            color_needs,
-            state['gold'],
-            state['max_ml'] - state['total_ml'],
-            future_block['strategy_name']
-        )
+        state = ctx.state
+
+        if lookahead_blocks > 1:
+            horizon = BarrelManager.get_horizon_blocks(conn, time_id, lookahead_blocks, ctx)
+            horizon_needs = [
+                BarrelManager.get_block_ml_needs(conn, block, state['potion_capacity_units'] * 50)
+                for block in horizon
+            ]
+            purchases = BarrelManager.plan_lookahead_purchases(
+                catalog,
+                horizon_needs,
+                {color: state[f"{color.lower()}_ml"] for color in BarrelManager.COLORS},
+                state['gold'],
+                state['max_ml'] - state['total_ml'],
+                horizon[0]['strategy_name']
+            )
+        else:
+            # Get future block info and priorities
+            future_block = BarrelManager.get_future_block_priorities(conn, time_id, ctx)
+
+            # Calculate color needs based on future block
+            color_needs = BarrelManager.get_color_needs(conn, future_block, ctx)
+
+            # Plan purchases considering constraints
+            purchases = BarrelManager.calculate_purchase_quantities(
+                catalog,
+                color_needs,
+                state['gold'],
+                state['max_ml'] - state['total_ml'],
+                future_block['strategy_name']
+            )
         
         if purchases:
             logger.info(
@@ -603,7 +1336,8 @@ class BarrelManager:
             f"capacity: {available_capacity}"
         )
         
-        filtered_barrels = BarrelManager.filter_barrels_by_strategy(catalog, strategy)
+        catalog = BarrelCatalog.of(catalog)
+        color_barrels = {color: catalog.select(strategy, color) for color in color_needs}
         remaining_gold = available_gold
         remaining_capacity = available_capacity
         purchase_quantities = {}
@@ -622,17 +1356,15 @@ class BarrelManager:
                 if needed_ml <= 0:
                     continue
                     
-                color_barrels = [b for b in filtered_barrels if color in b['sku']]
-                
-                for barrel in color_barrels:
-                    if barrel['price'] <= remaining_gold and \
-                    barrel['ml_per_barrel'] <= remaining_capacity:
-                        purchase_quantities[barrel['sku']] = \
-                            purchase_quantities.get(barrel['sku'], 0) + 1
+                for i in color_barrels[color]:
+                    if catalog.price[i] <= remaining_gold and \
+                    catalog.ml[i] <= remaining_capacity:
+                        purchase_quantities[catalog.sku[i]] = \
+                            purchase_quantities.get(catalog.sku[i], 0) + 1
                         
-                        remaining_gold -= barrel['price']
-                        remaining_capacity -= barrel['ml_per_barrel']
-                        color_needs[color] -= barrel['ml_per_barrel']
+                        remaining_gold -= catalog.price[i]
+                        remaining_capacity -= catalog.ml[i]
+                        color_needs[color] -= catalog.ml[i]
                         can_purchase = True
                         break  # Move to next color
         
@@ -644,6 +1376,156 @@ class BarrelManager:
         logger.debug(f"Planned {len(purchases)} purchases")
         return purchases
     
+    @classmethod
+    def horizon_value(
+        cls,
+        ml: Dict[str, float],
+        horizon_needs: List[Dict[str, float]]
+    ) -> float:
+        """Scores ml on hand by the discounted share of each horizon block's needs it covers."""
+        return sum(
+            cls.LOOKAHEAD_DISCOUNT ** k * min(ml.get(color, 0), needs.get(color, 0))
+            for k, needs in enumerate(horizon_needs)
+            for color in cls.COLORS
+        )
+
+    @classmethod
+    def plan_lookahead_purchases(
+        cls,
+        catalog: list,
+        horizon_needs: List[Dict[str, float]],
+        current_ml: Dict[str, int],
+        available_gold: int,
+        available_capacity: int,
+        strategy: str,
+        time_budget: Optional[float] = None
+    ) -> list:
+        """
+        Chooses barrel quantities that maximize discounted coverage of every
+        horizon block's ml needs within gold, ml capacity and catalog limits,
+        spending the least gold among equal plans. Branch and bound from the
+        greedy plan for the largest need; when time_budget runs out the best
+        plan found so far is returned.
+        """
+        deadline = time.monotonic() + (
+            cls.LOOKAHEAD_TIME_BUDGET if time_budget is None else time_budget
+        )
+
+        # Most ml per color worth holding anywhere in the horizon
+        targets = {
+            color: max((needs.get(color, 0) for needs in horizon_needs), default=0)
+            for color in cls.COLORS
+        }
+        shortfalls = {
+            color: targets[color] - current_ml.get(color, 0)
+            for color in cls.COLORS
+            if targets[color] > current_ml.get(color, 0)
+        }
+
+        catalog = BarrelCatalog.of(catalog)
+        barrels = sorted(
+            (
+                {**catalog.barrels[i], "color": color}
+                for color in shortfalls
+                for i in catalog.select(strategy, color)
+            ),
+            key=lambda b: (b['color'], -b['ml_per_barrel'])
+        )
+        if not barrels:
+            return []
+
+        # Value gained over doing nothing; gold breaks ties between equal coverage
+        base_value = cls.horizon_value(current_ml, horizon_needs)
+        gold_weight = 1e-6
+
+        def objective(quantities: list) -> float:
+            ml = dict(current_ml)
+            gold = 0
+            for barrel, quantity in zip(barrels, quantities):
+                ml[barrel['color']] = ml.get(barrel['color'], 0) + quantity * barrel['ml_per_barrel']
+                gold += quantity * barrel['price']
+            return cls.horizon_value(ml, horizon_needs) - base_value - gold_weight * gold
+
+        # Seed with the single-target greedy plan
+        greedy = cls.calculate_purchase_quantities(
+            catalog, dict(shortfalls), available_gold, available_capacity, strategy
+        )
+        greedy_quantities = {p['sku']: p['quantity'] for p in greedy}
+        best = {"quantities": [
+            min(greedy_quantities.get(b['sku'], 0), b['quantity']) for b in barrels
+        ]}
+        best["value"] = objective(best["quantities"])
+
+        # Ceiling on value still reachable from barrels at index i onwards
+        colors_from = [set(b['color'] for b in barrels[i:]) for i in range(len(barrels) + 1)]
+        full_value = {
+            color: cls.horizon_value({color: targets[color]}, horizon_needs) -
+                   cls.horizon_value({color: current_ml.get(color, 0)}, horizon_needs)
+            for color in shortfalls
+        }
+
+        quantities = [0] * len(barrels)
+        nodes = 0
+        timed_out = False
+
+        def search(i: int, gold: int, capacity: int, ml: dict) -> None:
+            nonlocal nodes, timed_out
+            nodes += 1
+            if timed_out or time.monotonic() > deadline:
+                timed_out = True
+                return
+
+            value = cls.horizon_value(ml, horizon_needs) - base_value - gold_weight * (available_gold - gold)
+            bound = value + sum(
+                full_value[color] -
+                (cls.horizon_value({color: ml[color]}, horizon_needs) -
+                 cls.horizon_value({color: current_ml.get(color, 0)}, horizon_needs))
+                for color in colors_from[i]
+            )
+            if bound <= best["value"]:
+                return
+            if i == len(barrels):
+                best["value"] = value
+                best["quantities"] = list(quantities)
+                return
+
+            barrel = barrels[i]
+            color = barrel['color']
+            useful = max(targets[color] - ml[color], 0)
+            most = min(
+                barrel['quantity'],
+                gold // barrel['price'],
+                capacity // barrel['ml_per_barrel'],
+                -(-int(useful) // barrel['ml_per_barrel'])
+            )
+            for quantity in range(most, -1, -1):
+                quantities[i] = quantity
+                search(
+                    i + 1,
+                    gold - quantity * barrel['price'],
+                    capacity - quantity * barrel['ml_per_barrel'],
+                    {**ml, color: ml[color] + quantity * barrel['ml_per_barrel']}
+                )
+            quantities[i] = 0
+
+        search(
+            0,
+            available_gold,
+            available_capacity,
+            {color: current_ml.get(color, 0) for color in cls.COLORS}
+        )
+
+        logger.debug(
+            f"Lookahead search over {len(horizon_needs)} blocks - "
+            f"nodes: {nodes}, timed out: {timed_out}, value: {best['value']:.1f}"
+        )
+
+        return [
+            {"sku": barrel['sku'], "quantity": quantity}
+            for barrel, quantity in zip(barrels, best["quantities"])
+            if quantity > 0
+        ]
+
     @staticmethod
     def validate_purchase_constraints(conn, purchases: list, available_capacity: int) -> None:
         """
@@ -651,19 +1533,6 @@ class BarrelManager:
         Raises HTTPException if constraints are violated.
         """
         logger.debug(f"Validating purchases against capacity: {available_capacity}")
-        
-        # Get current strategy limits
-        strategy = conn.execute(
-            sqlalchemy.text("""
-                SELECT 
-                    s.max_potions_per_sku,
-                    s.name as strategy_name
-                FROM strategies s
-                JOIN active_strategy ast ON s.strategy_id = ast.strategy_id
-                ORDER BY ast.activated_at DESC
-                LIMIT 1
-            """)
-        ).mappings().one()
 
         # Validate ml capacity
         total_ml = sum(p['ml_per_barrel'] * p['quantity'] for p in purchases)
@@ -680,23 +1549,11 @@ class BarrelManager:
         logger.debug("Purchase constraints validated successfully")
     
     @classmethod
-    @with_retry
     def process_barrel_purchases(cls, conn, barrels: List[dict], time_id: int, visit_id: int, order_id: int) -> None:
-        """Records a barrel purchase with ledger entry, handling idempotency using order_id."""
-        # Check if this delivery was already processed successfully
-        existing_purchase = conn.execute(
-            sqlalchemy.text("""
-                SELECT 1 FROM barrel_purchases 
-                WHERE visit_id = :visit_id 
-                AND purchase_success = true
-            """),
-            {"visit_id": visit_id}
-        ).fetchone()
-
-        if existing_purchase:
-            logger.info(f"Delivery for visit {visit_id} was already processed successfully.")
-            return  
-
+        """
+        Records a barrel purchase with ledger entry. Callers guard against
+        replayed order_ids with OrderManager.claim_order.
+        """
         logger.info(f"Processing new delivery for visit {visit_id}")
 
         # Prepare data for batch insert
@@ -745,19 +1602,8 @@ class BarrelManager:
                 "color_name": color_name
             })
 
-        # Validate resources (gold)
-        state = conn.execute(
-            sqlalchemy.text("""
-                WITH locked_ledger AS (
-                    SELECT entry_id, gold_change
-                    FROM ledger_entries
-                    FOR UPDATE
-                )
-                SELECT 
-                    COALESCE(SUM(gold_change), 0) as gold
-                FROM locked_ledger
-            """)
-        ).mappings().one()
+        # Validate resources (gold) against live totals, locked against other spenders
+        state = LedgerManager.lock_state(conn)
 
         if state['gold'] < total_cost:
             raise HTTPException(status_code=400, detail="Insufficient gold")
@@ -824,44 +1670,13 @@ class BarrelManager:
 class BottlerManager:
     """Handles potion bottling planning and processing."""
 
-    MAX_RETRIES = 3
-    RETRY_DELAY = 0.1
-
-    @staticmethod
-    def with_retry(func):
-        """Decorator to retry database operations on failure."""
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(BottlerManager.MAX_RETRIES):
-                try:
-                    return func(*args, **kwargs)
-                except OperationalError as e:
-                    last_error = e
-                    if attempt < BottlerManager.MAX_RETRIES - 1:
-                        logger.warning(
-                            f"Retry {attempt + 1}/{BottlerManager.MAX_RETRIES} "
-                            f"for bottling operation: {str(e)}"
-                        )
-                        time.sleep(BottlerManager.RETRY_DELAY)
-                        continue
-                    logger.error(f"All retries failed: {str(last_error)}")
-                    raise
-            return None
-        return wrapper
-    
     @staticmethod
-    def get_bottling_priorities(conn) -> list:
+    def get_bottling_priorities(conn, ctx: RequestContext = None) -> list:
         """Gets prioritized potions for bottling based on future time block."""
-        # Get current time
-        current_time = TimeManager.get_current_time(conn)
+        ctx = ctx or RequestContext(conn)
         
         logger.debug(f"Getting bottling priorities for future time block")
-    
-        current_state = conn.execute(
-            sqlalchemy.text("SELECT * FROM current_state")
-        ).mappings().one()
-        
-        logger.debug(f"Current state: {current_state}")
+        logger.debug(f"Current state: {ctx.state}")
     
         priorities = conn.execute(
             sqlalchemy.text("""
@@ -869,14 +1684,8 @@ class BottlerManager:
                     SELECT 
                         gt.in_game_day,
                         gt.in_game_hour,
-                        ast.strategy_id
+                        :strategy_id as strategy_id
                     FROM game_time gt
-                    CROSS JOIN (
-                        SELECT strategy_id 
-                        FROM active_strategy
-                        ORDER BY activated_at DESC
-                        LIMIT 1
-                    ) ast
                     WHERE gt.time_id = (
                         SELECT bottling_time_id
                         FROM game_time
@@ -917,10 +1726,19 @@ class BottlerManager:
                     ON fi.strategy_id = s.strategy_id
                 ORDER BY bpp.priority_order
             """),
-            {"time_id": current_time['time_id']}
+            {
+                "time_id": ctx.time_id,
+                "strategy_id": ctx.strategy['strategy_id']
+            }
         ).mappings().all()
         
         if priorities:
+            priorities = DemandForecaster.blend(
+                conn,
+                priorities,
+                priorities[0]['in_game_day'],
+                priorities[0]['block_id']
+            )
             logger.debug(
                 f"Got priorities for future block - "
                 f"day: {priorities[0]['in_game_day']}, "
@@ -1069,10 +1887,41 @@ class BottlerManager:
             
         return result
 
+    @staticmethod
+    def lock_potions(conn, potion_types: List[list]) -> None:
+        """
+        Locks every potion row in a delivery in SKU order, the order checkouts
+        lock them in, before bottling takes any other lock.
+        """
+        potion_ids = [
+            conn.execute(
+                sqlalchemy.text("""
+                    SELECT potion_id
+                    FROM potions
+                    WHERE ARRAY[red_ml, green_ml, blue_ml, dark_ml] = :potion_type
+                """),
+                {"potion_type": potion_type}
+            ).scalar_one()
+            for potion_type in potion_types
+        ]
+
+        conn.execute(
+            sqlalchemy.text("""
+                SELECT potion_id
+                FROM potions
+                WHERE potion_id = ANY(:potion_ids)
+                ORDER BY sku
+                FOR UPDATE
+            """),
+            {"potion_ids": potion_ids}
+        )
+
     @classmethod
-    @with_retry
     def process_bottling(cls, conn, potion_data: Dict, time_id: int) -> None:
-        """Processes potion bottling with ledger entries."""
+        """
+        Processes potion bottling with ledger entries. Deliveries of several
+        potions lock them all with lock_potions first.
+        """
         # First get and lock the potion
         potion = conn.execute(
             sqlalchemy.text("""
@@ -1090,30 +1939,9 @@ class BottlerManager:
             {"potion_type": potion_data['potion_type']}
         ).mappings().one()
 
-        # Get and lock the ledger entries to check ml availability
-        ml_totals = conn.execute(
-            sqlalchemy.text("""
-                WITH locked_entries AS (
-                    SELECT 
-                        color_id,
-                        ml_change
-                    FROM ledger_entries
-                    FOR UPDATE
-                )
-                SELECT 
-                    c.color_name,
-                    COALESCE(SUM(le.ml_change), 0) as ml_available
-                FROM color_definitions c
-                LEFT JOIN locked_entries le ON c.color_id = le.color_id
-                GROUP BY c.color_name
-            """)
-        ).mappings().all()
-
-        # Convert to dict for easier access
-        ml_available = {
-            row['color_name'].lower() + '_ml': row['ml_available']
-            for row in ml_totals
-        }
+        # Lock out other ml spenders, then read ml per color from the last
+        # checkpoint and open epoch
+        ml_available = LedgerManager.lock_state(conn)
 
         # Log current state
         logger.debug(
@@ -1217,95 +2045,548 @@ class BottlerManager:
             }
         )
 
+class JointPlanner:
+    """
+    Plans barrel purchases together with the bottling they are bought for.
+    Potions for the arrival block are added one at a time, each time taking
+    the potion whose extra ml costs the least gold per potion it unlocks, so
+    complementary colors are always bought together and no ml is bought that
+    the block's recipes cannot use.
+    """
+
+    ML_COLUMNS = ('red_ml', 'green_ml', 'blue_ml', 'dark_ml')
+
+    # Search nodes each cheapest cover may visit before returning its best so far
+    SEARCH_NODES = 5000
+
+    # Seconds the planner may add potions before returning its plan so far
+    PLAN_TIME_BUDGET = 0.05
+
+    @staticmethod
+    def get_block_potions(conn, block: dict, ctx: RequestContext = None) -> List[dict]:
+        """Gets the block's priority potions with recipes, stock and blended sales_mix."""
+        ctx = ctx or RequestContext(conn)
+
+        potions = conn.execute(
+            sqlalchemy.text("""
+                SELECT
+                    p.potion_id,
+                    p.sku,
+                    p.red_ml,
+                    p.green_ml,
+                    p.blue_ml,
+                    p.dark_ml,
+                    p.current_quantity as inventory,
+                    bpp.sales_mix,
+                    bpp.priority_order
+                FROM block_potion_priorities bpp
+                JOIN potions p ON bpp.potion_id = p.potion_id
+                WHERE bpp.block_id = :block_id
+                ORDER BY bpp.priority_order
+            """),
+            {"block_id": block['block_id']}
+        ).mappings().all()
+
+        return [
+            {**potion, "max_potions_per_sku": ctx.strategy['max_potions_per_sku']}
+            for potion in DemandForecaster.blend(
+                conn, potions, block['in_game_day'], block['time_block_id']
+            )
+        ]
+
+    @classmethod
+    def cheapest_barrels(
+        cls,
+        barrels: List[dict],
+        deficit: int,
+        max_ml: int,
+        max_nodes: Optional[int] = None
+    ) -> Optional[tuple]:
+        """
+        Finds the cheapest quantities of one color's barrels holding at least
+        deficit ml and at most max_ml. Returns (cost, ml, {sku: quantity}) or None.
+        Branch and bound from a greedy cover in catalog order; after max_nodes
+        the best cover found so far is returned.
+        """
+        if deficit <= 0:
+            return 0, 0, {}
+
+        max_nodes = cls.SEARCH_NODES if max_nodes is None else max_nodes
+
+        # Seed with the greedy cover, taking each barrel in order as needed
+        best = None
+        ml, cost, chosen = 0, 0, {}
+        for barrel in barrels:
+            if ml >= deficit:
+                break
+            quantity = max(min(
+                barrel['quantity'],
+                -(-(deficit - ml) // barrel['ml_per_barrel']),
+                (max_ml - ml) // barrel['ml_per_barrel']
+            ), 0)
+            if quantity:
+                chosen[barrel['sku']] = quantity
+                ml += quantity * barrel['ml_per_barrel']
+                cost += quantity * barrel['price']
+        if ml >= deficit:
+            best = (cost, ml, chosen)
+
+        nodes = 0
+
+        def search(i: int, ml: int, cost: int, chosen: dict) -> None:
+            nonlocal best, nodes
+            nodes += 1
+            if nodes > max_nodes:
+                return
+            if best is not None and cost >= best[0]:
+                return
+            if ml >= deficit:
+                best = (cost, ml, dict(chosen))
+                return
+            if i == len(barrels):
+                return
+
+            barrel = barrels[i]
+            most = max(min(
+                barrel['quantity'],
+                -(-(deficit - ml) // barrel['ml_per_barrel']),
+                (max_ml - ml) // barrel['ml_per_barrel']
+            ), 0)
+            for quantity in range(most, -1, -1):
+                if quantity:
+                    chosen[barrel['sku']] = quantity
+                search(
+                    i + 1,
+                    ml + quantity * barrel['ml_per_barrel'],
+                    cost + quantity * barrel['price'],
+                    chosen
+                )
+                chosen.pop(barrel['sku'], None)
+
+        search(0, 0, 0, {})
+        if nodes > max_nodes:
+            logger.debug(f"Cheapest cover for {deficit} ml stopped after {max_nodes} nodes")
+        return best
+
+    @classmethod
+    def optimize(
+        cls,
+        catalog: list,
+        priorities: List[dict],
+        current_ml: Dict[str, int],
+        available_gold: int,
+        ml_capacity: int,
+        potion_capacity: int,
+        strategy: str,
+        time_budget: Optional[float] = None
+    ) -> dict:
+        """
+        Returns barrel purchases and the bottling they enable, maximizing
+        sellable potions per gold. A potion is sellable up to its share of
+        potion capacity and the strategy's per-sku limit, as in the bottler.
+        When time_budget runs out the potions added so far are returned.
+        """
+        deadline = time.monotonic() + (
+            cls.PLAN_TIME_BUDGET if time_budget is None else time_budget
+        )
+        timed_out = False
+
+        colors = BarrelManager.COLORS
+        catalog = BarrelCatalog.of(catalog)
+        # Best ml per gold first, so the cheapest cover is found early and prunes the rest
+        barrels_by_color = {
+            color: catalog.filter(strategy, color, ranked=True)
+            for color in colors
+        }
+
+        targets = {}
+        for potion in priorities:
+            target = min(
+                int(potion['sales_mix'] * potion_capacity),
+                potion['max_potions_per_sku'] - potion['inventory']
+            )
+            if target > 0:
+                targets[potion['potion_id']] = target
+
+        bottled = {potion_id: 0 for potion_id in targets}
+        used = {color: 0 for color in colors}
+        purchases = {color: (0, 0, {}) for color in colors}
+
+        def recipe(potion: dict) -> Dict[str, int]:
+            return {
+                color: potion[column] or 0
+                for color, column in zip(colors, cls.ML_COLUMNS)
+                if potion[column]
+            }
+
+        def cover(color: str, need: int) -> Optional[tuple]:
+            """Cheapest purchase for a color's total need within remaining ml capacity."""
+            deficit = need - current_ml.get(color, 0)
+            if deficit <= purchases[color][1]:
+                return purchases[color]
+            other_ml = sum(ml for c, (_, ml, _) in purchases.items() if c != color)
+            return cls.cheapest_barrels(barrels_by_color[color], deficit, ml_capacity - other_ml)
+
+        while sum(bottled.values()) < potion_capacity:
+            if time.monotonic() > deadline:
+                timed_out = True
+                break
+
+            spent = sum(cost for cost, _, _ in purchases.values())
+            best = None
+
+            for potion in priorities:
+                potion_id = potion['potion_id']
+                if bottled.get(potion_id, 0) >= targets.get(potion_id, 0):
+                    continue
+
+                ml = recipe(potion)
+                covered = {color: cover(color, used[color] + amount) for color, amount in ml.items()}
+                if any(c is None for c in covered.values()):
+                    continue
+
+                extra = sum(c[0] - purchases[color][0] for color, c in covered.items())
+                if spent + extra > available_gold:
+                    continue
+
+                # Potions of this kind the new ml allows, so lumpy barrel prices are amortized
+                unlocked = min(
+                    targets[potion_id] - bottled[potion_id],
+                    potion_capacity - sum(bottled.values()),
+                    *(
+                        (current_ml.get(color, 0) + c[1] - used[color]) // ml[color]
+                        for color, c in covered.items()
+                    )
+                )
+                score = extra / max(unlocked, 1)
+                if best is None or score < best[0]:
+                    best = (score, potion_id, ml, covered)
+
+            if best is None:
+                break
+
+            _, potion_id, ml, covered = best
+            bottled[potion_id] += 1
+            for color, amount in ml.items():
+                used[color] += amount
+                purchases[color] = covered[color]
+
+        by_id = {potion['potion_id']: potion for potion in priorities}
+        barrels = {}
+        for _, _, quantities in purchases.values():
+            for sku, quantity in quantities.items():
+                barrels[sku] = barrels.get(sku, 0) + quantity
+
+        result = {
+            "barrels": [{"sku": sku, "quantity": quantity} for sku, quantity in barrels.items()],
+            "bottling": [
+                {
+                    "potion_type": [by_id[potion_id][column] or 0 for column in cls.ML_COLUMNS],
+                    "quantity": quantity,
+                    "sku": by_id[potion_id]['sku']
+                }
+                for potion_id, quantity in bottled.items()
+                if quantity > 0
+            ],
+            "potions": sum(bottled.values()),
+            "gold": sum(cost for cost, _, _ in purchases.values())
+        }
+
+        logger.debug(
+            f"Joint plan - potions: {result['potions']}, gold: {result['gold']}, "
+            f"barrels: {result['barrels']}, timed out: {timed_out}"
+        )
+        return result
+
+    @classmethod
+    def plan(cls, conn, wholesale_catalog: list, time_id: int, ctx: RequestContext = None) -> dict:
+        """Plans barrels and expected bottling for the block barrels bought now arrive in."""
+        ctx = ctx or RequestContext(conn)
+        state = ctx.state
+
+        block = BarrelManager.get_future_block_priorities(conn, time_id, ctx)
+        priorities = cls.get_block_potions(conn, block, ctx)
+
+        return cls.optimize(
+            wholesale_catalog,
+            priorities,
+            {color: state[f"{color.lower()}_ml"] for color in BarrelManager.COLORS},
+            state['gold'],
+            state['max_ml'] - state['total_ml'],
+            state['max_potions'] - state['total_potions'],
+            block['strategy_name']
+        )
+
 class CartManager:
     """Handles cart operations and customer interactions."""
     
     PAGE_SIZE = 5
-    MAX_RETRIES = 3
-    RETRY_DELAY = 0.1
 
-    @staticmethod
-    def with_retry(func):
-        """Decorator to retry database operations on failure."""
-        def wrapper(*args, **kwargs):
-            for attempt in range(CartManager.MAX_RETRIES):
-                try:
-                    return func(*args, **kwargs)
-                except OperationalError:
-                    if attempt < CartManager.MAX_RETRIES - 1:
-                        time.sleep(CartManager.RETRY_DELAY)
-                        continue
-                    raise
-            return None
-        return wrapper
+    # Raw visit payload storage: 'none' (customers rows only), 'compressed' or 'json'
+    VISIT_PAYLOAD_MODES = ('none', 'compressed', 'json')
+    VISIT_PAYLOAD_MODE = os.environ.get('CUSTOMER_VISIT_PAYLOAD', 'none')
+
+    # Rows per multi-row customers insert, kept well under bind parameter limits
+    CUSTOMER_INSERT_BATCH = 1000
+
+    # Latest committed visit: visit ids and (name, class, level) -> customer_id
+    _visit_index = None
+    _visit_index_lock = threading.Lock()
 
     @classmethod
-    @with_retry
-    def record_customer_visit(cls, conn, visit_id: int, customers: list, time_id: int) -> int:
-        """Records customer visit with basic retry logic."""
+    def record_customer_visit(
+        cls,
+        conn,
+        visit_id: int,
+        customers: list,
+        time_id: int,
+        payload_mode: Optional[str] = None
+    ) -> dict:
+        """
+        Records customer visit and bulk inserts its customers. The raw payload
+        is dropped, compressed or kept as JSON depending on payload_mode.
+        Returns the visit index to publish with cache_visit_index after commit.
+        """
+        payload_mode = payload_mode or cls.VISIT_PAYLOAD_MODE
+        if payload_mode not in cls.VISIT_PAYLOAD_MODES:
+            raise ValueError(f"Unknown visit payload mode: {payload_mode}")
+
         visit_record_id = conn.execute(
             sqlalchemy.text("""
-                INSERT INTO customer_visits (visit_id, time_id, customers)
-                VALUES (:visit_id, :time_id, :customers)
+                INSERT INTO customer_visits (
+                    visit_id, time_id, customer_count, customers, customers_gz
+                )
+                VALUES (:visit_id, :time_id, :customer_count, :customers, :customers_gz)
                 RETURNING visit_record_id
             """),
             {
                 "visit_id": visit_id,
                 "time_id": time_id,
-                "customers": json.dumps(customers)
+                "customer_count": len(customers),
+                "customers": json.dumps(customers) if payload_mode == 'json' else None,
+                "customers_gz": (
+                    zlib.compress(json.dumps(customers).encode())
+                    if payload_mode == 'compressed' else None
+                )
             }
         ).scalar_one()
 
-        # Insert customers in a single batch
-        values = []
-        for customer in customers:
-            values.append({
+        visit_index = {
+            "visit_record_id": visit_record_id,
+            "visit_id": visit_id,
+            "customers": {}
+        }
+
+        identities = {
+            cls.identity_hash(c['customer_name'], c['character_class']):
+                (c['customer_name'], c['character_class'])
+            for c in customers
+        }
+        identity_ids = cls.upsert_identities(conn, identities, time_id)
+
+        # Multi-row inserts; visit columns are bound once per statement
+        for start in range(0, len(customers), cls.CUSTOMER_INSERT_BATCH):
+            batch = customers[start:start + cls.CUSTOMER_INSERT_BATCH]
+            params = {
                 "visit_record_id": visit_record_id,
                 "visit_id": visit_id,
-                "time_id": time_id,
-                "name": customer['customer_name'],
-                "class": customer['character_class'],
-                "level": customer['level']
-            })
+                "time_id": time_id
+            }
+            rows = []
+            for i, customer in enumerate(batch):
+                rows.append(
+                    f"(:visit_record_id, :visit_id, :time_id, :identity_{i}, :level_{i})"
+                )
+                params[f"identity_{i}"] = identity_ids[
+                    cls.identity_hash(customer['customer_name'], customer['character_class'])
+                ]
+                params[f"level_{i}"] = customer['level']
 
-        if values:
-            conn.execute(
-                sqlalchemy.text("""
+            inserted = conn.execute(
+                sqlalchemy.text(f"""
                     INSERT INTO customers (
-                        visit_record_id, visit_id, time_id,
-                        customer_name, character_class, level
+                        visit_record_id, visit_id, time_id, identity_id, level
                     )
-                    VALUES (:visit_record_id, :visit_id, :time_id,
-                            :name, :class, :level)
+                    VALUES {", ".join(rows)}
+                    RETURNING customer_id, identity_id, level
                 """),
-                values
-            )
+                params
+            ).all()
+
+            # Repeated (name, class, level) resolves to the newest row
+            names = {identity_ids[h]: identity for h, identity in identities.items()}
+            for row in sorted(inserted, key=lambda r: r.customer_id):
+                name, character_class = names[row.identity_id]
+                visit_index["customers"][
+                    (name, character_class, row.level)
+                ] = row.customer_id
         
-        return visit_record_id
+        return visit_index
+
+    @staticmethod
+    def identity_hash(name: str, character_class: str) -> int:
+        """Stable signed 64-bit hash of a customer's (name, class) identity."""
+        digest = hashlib.blake2b(
+            f"{name}\x1f{character_class}".encode(),
+            digest_size=8
+        ).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    @classmethod
+    def upsert_identities(cls, conn, identities: Dict[int, tuple], time_id: int) -> Dict[int, int]:
+        """
+        Inserts unseen (name, class) identities and returns identity_hash -> identity_id
+        for every hash given. Existing identities are left untouched.
+        """
+        hashes = list(identities)
+        identity_ids = {}
+
+        for start in range(0, len(hashes), cls.CUSTOMER_INSERT_BATCH):
+            batch = hashes[start:start + cls.CUSTOMER_INSERT_BATCH]
+            params = {"time_id": time_id}
+            rows = []
+            for i, identity_hash in enumerate(batch):
+                rows.append(f"(:hash_{i}, :name_{i}, :class_{i}, :time_id)")
+                params[f"hash_{i}"] = identity_hash
+                params[f"name_{i}"], params[f"class_{i}"] = identities[identity_hash]
+
+            conn.execute(
+                sqlalchemy.text(f"""
+                    INSERT INTO customer_identities (
+                        identity_hash, customer_name, character_class, first_seen_time_id
+                    )
+                    VALUES {", ".join(rows)}
+                    ON CONFLICT (identity_hash) DO NOTHING
+                """),
+                params
+            )
+
+            placeholders = ", ".join(f":hash_{i}" for i in range(len(batch)))
+            identity_ids.update(conn.execute(
+                sqlalchemy.text(f"""
+                    SELECT identity_hash, identity_id
+                    FROM customer_identities
+                    WHERE identity_hash IN ({placeholders})
+                """),
+                {f"hash_{i}": identity_hash for i, identity_hash in enumerate(batch)}
+            ).all())
+
+        return identity_ids
 
     @staticmethod
-    def create_cart(conn, customer: dict, time_id: int, visit_id: int) -> int:
-        """Creates new cart for customer."""
-        customer_id = conn.execute(
+    def get_visit_payload(conn, visit_record_id: int) -> Optional[list]:
+        """Gets raw customer payload for a visit, or None if it was not kept."""
+        visit = conn.execute(
             sqlalchemy.text("""
-                SELECT c.customer_id
-                FROM customers c
-                JOIN customer_visits cv ON c.visit_record_id = cv.visit_record_id
-                WHERE c.customer_name = :name 
-                AND c.character_class = :class
-                AND c.level = :level
-                AND cv.visit_id = :visit_id
-                ORDER BY cv.created_at DESC
-                LIMIT 1
-                """
-            ),
+                SELECT customers, customers_gz
+                FROM customer_visits
+                WHERE visit_record_id = :visit_record_id
+            """),
+            {"visit_record_id": visit_record_id}
+        ).mappings().one()
+
+        if visit['customers_gz'] is not None:
+            return json.loads(zlib.decompress(bytes(visit['customers_gz'])))
+        if visit['customers'] is not None:
+            customers = visit['customers']
+            return json.loads(customers) if isinstance(customers, str) else customers
+        return None
+
+    @classmethod
+    def cache_visit_index(cls, visit_index: dict) -> None:
+        """Publishes a committed visit's customer index for cart creation."""
+        with cls._visit_index_lock:
+            current = cls._visit_index
+            if current is None or visit_index['visit_record_id'] >= current['visit_record_id']:
+                cls._visit_index = visit_index
+
+    @classmethod
+    def clear_visit_index(cls) -> None:
+        """Drops cached visit index."""
+        with cls._visit_index_lock:
+            cls._visit_index = None
+
+    @staticmethod
+    def resolve_customer(conn, customer: dict) -> dict:
+        """Finds latest visit and the matching customer in it via index lookups."""
+        result = conn.execute(
+            sqlalchemy.text("""
+                SELECT 
+                    cv.visit_record_id,
+                    cv.visit_id,
+                    (
+                        SELECT MAX(c.customer_id)
+                        FROM customers c
+                        WHERE c.visit_record_id = cv.visit_record_id
+                        AND c.identity_id = (
+                            SELECT identity_id
+                            FROM customer_identities
+                            WHERE identity_hash = :identity_hash
+                        )
+                        AND c.level = :level
+                    ) as customer_id
+                FROM customer_visits cv
+                WHERE cv.visit_record_id = (
+                    SELECT MAX(visit_record_id) FROM customer_visits
+                )
+            """),
             {
-                "name": customer['customer_name'],
-                "class": customer['character_class'],
-                "level": customer['level'],
-                "visit_id": visit_id
+                "identity_hash": CartManager.identity_hash(
+                    customer['customer_name'], customer['character_class']
+                ),
+                "level": customer['level']
             }
-        ).scalar()
+        ).mappings().first()
+
+        if not result:
+            raise HTTPException(status_code=400, detail="No customer visit recorded")
+
+        return dict(result)
+
+    @classmethod
+    def create_cart(cls, conn, customer: dict, time_id: int) -> int:
+        """
+        Creates new cart for customer in the latest visit. Uses the in-process
+        visit index when it still names the latest visit, so a cache hit is a
+        single insert; otherwise resolves the customer from the database.
+        """
+        with cls._visit_index_lock:
+            visit_index = cls._visit_index
+
+        if visit_index is not None:
+            key = (customer['customer_name'], customer['character_class'], customer['level'])
+
+            # Guard on latest visit so a visit recorded by another worker is never missed
+            cart_id = conn.execute(
+                sqlalchemy.text("""
+                    INSERT INTO carts (
+                        customer_id,
+                        visit_id,
+                        time_id,
+                        checked_out,
+                        total_potions,
+                        total_gold
+                    )
+                    SELECT :customer_id, :visit_id, :time_id, false, 0, 0
+                    WHERE :visit_record_id = (
+                        SELECT MAX(visit_record_id) FROM customer_visits
+                    )
+                    RETURNING cart_id
+                """),
+                {
+                    "customer_id": visit_index['customers'].get(key),
+                    "visit_id": visit_index['visit_id'],
+                    "time_id": time_id,
+                    "visit_record_id": visit_index['visit_record_id']
+                }
+            ).scalar()
+
+            if cart_id is not None:
+                return cart_id
+
+            logger.debug("Visit index is stale, resolving customer from database")
+
+        resolved = cls.resolve_customer(conn, customer)
         
         return conn.execute(
             sqlalchemy.text("""
@@ -1328,8 +2609,8 @@ class CartManager:
                 """
             ),
             {
-                "customer_id": customer_id,
-                "visit_id": visit_id,
+                "customer_id": resolved['customer_id'],
+                "visit_id": resolved['visit_id'],
                 "time_id": time_id
             }
         ).scalar_one()
@@ -1363,41 +2644,57 @@ class CartManager:
                 "total_potions_bought": result['total_potions'],
                 "total_gold_paid": result['total_gold']
             }
-            
-        # Check for pending checkout
-        pending = conn.execute(
-            sqlalchemy.text("""
-                SELECT 
-                    p.time_id,
-                    EXISTS (
-                        SELECT 1 
-                        FROM ledger_entries le 
-                        WHERE le.cart_id = :cart_id 
-                        AND le.entry_type = 'POTION_SOLD'
-                    ) as has_ledger
-                FROM pending_checkouts p
-                WHERE p.cart_id = :cart_id
-            """),
-            {"cart_id": cart_id}
-        ).mappings().first()
-        
-        if pending:
-            if pending['has_ledger']:
-                # Previous attempt succeeded but didn't finalize
-                return CartManager.finalize_pending_checkout(conn, cart_id, pending['time_id'])
-            else:
-                # Previous attempt failed - clean up and allow retry
-                conn.execute(
-                    sqlalchemy.text("DELETE FROM pending_checkouts WHERE cart_id = :cart_id"),
-                    {"cart_id": cart_id}
-                )
         
         return dict(result)
 
+    @staticmethod
+    def get_journaled_checkout(conn, cart_id: int, idempotency_key: Optional[str] = None) -> Optional[dict]:
+        """
+        Gets stored result of a completed checkout by cart_id, or by
+        idempotency key when given. Returns None if the cart has not checked out.
+        """
+        if idempotency_key:
+            entry = conn.execute(
+                sqlalchemy.text("""
+                    SELECT cart_id, status, total_potions, total_gold
+                    FROM checkout_journal
+                    WHERE idempotency_key = :key
+                """),
+                {"key": idempotency_key}
+            ).mappings().first()
+
+            if entry and entry['cart_id'] != cart_id:
+                raise HTTPException(
+                    status_code=409,
+                    detail="Idempotency key already used for another cart"
+                )
+        else:
+            entry = None
+
+        if entry is None:
+            entry = conn.execute(
+                sqlalchemy.text("""
+                    SELECT cart_id, status, total_potions, total_gold
+                    FROM checkout_journal
+                    WHERE cart_id = :cart_id
+                """),
+                {"cart_id": cart_id}
+            ).mappings().first()
+
+        if entry is None or entry['status'] != 'COMPLETED':
+            return None
+
+        return {
+            "total_potions_bought": entry['total_potions'],
+            "total_gold_paid": entry['total_gold']
+        }
+
     @staticmethod
     def update_cart_item(conn, cart_id: int, item_sku: str, quantity: int, time_id: int, visit_id: int) -> None:
-        """Updates cart item quantity with proper locking."""
-        # Lock potion row when checking inventory
+        """
+        Updates cart item quantity without locking the potion row.
+        Stock is only reserved at checkout by a guarded decrement.
+        """
         potion = conn.execute(
             sqlalchemy.text("""
                 SELECT 
@@ -1406,17 +2703,16 @@ class CartManager:
                     base_price
                 FROM potions
                 WHERE sku = :sku
-                FOR UPDATE
             """),
             {"sku": item_sku}
         ).mappings().one()
         
+        # Optimistic check; checkout re-validates atomically
         if potion['current_quantity'] < quantity:
             raise HTTPException(status_code=400, detail="Insufficient quantity")
         
         line_total = potion['base_price'] * quantity
         
-        # Lock cart_items row
         conn.execute(
             sqlalchemy.text("""
                 INSERT INTO cart_items (
@@ -1445,59 +2741,116 @@ class CartManager:
                 """),
             {
                 "cart_id": cart_id,
-                "visit_id": visit_id,
-                "potion_id": potion['potion_id'],
-                "time_id": time_id,
-                "quantity": quantity,
-                "price": potion['base_price'],
-                "line_total": line_total
+                "visit_id": visit_id,
+                "potion_id": potion['potion_id'],
+                "time_id": time_id,
+                "quantity": quantity,
+                "price": potion['base_price'],
+                "line_total": line_total
+            }
+        )
+
+    @classmethod
+    def process_checkout(
+        cls,
+        conn,
+        cart_id: int,
+        payment: str,
+        time_id: int,
+        idempotency_key: Optional[str] = None
+    ) -> dict:
+        """
+        Process cart checkout with guarded per-SKU stock decrements.
+        The result is journaled so retries replay it without touching the ledger.
+        """
+        # Replay journaled result if this cart was already processed
+        existing_checkout = cls.get_journaled_checkout(conn, cart_id, idempotency_key)
+        if existing_checkout:
+            logger.info(f"Cart {cart_id} was already processed, returning its result")
+            return existing_checkout
+
+        # Open journal entry; a concurrent checkout of this cart or key blocks here
+        journaled = conn.execute(
+            sqlalchemy.text("""
+                INSERT INTO checkout_journal (
+                    cart_id,
+                    idempotency_key,
+                    status,
+                    payment,
+                    time_id
+                ) VALUES (
+                    :cart_id,
+                    :idempotency_key,
+                    'PENDING',
+                    :payment,
+                    :time_id
+                )
+                ON CONFLICT DO NOTHING
+                RETURNING cart_id
+            """),
+            {
+                "cart_id": cart_id,
+                "idempotency_key": idempotency_key,
+                "payment": payment,
+                "time_id": time_id
             }
-        )
+        ).first()
 
-    @classmethod
-    @with_retry 
-    def process_checkout(cls, conn, cart_id: int, payment: str, time_id: int) -> dict:
-        """Process cart checkout with retry logic and basic concurrency handling."""
-        # Check if this cart was already processed
-        existing_checkout = conn.execute(
+        if journaled is None:
+            existing_checkout = cls.get_journaled_checkout(conn, cart_id, idempotency_key)
+            if existing_checkout:
+                return existing_checkout
+            raise HTTPException(status_code=409, detail="Checkout already in progress")
+
+        # Claim cart; a parallel checkout of the same cart matches no row
+        claimed = conn.execute(
             sqlalchemy.text("""
-                SELECT total_potions, total_gold
-                FROM carts
+                UPDATE carts
+                SET 
+                    checked_out = true,
+                    checked_out_at = CURRENT_TIMESTAMP,
+                    payment = :payment
                 WHERE cart_id = :cart_id
-                AND checked_out = true
+                AND checked_out = false
+                RETURNING cart_id
             """),
-            {"cart_id": cart_id}
-        ).mappings().first()
-
-        if existing_checkout:
-            logger.info(f"Cart {cart_id} was already processed, returning its result")
-            return {
-                "total_potions_bought": existing_checkout['total_potions'],
-                "total_gold_paid": existing_checkout['total_gold']
+            {
+                "payment": payment,
+                "cart_id": cart_id
             }
+        ).first()
 
-        # Lock cart and items in one query
-        cart_items = conn.execute(
-            sqlalchemy.text("""
-                WITH cart_lock AS (
-                    SELECT cart_id, checked_out 
+        if claimed is None:
+            # Cart might have been processed in parallel, get its results
+            result = conn.execute(
+                sqlalchemy.text("""
+                    SELECT total_potions, total_gold 
                     FROM carts 
                     WHERE cart_id = :cart_id
-                    AND checked_out = false
-                    FOR UPDATE
-                )
+                    AND checked_out = true
+                """),
+                {"cart_id": cart_id}
+            ).mappings().first()
+
+            if result:
+                return {
+                    "total_potions_bought": result['total_potions'],
+                    "total_gold_paid": result['total_gold']
+                }
+            raise HTTPException(status_code=400, detail="Cart already processed")
+
+        # Sorted by SKU so concurrent checkouts take potion row locks in the same order
+        cart_items = conn.execute(
+            sqlalchemy.text("""
                 SELECT 
                     ci.potion_id,
                     ci.quantity,
-                    ci.unit_price,
                     ci.line_total,
-                    p.current_quantity,
                     p.sku
                 FROM cart_items ci
                 JOIN potions p ON ci.potion_id = p.potion_id
                 WHERE ci.cart_id = :cart_id
-                ORDER BY ci.potion_id
-                FOR UPDATE OF p
+                ORDER BY p.sku
             """),
             {"cart_id": cart_id}
         ).mappings().all()
@@ -1509,48 +2862,48 @@ class CartManager:
         total_potions = sum(item['quantity'] for item in cart_items)
         total_gold = sum(item['line_total'] for item in cart_items)
 
-        # Check inventory
-        for item in cart_items:
-            if item['current_quantity'] < item['quantity']:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Insufficient quantity for {item['sku']}"
-                )
-
-        # Update inventory and create ledger entries
+        # Guarded decrement per SKU; any miss rolls back the whole checkout
         for item in cart_items:
-            # Update potion inventory
-            conn.execute(
+            decremented = conn.execute(
                 sqlalchemy.text("""
                     UPDATE potions
                     SET current_quantity = current_quantity - :quantity
                     WHERE potion_id = :potion_id
+                    AND current_quantity >= :quantity
+                    RETURNING potion_id
                 """),
                 {
                     "quantity": item['quantity'],
                     "potion_id": item['potion_id']
                 }
-            )
+            ).first()
 
-            # Create ledger entry
-            conn.execute(
-                sqlalchemy.text("""
-                    INSERT INTO ledger_entries (
-                        time_id,
-                        entry_type,
-                        cart_id,
-                        potion_id,
-                        gold_change,
-                        potion_change
-                    ) VALUES (
-                        :time_id,
-                        'POTION_SOLD',
-                        :cart_id,
-                        :potion_id,
-                        :gold_change,
-                        :potion_change
-                    )
-                """),
+            if decremented is None:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Insufficient quantity for {item['sku']}"
+                )
+
+        # Create ledger entries
+        conn.execute(
+            sqlalchemy.text("""
+                INSERT INTO ledger_entries (
+                    time_id,
+                    entry_type,
+                    cart_id,
+                    potion_id,
+                    gold_change,
+                    potion_change
+                ) VALUES (
+                    :time_id,
+                    'POTION_SOLD',
+                    :cart_id,
+                    :potion_id,
+                    :gold_change,
+                    :potion_change
+                )
+            """),
+            [
                 {
                     "time_id": time_id,
                     "cart_id": cart_id,
@@ -1558,106 +2911,272 @@ class CartManager:
                     "gold_change": item['line_total'],
                     "potion_change": -item['quantity']
                 }
-            )
+                for item in cart_items
+            ]
+        )
+        SalesManager.record_sales(conn, time_id, cart_items)
 
-        # Mark cart as checked out 
-        rows_updated = conn.execute(
+        # Record checkout totals on the claimed cart and close the journal entry
+        totals = {
+            "total_potions": total_potions,
+            "total_gold": total_gold,
+            "cart_id": cart_id
+        }
+        conn.execute(
             sqlalchemy.text("""
                 UPDATE carts
                 SET 
-                    checked_out = true,
-                    checked_out_at = CURRENT_TIMESTAMP,
-                    payment = :payment,
                     total_potions = :total_potions,
                     total_gold = :total_gold,
                     purchase_success = true
                 WHERE cart_id = :cart_id
-                AND checked_out = false
-                RETURNING cart_id
             """),
-            {
-                "payment": payment,
-                "total_potions": total_potions,
-                "total_gold": total_gold,
-                "cart_id": cart_id
-            }
-        ).rowcount
+            totals
+        )
+        conn.execute(
+            sqlalchemy.text("""
+                UPDATE checkout_journal
+                SET 
+                    status = 'COMPLETED',
+                    total_potions = :total_potions,
+                    total_gold = :total_gold,
+                    completed_at = CURRENT_TIMESTAMP
+                WHERE cart_id = :cart_id
+            """),
+            totals
+        )
 
-        if rows_updated == 0:
-            # Cart might have been processed in parallel, get its results
-            result = conn.execute(
-                sqlalchemy.text("""
-                    SELECT total_potions, total_gold 
-                    FROM carts 
-                    WHERE cart_id = :cart_id
-                    AND checked_out = true
-                """),
-                {"cart_id": cart_id}
-            ).mappings().first()
+        return {
+            "total_potions_bought": total_potions,
+            "total_gold_paid": total_gold
+        }
 
-            if result:
-                return {
-                    "total_potions_bought": result['total_potions'],
-                    "total_gold_paid": result['total_gold']
+class SalesManager:
+    """Maintains and reads per-tick sales rollups."""
+
+    # Ticks per ledger epoch: seven days of twelve two-hour ticks
+    TICKS_PER_EPOCH = 84
+
+    @staticmethod
+    def record_sales(conn, time_id: int, items: List[dict]) -> None:
+        """
+        Adds sold cart lines to the open epoch's rollup for time_id. Callers
+        pass items in their potion lock order so concurrent upserts agree.
+        """
+        conn.execute(
+            sqlalchemy.text("""
+                INSERT INTO sales_rollup (epoch_id, time_id, potion_id, units_sold, gold)
+                VALUES (
+                    COALESCE((SELECT epoch_id FROM ledger_balances), 1),
+                    :time_id,
+                    :potion_id,
+                    :quantity,
+                    :line_total
+                )
+                ON CONFLICT (epoch_id, time_id, potion_id) DO UPDATE
+                SET
+                    units_sold = sales_rollup.units_sold + EXCLUDED.units_sold,
+                    gold = sales_rollup.gold + EXCLUDED.gold
+            """),
+            [
+                {
+                    "time_id": time_id,
+                    "potion_id": item['potion_id'],
+                    "quantity": item['quantity'],
+                    "line_total": item['line_total']
                 }
-            raise HTTPException(status_code=400, detail="Cart already processed")
+                for item in items
+            ]
+        )
+
+    @classmethod
+    def window_start(cls, epoch_id: int, time_id: int, ticks: int) -> tuple:
+        """Returns the (epoch_id, time_id) of the first tick in a window ending at the given tick."""
+        start = max((epoch_id - 1) * cls.TICKS_PER_EPOCH + time_id - ticks, 0)
+        return start // cls.TICKS_PER_EPOCH + 1, start % cls.TICKS_PER_EPOCH + 1
+
+    @classmethod
+    def get_trailing_sales(cls, conn, time_id: int, ticks: int) -> Dict[int, dict]:
+        """
+        Returns units and gold sold per potion over the last `ticks` ticks up
+        to and including time_id in the open epoch, with units per tick.
+        """
+        start_epoch, start_time = cls.window_start(
+            LedgerManager.get_open_epoch(conn), time_id, ticks
+        )
+        result = conn.execute(
+            sqlalchemy.text("""
+                SELECT
+                    potion_id,
+                    SUM(units_sold) as units_sold,
+                    SUM(gold) as gold
+                FROM sales_rollup
+                WHERE (epoch_id, time_id) >= (:start_epoch, :start_time)
+                GROUP BY potion_id
+            """),
+            {"start_epoch": start_epoch, "start_time": start_time}
+        ).mappings().all()
 
         return {
-            "total_potions_bought": total_potions,
-            "total_gold_paid": total_gold
+            row['potion_id']: {
+                "units_sold": row['units_sold'],
+                "gold": row['gold'],
+                "velocity": row['units_sold'] / ticks
+            }
+            for row in result
+        }
+
+    @staticmethod
+    def get_block_sales(conn, epochs: int) -> List[dict]:
+        """
+        Returns units and gold sold per potion, day and time block over the
+        last `epochs` epochs including the open one.
+        """
+        result = conn.execute(
+            sqlalchemy.text("""
+                SELECT
+                    sr.potion_id,
+                    gt.in_game_day as day,
+                    tb.name as block,
+                    SUM(sr.units_sold) as units_sold,
+                    SUM(sr.gold) as gold
+                FROM sales_rollup sr
+                JOIN game_time gt ON gt.time_id = sr.time_id
+                JOIN time_blocks tb ON gt.in_game_hour BETWEEN tb.start_hour AND tb.end_hour
+                WHERE sr.epoch_id > COALESCE((SELECT epoch_id FROM ledger_balances), 1) - :epochs
+                GROUP BY sr.potion_id, gt.in_game_day, tb.name
+            """),
+            {"epochs": epochs}
+        ).mappings().all()
+
+        return [dict(row) for row in result]
+
+class DemandForecaster:
+    """
+    Exponentially smoothed demand per (potion, day, time block), folded in
+    from sales_rollup one sealed epoch at a time and held in memory. Planners
+    blend its per-block demand shares with the static sales_mix.
+    """
+
+    # Weight of the latest epoch in the smoothed demand
+    SMOOTHING = 0.3
+
+    # Share of the blended mix taken from forecast demand; 0 keeps sales_mix
+    BLEND_WEIGHT = 0.5
+
+    _forecast = {}
+    _through_epoch = 0
+    _generation = None
+    _forecast_lock = threading.Lock()
+
+    @classmethod
+    def get_forecast(cls, conn) -> Dict[tuple, float]:
+        """
+        Gets smoothed units per (potion_id, day, time_block_id), folding in
+        epochs sealed since the last call. An admin reset in any worker
+        drops the forecast, since the sales it was folded from are gone.
+        """
+        open_epoch = LedgerManager.get_open_epoch(conn)
+        generation = LedgerManager.get_reset_generation(conn)
+        with cls._forecast_lock:
+            if cls._generation != generation:
+                cls._forecast, cls._through_epoch, cls._generation = {}, 0, generation
+            if cls._through_epoch == open_epoch - 1:
+                return cls._forecast
+            through_epoch = cls._through_epoch
+
+        rows = conn.execute(
+            sqlalchemy.text("""
+                SELECT
+                    sr.epoch_id,
+                    sr.potion_id,
+                    gt.in_game_day as day,
+                    tb.block_id as time_block_id,
+                    SUM(sr.units_sold) as units_sold
+                FROM sales_rollup sr
+                JOIN game_time gt ON gt.time_id = sr.time_id
+                JOIN time_blocks tb ON gt.in_game_hour BETWEEN tb.start_hour AND tb.end_hour
+                WHERE sr.epoch_id > :through_epoch
+                AND sr.epoch_id < :open_epoch
+                GROUP BY sr.epoch_id, sr.potion_id, gt.in_game_day, tb.block_id
+            """),
+            {"through_epoch": through_epoch, "open_epoch": open_epoch}
+        ).mappings().all()
+
+        observed = {}
+        for row in rows:
+            key = (row['potion_id'], row['day'], row['time_block_id'])
+            observed.setdefault(row['epoch_id'], {})[key] = row['units_sold']
+
+        with cls._forecast_lock:
+            if cls._generation != generation or cls._through_epoch != through_epoch:
+                return cls._forecast
+
+            forecast = dict(cls._forecast)
+            for epoch_id in range(through_epoch + 1, open_epoch):
+                sales = observed.get(epoch_id, {})
+                for key in forecast.keys() | sales.keys():
+                    units = sales.get(key, 0)
+                    if key in forecast:
+                        forecast[key] = cls.SMOOTHING * units + (1 - cls.SMOOTHING) * forecast[key]
+                    else:
+                        forecast[key] = float(units)
+
+            cls._forecast = forecast
+            cls._through_epoch = open_epoch - 1
+            logger.debug(f"Folded demand through epoch {open_epoch - 1}: {len(forecast)} keys")
+            return forecast
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """Drops the in-memory forecast."""
+        with cls._forecast_lock:
+            cls._forecast, cls._through_epoch, cls._generation = {}, 0, None
+
+    @classmethod
+    def blend(cls, conn, priorities: List[dict], day: str, time_block_id: int) -> List[dict]:
+        """
+        Returns priorities with sales_mix moved BLEND_WEIGHT of the way toward
+        each potion's share of forecast demand in the block. Blocks without
+        forecast demand keep their sales_mix.
+        """
+        forecast = cls.get_forecast(conn)
+        demand = {
+            p['potion_id']: forecast.get((p['potion_id'], day, time_block_id), 0.0)
+            for p in priorities
         }
+        total = sum(demand.values())
+        if total <= 0 or cls.BLEND_WEIGHT <= 0:
+            return [dict(p) for p in priorities]
+
+        return [
+            {
+                **p,
+                "sales_mix": (
+                    (1 - cls.BLEND_WEIGHT) * p['sales_mix'] +
+                    cls.BLEND_WEIGHT * demand[p['potion_id']] / total
+                )
+            }
+            for p in priorities
+        ]
 
 class InventoryManager:
     """Handles inventory state and capacity management."""
     
-    MAX_RETRIES = 3
-    RETRY_DELAY = 0.1
-
-    @staticmethod
-    def with_retry(func):
-        """Decorator to retry database operations on failure."""
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(InventoryManager.MAX_RETRIES):
-                try:
-                    return func(*args, **kwargs)
-                except OperationalError as e:
-                    last_error = e
-                    if attempt < InventoryManager.MAX_RETRIES - 1:
-                        logger.warning(
-                            f"Retry {attempt + 1}/{InventoryManager.MAX_RETRIES} "
-                            f"for capacity upgrade: {str(e)}"
-                        )
-                        time.sleep(InventoryManager.RETRY_DELAY)
-                        continue
-                    logger.error(f"All retries failed: {str(last_error)}")
-                    raise
-            return None
-        return wrapper
-
     @staticmethod
     def get_inventory_state(conn) -> dict:
-        """Get current inventory state from ledger."""
+        """Get current inventory state from the last ledger checkpoint and open epoch."""
         result = conn.execute(
             sqlalchemy.text("""
-                WITH ledger_totals AS (
-                    SELECT
-                        COALESCE(SUM(gold_change), 0) as gold,
-                        COALESCE(SUM(ml_change), 0) as total_ml,
-                        COALESCE(SUM(potion_change), 0) as total_potions,
-                        COALESCE(SUM(ml_capacity_change), 0) as ml_capacity_units,
-                        COALESCE(SUM(potion_capacity_change), 0) as potion_capacity_units
-                    FROM ledger_entries
-                )
                 SELECT
                     gold,
                     total_ml,
                     total_potions,
                     ml_capacity_units,
                     potion_capacity_units,
-                    (potion_capacity_units * 50) as max_potions,
-                    (ml_capacity_units * 10000) as max_ml
-                FROM ledger_totals
+                    max_potions,
+                    max_ml
+                FROM current_state
             """)
         ).mappings().one()
         
@@ -1725,27 +3244,12 @@ class InventoryManager:
         }
     
     @classmethod
-    @with_retry
     def process_capacity_upgrade(cls, conn, potion_capacity: int, ml_capacity: int, time_id: int) -> None:
         """Process capacity upgrade with ledger entries and strategy transition."""
         total_cost = (potion_capacity + ml_capacity) * 1000
         
-        # Lock ledger entries first and get current state
-        current_state = conn.execute(
-            sqlalchemy.text("""
-                WITH locked_ledger AS (
-                    SELECT entry_id, gold_change, ml_change,
-                        ml_capacity_change, potion_capacity_change
-                    FROM ledger_entries
-                    FOR UPDATE
-                )
-                SELECT
-                    COALESCE(SUM(gold_change), 0) as gold,
-                    COALESCE(SUM(ml_capacity_change), 0) as ml_capacity_units,
-                    COALESCE(SUM(potion_capacity_change), 0) as potion_capacity_units
-                FROM locked_ledger
-            """)
-        ).mappings().one()
+        # Lock out other spenders and check funds
+        current_state = LedgerManager.lock_state(conn)
         
         if current_state['gold'] < total_cost:
             raise HTTPException(
@@ -1778,68 +3282,140 @@ class InventoryManager:
             }
         )
         
-        # Calculate new totals and check for strategy transition
-        new_units = {
-            'ml_capacity_units': current_state['ml_capacity_units'] + ml_capacity,
-            'potion_capacity_units': current_state['potion_capacity_units'] + potion_capacity
-        }
-        
-        # Lock and check current strategy in one atomic operation
-        current_strategy = conn.execute(
-            sqlalchemy.text("""
-                WITH current_strategy AS (
-                    SELECT 
-                        ast.strategy_id,
-                        s.name as strategy_name
-                    FROM active_strategy ast
-                    JOIN strategies s ON ast.strategy_id = s.strategy_id
-                    WHERE ast.activated_at = (
-                        SELECT MAX(activated_at)
-                        FROM active_strategy
-                    )
-                    FOR UPDATE
-                )
-                SELECT 
-                    cs.strategy_id,
-                    cs.strategy_name,
-                    st.to_strategy_id
-                FROM current_strategy cs
-                LEFT JOIN strategy_transitions st ON cs.strategy_id = st.from_strategy_id
-                WHERE cs.strategy_name != 'DYNAMIC'
-            """)
-        ).mappings().first()
-        
-        if current_strategy:
-            should_transition = False
-            new_strategy_id = None
-            
-            if (current_strategy['strategy_name'] == 'PENETRATION' and
-                new_units['ml_capacity_units'] >= 2 and
-                new_units['potion_capacity_units'] >= 2):
-                should_transition = True
-                new_strategy_id = current_strategy['to_strategy_id']
-                
-            elif (current_strategy['strategy_name'] == 'TIERED' and
-                new_units['ml_capacity_units'] >= 4 and
-                new_units['potion_capacity_units'] >= 4):
-                should_transition = True
-                new_strategy_id = current_strategy['to_strategy_id']
-                
-            if should_transition:
-                conn.execute(
-                    sqlalchemy.text("""
-                        INSERT INTO active_strategy (
-                            strategy_id,
-                            game_time_id
-                        ) VALUES (
-                            :strategy_id,
-                            :time_id
-                        )
-                    """),
-                    {
-                        "strategy_id": new_strategy_id,
-                        "time_id": time_id
-                    }
-                )
-                
-                logger.info(f"Upgraded to strategy_id: {new_strategy_id}")
+        # Check for strategy transition against the upgraded capacity
+        new_strategy_id = TransitionEngine.evaluate(
+            conn,
+            time_id,
+            {
+                **current_state,
+                "gold": current_state['gold'] - total_cost,
+                "ml_capacity_units": current_state['ml_capacity_units'] + ml_capacity,
+                "potion_capacity_units": current_state['potion_capacity_units'] + potion_capacity
+            }
+        )
+        if new_strategy_id is not None:
+            logger.info(f"Upgraded to strategy_id: {new_strategy_id}")
+
+class ExportManager:
+    """Streams ledger and order history for reconciliation as NDJSON or CSV."""
+
+    MEDIA_TYPES = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv'
+    }
+
+    # Rows fetched per server-side cursor round trip and emitted per chunk
+    CHUNK_ROWS = 1000
+
+    LEDGER_QUERY = """
+        SELECT
+            entry_id,
+            epoch_id,
+            time_id,
+            entry_type,
+            barrel_purchase_id,
+            cart_id,
+            potion_id,
+            color_id,
+            gold_change,
+            ml_change,
+            potion_change,
+            ml_capacity_change,
+            potion_capacity_change,
+            created_at
+        FROM ledger_entries
+        WHERE (:from_time_id IS NULL OR time_id >= :from_time_id)
+        AND (:to_time_id IS NULL OR time_id <= :to_time_id)
+        ORDER BY epoch_id, entry_id
+    """
+
+    # One row per order line: checked out cart items and barrel purchases
+    ORDERS_QUERY = """
+        SELECT *
+        FROM (
+            SELECT
+                'CART' as order_type,
+                c.cart_id as order_id,
+                c.visit_id,
+                c.time_id,
+                p.sku,
+                ci.quantity,
+                ci.unit_price,
+                ci.line_total as total,
+                c.payment,
+                c.purchase_success,
+                c.checked_out_at as created_at
+            FROM carts c
+            JOIN cart_items ci ON ci.cart_id = c.cart_id
+            JOIN potions p ON p.potion_id = ci.potion_id
+            WHERE c.checked_out = TRUE
+            UNION ALL
+            SELECT
+                'BARREL' as order_type,
+                bp.purchase_id as order_id,
+                bp.visit_id,
+                bp.time_id,
+                bd.sku,
+                bp.quantity,
+                bd.price as unit_price,
+                bp.total_cost as total,
+                NULL as payment,
+                bp.purchase_success,
+                bp.created_at
+            FROM barrel_purchases bp
+            JOIN barrel_details bd ON bd.barrel_id = bp.barrel_id
+        ) orders
+        WHERE (:from_time_id IS NULL OR time_id >= :from_time_id)
+        AND (:to_time_id IS NULL OR time_id <= :to_time_id)
+        ORDER BY time_id, order_type, order_id
+    """
+
+    @staticmethod
+    def format_ndjson(columns: List[str], rows) -> str:
+        """Formats rows as newline-delimited JSON objects."""
+        return "".join(
+            json.dumps(dict(zip(columns, row)), default=str) + "\n"
+            for row in rows
+        )
+
+    @staticmethod
+    def format_csv(rows) -> str:
+        """Formats rows as CSV lines."""
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue()
+
+    @classmethod
+    def stream(
+        cls,
+        conn,
+        query: str,
+        export_format: str,
+        from_time_id: Optional[int] = None,
+        to_time_id: Optional[int] = None
+    ) -> Iterator[str]:
+        """
+        Yields query results as formatted chunks of CHUNK_ROWS rows, reading
+        through a server-side cursor so memory stays flat for any history size.
+        """
+        result = conn.execution_options(
+            stream_results=True,
+            yield_per=cls.CHUNK_ROWS
+        ).execute(
+            sqlalchemy.text(query),
+            {"from_time_id": from_time_id, "to_time_id": to_time_id}
+        )
+        columns = list(result.keys())
+
+        if export_format == 'csv':
+            yield cls.format_csv([columns])
+
+        rows = 0
+        for partition in result.partitions():
+            rows += len(partition)
+            if export_format == 'csv':
+                yield cls.format_csv(partition)
+            else:
+                yield cls.format_ndjson(columns, partition)
+
+        logger.info(f"Exported {rows} rows as {export_format}")
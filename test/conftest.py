@@ -2,20 +2,19 @@ import os
 os.environ['TESTING'] = 'true'
 
 import pytest
-from pathlib import Path
+from src.database import dispose_engine
 from src.logging_config import logging_manager
 
 @pytest.fixture(scope="session", autouse=True)
 def test_environment():
     """Ensure we're in test environment"""
     yield
+    dispose_engine()
     os.environ.pop('TESTING', None)
 
 @pytest.fixture(scope="session", autouse=True)
 def test_logs_setup():
-    """Setup and cleanup test logs directory at session level"""
-    test_dir = Path(__file__).parent / "test_logs"
-    test_dir.mkdir(parents=True, exist_ok=True)
+    """Setup and cleanup this worker's test logs directory at session level"""
     logging_manager.cleanup_test_directory()
     yield
 
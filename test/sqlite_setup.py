@@ -1,10 +1,15 @@
 import sqlalchemy
 from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
 from pathlib import Path
+import hashlib
+import json
+import os
 import re
 import sqlite3
 from datetime import datetime, timezone
 from src.database import get_engine
+from src.utilities import CartManager, DemandForecaster, StrategyManager, TransitionEngine
 
 # SQLite Configuration Functions
 def get_test_db_url() -> str:
@@ -72,18 +77,26 @@ def convert_postgres_to_sqlite(sql: str) -> str:
         "DECIMAL(10,2)": "REAL",
         "INTERVAL": "TEXT",
         "JSONB": "TEXT",
+        "BYTEA": "BLOB",
         "BIGINT": "INTEGER",
         
         # Functions and keywords
         "NOW()": "CURRENT_TIMESTAMP",
         "true": "1",
         "false": "0",
+        # Identity and sequence keys become rowid aliases
+        "INT GENERATED ALWAYS AS IDENTITY": "INTEGER PRIMARY KEY AUTOINCREMENT",
         "GENERATED ALWAYS AS IDENTITY": "",
+        "INT NOT NULL DEFAULT nextval('ledger_entry_id_seq')": "INTEGER PRIMARY KEY AUTOINCREMENT",
         " CASCADE": "",
         " USING btree": "",
         "DEFERRABLE": "",
         "INITIALLY DEFERRED": "",
         
+        # Ledger epochs are assigned by trigger instead of a column default
+        "NOT NULL DEFAULT ledger_open_epoch()": "",
+        " PARTITION BY LIST (epoch_id)": "",
+        
         # Timestamp handling
         "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP": 
             "TIMESTAMP NOT NULL DEFAULT (STRFTIME('%s', 'NOW'))",
@@ -96,6 +109,15 @@ def convert_postgres_to_sqlite(sql: str) -> str:
         sql = sql.replace(pg_syntax, sqlite_syntax)
     
     # Handle regex patterns
+    # A rowid alias key leaves the partition-keyed primary key as a unique constraint
+    sql = re.sub(
+        r"(PRIMARY KEY AUTOINCREMENT.*), PRIMARY KEY \(([^)]*)\)",
+        r"\1, UNIQUE (\2)",
+        sql,
+        flags=re.DOTALL
+    )
+    # Covering index columns are PostgreSQL-only
+    sql = re.sub(r"\s+INCLUDE\s*\([^)]*\)", "", sql)
     sql = re.sub(
         r"CHECK\s*\(\s*sku\s*~\s*'\^([^']+)\$'\s*\)",
         r"CHECK (sku REGEXP '\1')",
@@ -181,6 +203,7 @@ def validate_create_table(statement: str) -> str:
                 strategy_id INT REFERENCES strategies(strategy_id),
                 activated_at TIMESTAMP DEFAULT (STRFTIME('%s', 'NOW')),
                 game_time_id INT REFERENCES game_time(time_id),
+                tick_id INT REFERENCES current_game_time(id),
                 UNIQUE(strategy_id, game_time_id)
             );
         """,
@@ -210,6 +233,68 @@ def validate_create_table(statement: str) -> str:
     
     return statement
 
+# Trigger Handling
+SQLITE_TRIGGERS = {
+    'trg_active_strategy_pointer': """
+        CREATE TRIGGER trg_active_strategy_pointer
+        AFTER INSERT ON active_strategy
+        BEGIN
+            INSERT INTO current_strategy (
+                singleton, active_strategy_id, strategy_id, game_time_id, tick_id, activated_at
+            ) VALUES (
+                1, NEW.active_strategy_id, NEW.strategy_id, NEW.game_time_id, NEW.tick_id, NEW.activated_at
+            )
+            ON CONFLICT (singleton) DO UPDATE SET
+                active_strategy_id = excluded.active_strategy_id,
+                strategy_id = excluded.strategy_id,
+                game_time_id = excluded.game_time_id,
+                tick_id = excluded.tick_id,
+                activated_at = excluded.activated_at;
+        END;
+    """,
+    'trg_ledger_entries_write': """
+        CREATE TRIGGER trg_ledger_entries_write
+        INSTEAD OF INSERT ON ledger_entries
+        BEGIN
+            INSERT INTO ledger_transactions (
+                epoch_id, time_id, entry_type, barrel_purchase_id, cart_id, potion_id
+            ) VALUES (
+                COALESCE((SELECT epoch_id FROM ledger_balances), 1),
+                NEW.time_id, NEW.entry_type, NEW.barrel_purchase_id, NEW.cart_id, NEW.potion_id
+            );
+            INSERT INTO ledger_gold (entry_id, epoch_id, time_id, gold_change)
+            SELECT entry_id, epoch_id, time_id, NEW.gold_change
+            FROM ledger_transactions
+            WHERE entry_id = (SELECT MAX(entry_id) FROM ledger_transactions)
+            AND NEW.gold_change IS NOT NULL;
+            INSERT INTO ledger_ml (entry_id, epoch_id, time_id, color_id, ml_change)
+            SELECT entry_id, epoch_id, time_id, NEW.color_id, NEW.ml_change
+            FROM ledger_transactions
+            WHERE entry_id = (SELECT MAX(entry_id) FROM ledger_transactions)
+            AND NEW.ml_change IS NOT NULL;
+            INSERT INTO ledger_potions (entry_id, epoch_id, time_id, potion_id, potion_change)
+            SELECT entry_id, epoch_id, time_id, NEW.potion_id, NEW.potion_change
+            FROM ledger_transactions
+            WHERE entry_id = (SELECT MAX(entry_id) FROM ledger_transactions)
+            AND NEW.potion_change IS NOT NULL;
+            INSERT INTO ledger_capacity (
+                entry_id, epoch_id, time_id, ml_capacity_change, potion_capacity_change
+            )
+            SELECT entry_id, epoch_id, time_id, NEW.ml_capacity_change, NEW.potion_capacity_change
+            FROM ledger_transactions
+            WHERE entry_id = (SELECT MAX(entry_id) FROM ledger_transactions)
+            AND (NEW.ml_capacity_change IS NOT NULL OR NEW.potion_capacity_change IS NOT NULL);
+        END;
+    """
+}
+
+def convert_trigger(statement: str) -> str:
+    """Replace PL/pgSQL-backed trigger with its SQLite equivalent."""
+    match = re.match(r'CREATE TRIGGER (\w+)', statement, re.IGNORECASE)
+    if not match or match.group(1) not in SQLITE_TRIGGERS:
+        raise ValueError(f"No SQLite equivalent for trigger: {statement}")
+    return re.sub(r'\s+', ' ', SQLITE_TRIGGERS[match.group(1)].strip())
+
 # Statement Processing
 def split_sql_statements(sql: str) -> list:
     """Split SQL content into individual statements."""
@@ -217,109 +302,201 @@ def split_sql_statements(sql: str) -> list:
     sql = re.sub(r'--.*$', '', sql, flags=re.MULTILINE)
     sql = re.sub(r'/\*.*?\*/', '', sql, flags=re.DOTALL)
     
-    # Split the statements
+    # Split the statements, keeping $$-quoted function bodies intact
     statements = []
     current_statement = ''
+    in_dollar_quote = False
     for line in sql.split('\n'):
         line = line.strip()
         if not line:
             continue
         current_statement += ' ' + line
-        if line.endswith(';'):
+        if line.count('$$') % 2 == 1:
+            in_dollar_quote = not in_dollar_quote
+        if line.endswith(';') and not in_dollar_quote:
             statements.append(current_statement.strip())
             current_statement = ''
     if current_statement.strip():
         statements.append(current_statement.strip())
     return statements
 
+# Converted Schema Cache
+SCHEMA_CACHE_DIR = Path(__file__).parent / ".schema_cache"
+_converted_schema_cache = {}
+_template_engine = None
+
+def get_source_sql_paths() -> tuple:
+    """Get paths of the PostgreSQL schema and seed files."""
+    project_root = Path(__file__).parent.parent
+    schema_path = project_root / "schema.sql"
+    insert_path = project_root / "block_potion_priorities_insert.sql"
+    
+    if not all(p.exists() for p in [schema_path, insert_path]):
+        raise FileNotFoundError("Required SQL files not found")
+    
+    return schema_path, insert_path
+
+def schema_content_hash(schema_sql: str, insert_sql: str, converter_source: str = None) -> str:
+    """
+    Hash source SQL and this converter's own source, so converted statements
+    are rebuilt when either the SQL or the conversion rules change.
+    """
+    if converter_source is None:
+        converter_source = Path(__file__).read_text()
+
+    digest = hashlib.sha256()
+    for part in (schema_sql, insert_sql, converter_source):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def convert_schema(schema_sql: str, insert_sql: str) -> dict:
+    """Convert schema and seed SQL into ordered SQLite statement groups."""
+    # Split statements
+    all_statements = split_sql_statements(schema_sql)
+    
+    # Convert statements
+    converted_statements = [convert_postgres_to_sqlite(stmt) for stmt in all_statements]
+    
+    # Categorize statements
+    drop_statements = []
+    create_statements = []
+    other_statements = []
+    for stmt in converted_statements:
+        if re.match(r'(CREATE OR REPLACE|DROP) FUNCTION', stmt, re.IGNORECASE):
+            # PL/pgSQL functions are replaced by SQLite trigger bodies
+            continue
+        elif re.match(r'(CREATE|DROP) SEQUENCE', stmt, re.IGNORECASE):
+            # Sequence-backed keys become rowid aliases
+            continue
+        elif re.match(r'CREATE TABLE \w+ PARTITION OF', stmt, re.IGNORECASE):
+            # SQLite has no partitions; rows stay in the parent table
+            continue
+        elif stmt.upper().startswith('CREATE TRIGGER'):
+            other_statements.append(convert_trigger(stmt))
+        elif stmt.upper().startswith('DROP TABLE'):
+            drop_statements.append(stmt)
+        elif stmt.upper().startswith('CREATE TABLE'):
+            create_statements.append(validate_create_table(stmt))
+        else:
+            other_statements.append(stmt)
+    
+    # Reorder drop statements based on dependencies
+    table_order = [
+        'ledger_balances',
+        'ledger_checkpoints',
+        'ledger_snapshots',
+        'ledger_gold',
+        'ledger_ml',
+        'ledger_potions',
+        'ledger_capacity',
+        'ledger_transactions',
+        'checkout_journal',
+        'processed_orders',
+        'sales_rollup',
+        'cart_items',
+        'carts',
+        'customers',
+        'customer_identities',
+        'customer_visits',
+        'block_potion_priorities',
+        'barrel_purchases',
+        'barrel_details',
+        'barrel_visits',
+        'current_strategy',
+        'active_strategy',
+        'strategy_time_blocks',
+        'strategy_transitions',
+        'potions',
+        'strategies',
+        'current_game_time',
+        'game_time',
+        'color_definitions',
+        'time_blocks',
+        'capacity_upgrade_thresholds'
+    ]
+    
+    ordered_drops = []
+    for table in table_order:
+        pattern = re.compile(rf'DROP TABLE IF EXISTS {table}\b', re.IGNORECASE)
+        drop_stmt = next((stmt for stmt in drop_statements if pattern.search(stmt)), None)
+        if drop_stmt:
+            ordered_drops.append(drop_stmt)
+    
+    # Add any remaining drops
+    remaining_drops = [stmt for stmt in drop_statements if stmt not in ordered_drops]
+    ordered_drops.extend(remaining_drops)
+    
+    # Convert seed inserts
+    sqlite_inserts = convert_postgres_to_sqlite(insert_sql)
+    insert_statements = [
+        clean_statement(stmt) for stmt in split_sql_statements(sqlite_inserts)
+    ]
+    
+    return {
+        "drops": ordered_drops,
+        "creates": create_statements,
+        "others": other_statements,
+        "inserts": insert_statements
+    }
+
+def load_converted_schema() -> dict:
+    """Load converted statements from cache, converting only on source change."""
+    schema_path, insert_path = get_source_sql_paths()
+    schema_sql = schema_path.read_text()
+    insert_sql = insert_path.read_text()
+    content_hash = schema_content_hash(schema_sql, insert_sql)
+    
+    # Check in-process cache
+    if content_hash in _converted_schema_cache:
+        return _converted_schema_cache[content_hash]
+    
+    # Check on-disk cache
+    cache_file = SCHEMA_CACHE_DIR / f"{content_hash}.json"
+    converted = None
+    if cache_file.exists():
+        try:
+            converted = json.loads(cache_file.read_text())
+        except (OSError, ValueError):
+            converted = None
+    
+    if converted is None:
+        converted = convert_schema(schema_sql, insert_sql)
+        try:
+            SCHEMA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            tmp_file.write_text(json.dumps(converted))
+            tmp_file.replace(cache_file)
+        except OSError as e:
+            print(f"Could not write schema cache: {str(e)}")
+    
+    _converted_schema_cache[content_hash] = converted
+    return converted
+
 # Database Setup
 def setup_test_db(engine):
     """Initialize test database with schema and test data."""
     try:
-        # Load SQL files
-        project_root = Path(__file__).parent.parent
-        schema_path = project_root / "schema.sql"
-        insert_path = project_root / "block_potion_priorities_insert.sql"
-        
-        if not all(p.exists() for p in [schema_path, insert_path]):
-            raise FileNotFoundError("Required SQL files not found")
-            
-        # Read schema
-        with open(schema_path) as f:
-            schema_sql = f.read()
-        
-        # Split statements
-        all_statements = split_sql_statements(schema_sql)
-        
-        # Convert statements
-        converted_statements = [convert_postgres_to_sqlite(stmt) for stmt in all_statements]
-        
-        # Categorize statements
-        drop_statements = []
-        create_statements = []
-        other_statements = []
-        for stmt in converted_statements:
-            if stmt.upper().startswith('DROP TABLE'):
-                drop_statements.append(stmt)
-            elif stmt.upper().startswith('CREATE TABLE'):
-                create_statements.append(stmt)
-            else:
-                other_statements.append(stmt)
-        
-        # Reorder drop statements based on dependencies
-        table_order = [
-            'ledger_entries',
-            'cart_items',
-            'carts',
-            'customers',
-            'customer_visits',
-            'block_potion_priorities',
-            'barrel_purchases',
-            'barrel_details',
-            'barrel_visits',
-            'active_strategy',
-            'strategy_time_blocks',
-            'strategy_transitions',
-            'potions',
-            'strategies',
-            'current_game_time',
-            'game_time',
-            'color_definitions',
-            'time_blocks',
-            'capacity_upgrade_thresholds'
-        ]
-        
-        ordered_drops = []
-        for table in table_order:
-            pattern = re.compile(rf'DROP TABLE IF EXISTS {table}\b', re.IGNORECASE)
-            drop_stmt = next((stmt for stmt in drop_statements if pattern.search(stmt)), None)
-            if drop_stmt:
-                ordered_drops.append(drop_stmt)
-        
-        # Add any remaining drops
-        remaining_drops = [stmt for stmt in drop_statements if stmt not in ordered_drops]
-        ordered_drops.extend(remaining_drops)
+        converted = load_converted_schema()
         
         # Execute statements
         with engine.begin() as conn:
             # Execute drops
-            for statement in ordered_drops:
+            for statement in converted["drops"]:
                 try:
                     conn.execute(sqlalchemy.text(statement))
                 except Exception as e:
                     print(f"Error executing drop statement: {statement}")
                     raise
             # Execute creates
-            for statement in create_statements:
+            for statement in converted["creates"]:
                 try:
-                    if statement.upper().startswith('CREATE TABLE'):
-                        statement = validate_create_table(statement)
                     conn.execute(sqlalchemy.text(statement))
                 except Exception as e:
                     print(f"Error executing create statement: {statement}")
                     raise
             # Execute others
-            for statement in other_statements:
+            for statement in converted["others"]:
                 try:
                     conn.execute(sqlalchemy.text(statement))
                 except Exception as e:
@@ -327,10 +504,6 @@ def setup_test_db(engine):
                     raise
         
         # Process inserts
-        with open(insert_path) as f:
-            insert_sql = f.read()
-        sqlite_inserts = convert_postgres_to_sqlite(insert_sql)
-        insert_statements = split_sql_statements(sqlite_inserts)
         with engine.begin() as conn:
             # Check if game_time already has data
             result = conn.execute(sqlalchemy.text(
@@ -456,9 +629,9 @@ def setup_test_db(engine):
                     WHERE time_id = 1
                 """))
 
-            for statement in insert_statements:
+            for statement in converted["inserts"]:
                 try:
-                    conn.execute(sqlalchemy.text(clean_statement(statement)))
+                    conn.execute(sqlalchemy.text(statement))
                 except Exception as e:
                     print(f"Error executing insert statement: {statement}")
                     raise
@@ -466,6 +639,30 @@ def setup_test_db(engine):
         print(f"Database setup failed: {str(e)}")
         raise
 
+def get_template_engine():
+    """Get seeded template database, building it once per test session."""
+    global _template_engine
+    if _template_engine is None:
+        engine = create_engine(
+            get_test_db_url(),
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool
+        )
+        event.listen(engine, 'connect', set_sqlite_pragma)
+        setup_test_db(engine)
+        _template_engine = engine
+    return _template_engine
+
+def clone_template_db(engine):
+    """Copy seeded template database into engine using SQLite backup API."""
+    source = get_template_engine().raw_connection()
+    target = engine.raw_connection()
+    try:
+        source.driver_connection.backup(target.driver_connection)
+    finally:
+        target.close()
+        source.close()
+
 def create_test_db():
     """Create and configure SQLite test database."""
     # Register timestamp converter
@@ -475,8 +672,15 @@ def create_test_db():
     engine = get_engine()
     
     # Configure pragmas
-    event.listen(engine, 'connect', set_sqlite_pragma)
+    if not event.contains(engine, 'connect', set_sqlite_pragma):
+        event.listen(engine, 'connect', set_sqlite_pragma)
     
-    # Initialize database
-    setup_test_db(engine)
-    return engine
\ No newline at end of file
+    # Initialize database from seeded template
+    clone_template_db(engine)
+
+    # Fresh database may hold a different active strategy, rules and visits
+    StrategyManager.invalidate_cache()
+    TransitionEngine.invalidate_rules()
+    DemandForecaster.invalidate()
+    CartManager.clear_visit_index()
+    return engine
@@ -0,0 +1,108 @@
+import pytest
+import sqlalchemy
+from src.analytics import AnalyticsStore
+from test.sqlite_setup import create_test_db
+
+duckdb = pytest.importorskip("duckdb")
+
+class TestAnalyticsStore:
+    """Test incremental sync into the local analytics store and its reports"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger, tmp_path):
+        """Setup test database with a barrel purchase, a bottling and a sale"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+        self.store = AnalyticsStore(str(tmp_path / "analytics.duckdb"))
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change, ml_change, color_id)
+                VALUES (2, 'BARREL_PURCHASE', -100, 500, 2)
+            """))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, ml_change, color_id)
+                VALUES (3, 'POTION_BOTTLED', -200, 2)
+            """))
+            potion_id = conn.execute(sqlalchemy.text(
+                "SELECT potion_id FROM potions ORDER BY potion_id LIMIT 1"
+            )).scalar_one()
+            cart_id = conn.execute(sqlalchemy.text("""
+                INSERT INTO carts (visit_id, time_id, checked_out, checked_out_at)
+                VALUES (1, 4, TRUE, CURRENT_TIMESTAMP)
+                RETURNING cart_id
+            """)).scalar_one()
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO cart_items (cart_id, visit_id, potion_id, time_id, quantity, unit_price, line_total)
+                VALUES (:cart_id, 1, :potion_id, 4, 2, 30, 60)
+            """), {"cart_id": cart_id, "potion_id": potion_id})
+            self.sell(conn, cart_id, potion_id)
+
+    def sell(self, conn, cart_id, potion_id):
+        """Write the POTION_SOLD entry for a cart line at time_id 4"""
+        conn.execute(sqlalchemy.text("""
+            INSERT INTO ledger_entries (time_id, entry_type, cart_id, potion_id, gold_change, potion_change)
+            VALUES (4, 'POTION_SOLD', :cart_id, :potion_id, 60, -2)
+        """), {"cart_id": cart_id, "potion_id": potion_id})
+
+    def sync(self):
+        """Sync the store from the test database"""
+        with self.engine.connect() as conn:
+            return self.store.sync(conn)
+
+    def test_sync_is_incremental(self):
+        """Test repeated syncs only append rows past the high-water mark"""
+        first = self.sync()
+        second = self.sync()
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change)
+                VALUES (5, 'GOLD_CHANGE', 5)
+            """))
+        third = self.sync()
+
+        self.logger.info(f"Syncs: {first}, {second}, {third}")
+        assert first == {'ledger_entries': 4, 'cart_items': 1, 'barrel_purchases': 0}
+        assert second == {'ledger_entries': 0, 'cart_items': 0, 'barrel_purchases': 0}
+        assert third['ledger_entries'] == 1
+        assert self.store.get_marks()['ledger_entries'] == 5
+
+    def test_reread_recovers_late_rows(self):
+        """Test rows below the mark missing from the store are picked up again"""
+        self.sync()
+        duck = self.store.connect()
+        duck.execute("DELETE FROM ledger_entries WHERE entry_id = 2")
+        duck.close()
+
+        assert self.sync()['ledger_entries'] == 1
+
+    def test_reread_window_by_age(self):
+        """Test rows below the mark are re-read by creation time, not id distance"""
+        self.sync()
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(
+                "UPDATE ledger_transactions SET created_at = created_at - 3600 WHERE entry_id = 2"
+            ))
+        duck = self.store.connect()
+        duck.execute("DELETE FROM ledger_entries WHERE entry_id IN (2, 3)")
+        duck.close()
+
+        assert self.sync()['ledger_entries'] == 1
+        assert [row['entry_id'] for row in self.store.query(
+            "SELECT entry_id FROM ledger_entries WHERE entry_id IN (2, 3)"
+        )] == [3]
+
+    def test_reports(self):
+        """Test profit, sales and ml reports over synced rows"""
+        self.sync()
+
+        profit = self.store.profit_per_tick()
+        sales = self.store.sales_per_block()
+        ml = {row['color']: row for row in self.store.ml_usage()}
+
+        self.logger.info(f"Profit: {profit}, sales: {sales}, ml: {ml}")
+        assert [(row['time_id'], row['profit']) for row in profit] == [(1, 100), (2, -100), (4, 60)]
+        assert [(row['block'], row['potions_sold'], row['gold']) for row in sales] == [('MORNING', 2, 60)]
+        assert ml['RED']['ml_bought'] == 500
+        assert ml['RED']['ml_bottled'] == 200
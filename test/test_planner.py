@@ -0,0 +1,353 @@
+import random
+import time
+import pytest
+import sqlalchemy
+from src.utilities import BarrelCatalog, BarrelManager, JointPlanner, RequestContext
+from test.sqlite_setup import create_test_db
+
+COLORS = ('RED', 'GREEN', 'BLUE', 'DARK')
+
+def make_catalog(quantity: int = 10) -> list:
+    """Build a wholesale catalog with every size and color"""
+    sizes = (('SMALL', 500, 100), ('MEDIUM', 2500, 250), ('LARGE', 10000, 750))
+    return [
+        {
+            "sku": f"{size}_{color}_BARREL",
+            "ml_per_barrel": ml,
+            "potion_type": [int(color == c) for c in COLORS],
+            "price": price,
+            "quantity": quantity
+        }
+        for size, ml, price in sizes
+        for color in COLORS
+    ]
+
+def expired_clock():
+    """Monotonic clock that starts at zero and has passed any deadline after its first reading"""
+    readings = iter([0.0])
+    return lambda: next(readings, float('inf'))
+
+def plan_ml(plan: list, catalog: list, current_ml: dict) -> dict:
+    """ML per color on hand after a plan's barrels arrive"""
+    ml_per_barrel = {b['sku']: b['ml_per_barrel'] for b in catalog}
+    ml = dict(current_ml)
+    for purchase in plan:
+        color = next(c for c in COLORS if c in purchase['sku'])
+        ml[color] += purchase['quantity'] * ml_per_barrel[purchase['sku']]
+    return ml
+
+def greedy_plan(catalog, horizon_needs, current_ml, gold, capacity, strategy) -> list:
+    """Single-block greedy plan for the arrival block only"""
+    color_needs = {
+        color: need - current_ml[color]
+        for color, need in horizon_needs[0].items()
+        if need > current_ml[color]
+    }
+    return BarrelManager.calculate_purchase_quantities(
+        catalog, color_needs, gold, capacity, strategy
+    )
+
+def substring_filter(barrels: list, strategy: str) -> list:
+    """Strategy filter by sku substring checks, as planners used to scan"""
+    valid = [b for b in barrels if not b['sku'].startswith('MINI')]
+    sizes = {'PREMIUM': ('SMALL',), 'PENETRATION': ('MEDIUM', 'SMALL')}.get(strategy, ('LARGE', 'MEDIUM'))
+    return [b for size in sizes for b in valid if size in b['sku']]
+
+class TestBarrelCatalog:
+    """Test the parsed wholesale catalog"""
+
+    def test_parses_columns(self):
+        """Test size, color and ml per gold are parsed once from each barrel"""
+        catalog = BarrelCatalog(make_catalog())
+
+        i = catalog.sku.index('MEDIUM_BLUE_BARREL')
+        assert (catalog.size[i], catalog.color[i], catalog.ml[i], catalog.price[i]) == ('MEDIUM', 'BLUE', 2500, 250)
+        assert catalog.ml_per_gold[i] == 10
+
+    def test_filter_matches_substring_scan(self):
+        """Test strategy filters keep the sku scan's barrels and order, dropping MINI barrels"""
+        barrels = make_catalog() + [
+            {"sku": "MINI_RED_BARREL", "ml_per_barrel": 200, "potion_type": [1, 0, 0, 0], "price": 60, "quantity": 1}
+        ]
+        random.Random(50).shuffle(barrels)
+        catalog = BarrelCatalog(barrels)
+
+        for strategy in ('PREMIUM', 'PENETRATION', 'TIERED'):
+            assert catalog.filter(strategy) == substring_filter(barrels, strategy)
+            assert BarrelManager.filter_barrels_by_strategy(barrels, strategy) == substring_filter(barrels, strategy)
+            for color in COLORS:
+                assert catalog.filter(strategy, color) == [
+                    b for b in substring_filter(barrels, strategy) if color in b['sku']
+                ]
+
+    def test_ranked_selection(self):
+        """Test ranked selections order by ml per gold and are reused"""
+        catalog = BarrelCatalog(make_catalog())
+
+        ranked = catalog.select('TIERED', 'RED', ranked=True)
+        assert [catalog.sku[i] for i in ranked] == ['LARGE_RED_BARREL', 'MEDIUM_RED_BARREL']
+        assert catalog.select('TIERED', 'RED', ranked=True) is ranked
+        assert BarrelCatalog.of(catalog) is catalog
+
+    def test_parsed_catalog_plans_match(self):
+        """Test planners give the same purchases from a parsed or raw catalog"""
+        raw = make_catalog()
+        catalog = BarrelCatalog(raw)
+        needs = {'RED': 3000, 'DARK': 1200, 'BLUE': 600}
+
+        for strategy in ('PREMIUM', 'PENETRATION', 'TIERED'):
+            assert BarrelManager.calculate_purchase_quantities(
+                catalog, dict(needs), 2000, 20000, strategy
+            ) == BarrelManager.calculate_purchase_quantities(
+                raw, dict(needs), 2000, 20000, strategy
+            )
+
+class TestLookaheadPlanner:
+    """Test barrel planning across several schedule blocks"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database at Hearthday 8:00"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+        self.catalog = make_catalog()
+        self.empty = {color: 0 for color in COLORS}
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(
+                "INSERT INTO current_game_time (game_time_id, current_day, current_hour) VALUES (5, 'Hearthday', 8)"
+            ))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change)
+                VALUES (5, 'GOLD_CHANGE', 900)
+            """))
+
+    def test_horizon_starts_at_arrival_block(self):
+        """Test horizon blocks start with the arrival block and follow the schedule"""
+        with self.engine.begin() as conn:
+            ctx = RequestContext(conn)
+            arrival = BarrelManager.get_future_block_priorities(conn, 5, ctx)
+            horizon = BarrelManager.get_horizon_blocks(conn, 5, 4, ctx)
+
+        self.logger.info(f"Horizon: {horizon}")
+        assert horizon[0]['block_id'] == arrival['block_id']
+        assert [b['block_name'] for b in horizon] == ['AFTERNOON', 'EVENING', 'NIGHT', 'MORNING']
+        assert horizon[-1]['in_game_day'] == 'Crownday'
+        assert [b['tick_offset'] for b in horizon] == sorted(b['tick_offset'] for b in horizon)
+
+    def test_buys_for_later_block(self):
+        """Test an idle arrival block still stocks a DARK-heavy block behind it"""
+        horizon_needs = [{'RED': 0}, {'DARK': 1000}]
+
+        greedy = greedy_plan(self.catalog, horizon_needs, self.empty, 500, 10000, 'PREMIUM')
+        plan = BarrelManager.plan_lookahead_purchases(
+            self.catalog, horizon_needs, self.empty, 500, 10000, 'PREMIUM'
+        )
+
+        assert greedy == []
+        assert plan == [{"sku": "SMALL_DARK_BARREL", "quantity": 2}]
+
+    def test_respects_gold_capacity_and_stock(self):
+        """Test plans stay within gold, ml capacity and catalog quantities"""
+        horizon_needs = [{'RED': 6000, 'BLUE': 3000}, {'DARK': 9000}]
+        catalog = make_catalog(quantity=2)
+
+        plan = BarrelManager.plan_lookahead_purchases(
+            catalog, horizon_needs, self.empty, 450, 2000, 'PREMIUM'
+        )
+
+        prices = {b['sku']: b['price'] for b in catalog}
+        ml = plan_ml(plan, catalog, self.empty)
+        assert sum(p['quantity'] * prices[p['sku']] for p in plan) <= 450
+        assert sum(ml.values()) <= 2000
+        assert all(p['quantity'] <= 2 for p in plan)
+
+    def test_time_budget_returns_feasible_plan(self, monkeypatch):
+        """Test an exhausted time budget still returns the seeded plan"""
+        horizon_needs = [{color: 20000 for color in COLORS}] * 4
+        monkeypatch.setattr(time, 'monotonic', expired_clock())
+
+        plan = BarrelManager.plan_lookahead_purchases(
+            self.catalog, horizon_needs, self.empty, 10000, 100000, 'TIERED'
+        )
+        greedy = BarrelManager.calculate_purchase_quantities(
+            self.catalog, {color: 20000 for color in COLORS}, 10000, 100000, 'TIERED'
+        )
+
+        assert plan
+        assert {p['sku']: p['quantity'] for p in plan} == {
+            p['sku']: min(p['quantity'], 10) for p in greedy if p['quantity'] > 0
+        }
+
+    def test_plan_mode(self):
+        """Test lookahead mode plans through plan_barrel_purchases"""
+        with self.engine.begin() as conn:
+            plan = BarrelManager.plan_barrel_purchases(
+                conn, self.catalog, 5, lookahead_blocks=4
+            )
+
+        self.logger.info(f"Lookahead plan: {plan}")
+        prices = {b['sku']: b['price'] for b in self.catalog}
+        assert sum(p['quantity'] * prices[p['sku']] for p in plan) <= 1000
+
+def potion(potion_id: int, recipe: list, sales_mix: float, inventory: int = 0) -> dict:
+    """Build a priority potion with the given recipe"""
+    return {
+        "potion_id": potion_id,
+        "sku": f"POTION_{potion_id}",
+        "red_ml": recipe[0],
+        "green_ml": recipe[1],
+        "blue_ml": recipe[2],
+        "dark_ml": recipe[3],
+        "inventory": inventory,
+        "sales_mix": sales_mix,
+        "max_potions_per_sku": 20
+    }
+
+class TestJointPlanner:
+    """Test joint barrel and bottling planning"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database at Hearthday 8:00"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+        self.catalog = make_catalog()
+        self.empty = {color: 0 for color in COLORS}
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(
+                "INSERT INTO current_game_time (game_time_id, current_day, current_hour) VALUES (5, 'Hearthday', 8)"
+            ))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change)
+                VALUES (5, 'GOLD_CHANGE', 900)
+            """))
+
+    def test_buys_complementary_colors(self):
+        """Test a two-color potion gets both colors and its expected bottling"""
+        purple = potion(1, [50, 0, 50, 0], 1.0)
+
+        plan = JointPlanner.optimize(self.catalog, [purple], self.empty, 200, 10000, 50, 'PREMIUM')
+
+        self.logger.info(f"Joint plan: {plan}")
+        assert sorted(p['sku'] for p in plan['barrels']) == ['SMALL_BLUE_BARREL', 'SMALL_RED_BARREL']
+        assert plan['bottling'] == [{"potion_type": [50, 0, 50, 0], "quantity": 10, "sku": "POTION_1"}]
+        assert plan['gold'] == 200
+
+    def test_skips_unbottleable_ml(self):
+        """Test gold for only half a mix goes to a potion it can finish"""
+        purple = potion(1, [50, 0, 50, 0], 0.5)
+        green = potion(2, [0, 100, 0, 0], 0.5)
+
+        plan = JointPlanner.optimize(self.catalog, [purple, green], self.empty, 150, 10000, 50, 'PREMIUM')
+
+        assert plan['barrels'] == [{"sku": "SMALL_GREEN_BARREL", "quantity": 1}]
+        assert plan['potions'] == 5
+
+    def test_uses_ml_on_hand(self):
+        """Test ml already held only needs its missing complement"""
+        purple = potion(1, [50, 0, 50, 0], 1.0)
+
+        plan = JointPlanner.optimize(
+            self.catalog, [purple], {**self.empty, 'RED': 500}, 200, 10000, 50, 'PREMIUM'
+        )
+
+        assert plan['barrels'] == [{"sku": "SMALL_BLUE_BARREL", "quantity": 1}]
+        assert plan['potions'] == 10
+
+    def test_respects_targets_and_capacity(self):
+        """Test bottling stays within sales share, per-sku limit and ml capacity"""
+        red = potion(1, [100, 0, 0, 0], 0.5, inventory=15)
+        blue = potion(2, [0, 0, 100, 0], 0.5)
+
+        plan = JointPlanner.optimize(self.catalog, [red, blue], self.empty, 5000, 1000, 40, 'PREMIUM')
+
+        bottled = {p['sku']: p['quantity'] for p in plan['bottling']}
+        assert bottled['POTION_1'] <= 5
+        assert bottled['POTION_2'] <= 20
+        assert sum(b['quantity'] for b in plan['barrels']) * 500 <= 1000
+
+    def test_budgets_return_plan_so_far(self, monkeypatch):
+        """Test exhausted node and time budgets still return feasible plans"""
+        red = [b for b in self.catalog if b['potion_type'][0]]
+        red.sort(key=lambda b: b['price'] / b['ml_per_barrel'])
+
+        searched = JointPlanner.cheapest_barrels(red, 600, 10000)
+        capped = JointPlanner.cheapest_barrels(red, 600, 10000, max_nodes=0)
+        purple = potion(1, [50, 0, 50, 0], 1.0)
+        monkeypatch.setattr(time, 'monotonic', expired_clock())
+        plan = JointPlanner.optimize(self.catalog, [purple], self.empty, 200, 10000, 50, 'PREMIUM')
+
+        assert searched == (200, 1000, {"SMALL_RED_BARREL": 2})
+        assert capped[0] >= searched[0] and capped[1] >= 600
+        assert plan == {"barrels": [], "bottling": [], "potions": 0, "gold": 0}
+
+    def test_plan_from_database(self):
+        """Test joint plan reads the arrival block's priorities"""
+        with self.engine.begin() as conn:
+            plan = JointPlanner.plan(conn, self.catalog, 5)
+
+        self.logger.info(f"Database joint plan: {plan}")
+        assert plan['gold'] <= 1000
+        assert plan['potions'] == sum(p['quantity'] for p in plan['bottling'])
+
+class TestLookaheadBenchmark:
+    """Benchmark lookahead planning against the single-block greedy"""
+
+    SCENARIOS = 100
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup logger"""
+        self.logger = test_logger
+
+    def scenario(self, rng: random.Random) -> dict:
+        """Random horizon with sparse color needs, stock, gold and capacity"""
+        return {
+            "horizon_needs": [
+                {
+                    color: rng.choice((0, 0, 500, 1000, 2500)) * rng.choice((1.0, 2.0, 3.0))
+                    for color in COLORS
+                }
+                for _ in range(4)
+            ],
+            "current_ml": {color: rng.choice((0, 0, 500)) for color in COLORS},
+            "gold": rng.randint(100, 2000),
+            "capacity": rng.choice((5000, 10000, 20000)),
+            "strategy": rng.choice(('PREMIUM', 'PENETRATION', 'TIERED'))
+        }
+
+    def test_lookahead_vs_greedy(self):
+        """Test lookahead covers at least as much discounted horizon need within its time budget"""
+        rng = random.Random(48)
+        catalog = make_catalog()
+        greedy_value = lookahead_value = 0.0
+        wins = losses = 0
+        slowest = 0.0
+
+        for _ in range(self.SCENARIOS):
+            s = self.scenario(rng)
+            args = (catalog, s['horizon_needs'], s['current_ml'], s['gold'], s['capacity'], s['strategy'])
+
+            greedy = greedy_plan(*args)
+
+            started = time.perf_counter()
+            lookahead = BarrelManager.plan_lookahead_purchases(*args)
+            slowest = max(slowest, time.perf_counter() - started)
+
+            g = BarrelManager.horizon_value(plan_ml(greedy, catalog, s['current_ml']), s['horizon_needs'])
+            l = BarrelManager.horizon_value(plan_ml(lookahead, catalog, s['current_ml']), s['horizon_needs'])
+            greedy_value += g
+            lookahead_value += l
+            wins += l > g + 1e-9
+            losses += l < g - 1e-9
+
+        report = (
+            f"{self.SCENARIOS} scenarios - horizon coverage greedy: {greedy_value:.0f}, "
+            f"lookahead: {lookahead_value:.0f} ({lookahead_value / greedy_value:.2f}x), "
+            f"wins: {wins}, losses: {losses}, slowest solve: {slowest * 1000:.1f}ms"
+        )
+        self.logger.info(report)
+
+        assert lookahead_value > greedy_value
@@ -0,0 +1,155 @@
+import pytest
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import StaticPool
+from src import database as db
+from src.replica import ReplicaRouter
+from test.sqlite_setup import create_test_db, clone_template_db
+
+class FakeClock:
+    """Manually advanced monotonic clock"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestReplicaRouter:
+    """Test lag-aware routing between primary and replica"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup router with controllable clock and lag"""
+        self.logger = test_logger
+        self.clock = FakeClock()
+        self.lag = 0.0
+        self.probes = 0
+        self.router = ReplicaRouter(max_lag_seconds=2.0, check_interval=1.0, clock=self.clock)
+        self.router.measure_lag = self.fake_lag
+        self.primary = object()
+        self.replica = object()
+
+    def fake_lag(self, replica):
+        """Return configured lag, raising when set to an exception"""
+        self.probes += 1
+        if isinstance(self.lag, Exception):
+            raise self.lag
+        return self.lag
+
+    def test_routes_to_replica_within_threshold(self):
+        """Test healthy replica serves reads"""
+        assert self.router.choose(self.primary, self.replica) is self.replica
+        assert self.router.snapshot()['replica_reads'] == 1
+
+    def test_falls_back_on_lag(self):
+        """Test lag beyond threshold routes to primary until it recovers"""
+        self.lag = 5.0
+        assert self.router.choose(self.primary, self.replica) is self.primary
+
+        self.lag = 0.5
+        assert self.router.choose(self.primary, self.replica) is self.primary
+
+        self.clock.now += 1.5
+        assert self.router.choose(self.primary, self.replica) is self.replica
+
+        snapshot = self.router.snapshot()
+        self.logger.info(f"Router snapshot: {snapshot}")
+        assert snapshot['primary_fallbacks'] == 2
+        assert snapshot['last_lag_seconds'] == 0.5
+
+    def test_probe_reused_within_interval(self):
+        """Test lag is probed once per check interval"""
+        for _ in range(5):
+            self.router.choose(self.primary, self.replica)
+        assert self.probes == 1
+
+    def test_probe_failure_uses_primary(self):
+        """Test unreachable replica routes to primary"""
+        self.lag = RuntimeError("connection refused")
+        assert self.router.choose(self.primary, self.replica) is self.primary
+        assert self.router.snapshot()['lag_probe_failures'] == 1
+
+    def test_receiver_down_not_current(self):
+        """Test a caught-up replica whose WAL receiver is down lags by replay age"""
+        status = {"in_recovery": True, "streaming": False, "caught_up": True, "replay_age": 600.0}
+        assert ReplicaRouter.lag_from_status({**status, "streaming": True}) == 0.0
+        assert ReplicaRouter.lag_from_status(status) == 600.0
+        assert ReplicaRouter.lag_from_status({**status, "replay_age": None}) == float('inf')
+        assert ReplicaRouter.lag_from_status({**status, "in_recovery": False}) == float('inf')
+
+        self.lag = ReplicaRouter.lag_from_status(status)
+        assert self.router.choose(self.primary, self.replica) is self.primary
+
+    def test_no_replica_uses_primary(self):
+        """Test reads stay on primary when no replica is configured"""
+        assert self.router.choose(self.primary, None) is self.primary
+        assert self.router.snapshot()['primary_fallbacks'] == 0
+
+class TestReplicaRouting:
+    """Test run_on_replica against two SQLite databases"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger, monkeypatch):
+        """Setup primary test database and a separately seeded replica"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+
+        self.replica = create_engine(
+            "sqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool
+        )
+        clone_template_db(self.replica)
+        with self.replica.begin() as conn:
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change)
+                VALUES (1, 'GOLD_CHANGE', 900)
+            """))
+
+        monkeypatch.setattr(db, '_replica_engine', self.replica)
+        monkeypatch.setattr(db, '_replica_configured', True)
+        db.replica_router.reset()
+
+        yield
+
+        db.replica_router.reset()
+        self.replica.dispose()
+
+    def read_gold(self):
+        """Read gold through the replica router"""
+        return db.run_on_replica(
+            lambda conn: conn.execute(
+                sqlalchemy.text("SELECT gold FROM current_state")
+            ).scalar_one(),
+            "test.replica_read"
+        )
+
+    def test_reads_from_replica(self):
+        """Test healthy replica serves the read"""
+        assert self.read_gold() == 1000
+
+    def test_lagging_replica_falls_back(self, monkeypatch):
+        """Test lag beyond threshold reads from primary"""
+        monkeypatch.setattr(db.replica_router, 'measure_lag', lambda replica: 60.0)
+        assert self.read_gold() == 100
+
+    def test_dropped_replica_retries_on_primary(self, monkeypatch):
+        """Test a replica disconnect marks it unhealthy and retries on primary"""
+        monkeypatch.setattr(db.default_retry_policy, 'sleep', lambda delay: None)
+        engines = []
+
+        def work(conn):
+            engines.append(conn.engine)
+            if conn.engine is self.replica:
+                raise OperationalError(
+                    "SELECT gold", {}, Exception("server closed the connection"),
+                    connection_invalidated=True
+                )
+            return conn.execute(sqlalchemy.text("SELECT gold FROM current_state")).scalar_one()
+
+        assert db.run_on_replica(work, "test.replica_drop") == 100
+        assert engines[0] is self.replica
+        assert engines[1] is not self.replica
+        assert db.replica_router.snapshot()['replica_healthy'] is False
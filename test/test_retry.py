@@ -0,0 +1,106 @@
+import pytest
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError, IntegrityError
+from src.retry import RetryMetrics, RetryPolicy
+
+class FakePgError(Exception):
+    """Stand-in for a psycopg2 error carrying a SQLSTATE code"""
+
+    def __init__(self, message: str, pgcode: str):
+        super().__init__(message)
+        self.pgcode = pgcode
+
+class TestRetryPolicy:
+    """Test shared transaction retry policy"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup isolated engine, policy and metrics"""
+        self.engine = create_engine("sqlite://")
+        self.metrics = RetryMetrics()
+        self.delays = []
+        self.policy = RetryPolicy(
+            max_attempts=4,
+            base_delay=0.01,
+            max_delay=0.05,
+            metrics=self.metrics,
+            sleep=self.delays.append
+        )
+        self.logger = test_logger
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE TABLE events (id INTEGER)"))
+
+        yield
+
+        self.engine.dispose()
+
+    def test_classify_error(self):
+        """Test serialization failures and deadlocks are separated from hard errors"""
+        serialization = OperationalError("stmt", {}, FakePgError("could not serialize", "40001"))
+        deadlock = OperationalError("stmt", {}, FakePgError("deadlock detected", "40P01"))
+        locked = OperationalError("stmt", {}, Exception("database is locked"))
+        missing = OperationalError("stmt", {}, Exception("no such table: potions"))
+        unique = IntegrityError("stmt", {}, FakePgError("duplicate key", "23505"))
+
+        assert RetryPolicy.classify_error(serialization) == RetryPolicy.SERIALIZATION_FAILURE
+        assert RetryPolicy.classify_error(deadlock) == RetryPolicy.DEADLOCK
+        assert RetryPolicy.classify_error(locked) == RetryPolicy.LOCK_TIMEOUT
+        assert RetryPolicy.classify_error(missing) is None
+        assert RetryPolicy.classify_error(unique) is None
+        assert RetryPolicy.classify_error(ValueError("bad input")) is None
+
+    def test_retry_reruns_whole_transaction(self):
+        """Test a failed attempt is rolled back and the whole unit re-run"""
+        calls = []
+
+        def work(conn):
+            calls.append(len(calls))
+            conn.execute(sqlalchemy.text("INSERT INTO events (id) VALUES (:id)"), {"id": len(calls)})
+            if len(calls) < 3:
+                raise OperationalError("stmt", {}, FakePgError("could not serialize", "40001"))
+            return "done"
+
+        assert self.policy.run(self.engine, work, "test.op") == "done"
+
+        with self.engine.begin() as conn:
+            ids = conn.execute(sqlalchemy.text("SELECT id FROM events")).scalars().all()
+
+        self.logger.info(f"Committed ids: {ids}, delays: {self.delays}")
+
+        assert ids == [3], "Only the successful attempt should be committed"
+        assert len(self.delays) == 2
+        assert all(0 <= d <= 0.05 for d in self.delays)
+
+        counters = self.metrics.snapshot()["operations"]["test.op"]
+        assert counters["attempts"] == 3
+        assert counters["retries"] == 2
+        assert counters["serialization_failures"] == 2
+
+    def test_hard_error_not_retried(self):
+        """Test non-transient errors are raised on first attempt"""
+        def work(conn):
+            conn.execute(sqlalchemy.text("SELECT * FROM missing_table"))
+
+        with pytest.raises(OperationalError):
+            self.policy.run(self.engine, work, "test.hard")
+
+        counters = self.metrics.snapshot()["operations"]["test.hard"]
+        assert counters["attempts"] == 1
+        assert counters["hard_failures"] == 1
+        assert self.delays == []
+
+    def test_retries_exhausted(self):
+        """Test deadlocks are retried up to max attempts then raised"""
+        def work(conn):
+            raise OperationalError("stmt", {}, FakePgError("deadlock detected", "40P01"))
+
+        with pytest.raises(OperationalError):
+            self.policy.run(self.engine, work, "test.deadlock")
+
+        totals = self.metrics.snapshot()["totals"]
+        assert totals["attempts"] == 4
+        assert totals["deadlocks"] == 4
+        assert totals["retries"] == 3
+        assert totals["exhausted"] == 1
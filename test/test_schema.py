@@ -2,7 +2,7 @@ import pytest
 import sqlalchemy
 import logging
 from pathlib import Path
-from test.sqlite_setup import create_test_db
+from test.sqlite_setup import create_test_db, schema_content_hash
 
 class TestSchema:
     """Test database schema implementation"""
@@ -30,9 +30,13 @@ class TestSchema:
             expected_tables = {
                 'active_strategy', 'barrel_details', 'barrel_purchases',
                 'barrel_visits', 'block_potion_priorities',
-                'capacity_upgrade_thresholds', 'cart_items', 'carts',
-                'color_definitions', 'current_game_time', 'customer_visits',
-                'customers', 'game_time', 'ledger_entries', 'potions',
+                'capacity_upgrade_thresholds', 'cart_items', 'carts', 'checkout_journal',
+                'color_definitions', 'current_game_time', 'current_strategy',
+                'customer_identities', 'customer_visits',
+                'customers', 'game_time', 'ledger_balances', 'ledger_capacity', 'ledger_checkpoints',
+                'ledger_gold', 'ledger_ml', 'ledger_potions', 'ledger_snapshots',
+                'ledger_transactions', 'potions',
+                'processed_orders', 'sales_rollup',
                 'strategies', 'strategy_time_blocks', 'strategy_transitions',
                 'time_blocks'
             }
@@ -415,13 +419,20 @@ class TestSchema:
                 );
             """))
             
-            # Insert test customer
+            # Insert test customer identity and visit row
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO customer_identities (
+                    identity_hash, customer_name, character_class, first_seen_time_id
+                ) VALUES (
+                    1, 'TestCustomer', 'Warrior', 1
+                );
+            """))
             conn.execute(sqlalchemy.text("""
                 INSERT INTO customers (
                     visit_record_id, visit_id, time_id,
-                    customer_name, character_class, level
+                    identity_id, level
                 ) VALUES (
-                    1, 1, 1, 'TestCustomer', 'Warrior', 1
+                    1, 1, 1, 1, 1
                 );
             """))
             
@@ -741,4 +752,41 @@ class TestSchema:
                         'NIGHT', 0, 4
                     );
                 """))
-            self.logger.info("Time block name uniqueness test passed")
\ No newline at end of file
+            self.logger.info("Time block name uniqueness test passed")
+    
+    def test_template_clone_isolation(self):
+        """Test each clone starts from the seeded template state"""
+        self.logger.info("Testing template clone isolation")
+        
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (
+                    time_id, entry_type, gold_change
+                ) VALUES (
+                    1, 'GOLD_CHANGE', 500
+                );
+            """))
+        
+        engine = create_test_db()
+        
+        with engine.begin() as conn:
+            gold = conn.execute(sqlalchemy.text("""
+                SELECT SUM(gold_change) FROM ledger_entries;
+            """)).scalar()
+            potion_count = conn.execute(sqlalchemy.text("""
+                SELECT COUNT(*) FROM potions;
+            """)).scalar()
+        
+        self.logger.info(f"Gold after clone: {gold}, potions: {potion_count}")
+        
+        assert gold == 100, "Clone should discard changes from previous test"
+        assert potion_count > 0, "Clone should include seed data"
+    
+    def test_schema_content_hash(self):
+        """Test converted schema cache key tracks source changes"""
+        base_hash = schema_content_hash("CREATE TABLE a (id INT);", "")
+        
+        assert base_hash == schema_content_hash("CREATE TABLE a (id INT);", "")
+        assert base_hash != schema_content_hash("CREATE TABLE b (id INT);", "")
+        assert base_hash != schema_content_hash("CREATE TABLE a (id INT);", "INSERT;")
+        assert base_hash != schema_content_hash("CREATE TABLE a (id INT);", "", "# converter changed")
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import httpx
+import pytest
+import sqlalchemy
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from src import database as db
+from src.api.auth import api_keys
+from src.api.server import app
+from src.retry import retry_metrics
+from src.utilities import (
+    BarrelManager, BottlerManager, CartManager, LedgerManager, StrategyManager, TransitionEngine
+)
+
+# Stress runs need a disposable local Postgres database; everything in it is dropped
+STRESS_POSTGRES_URI = os.environ.get('STRESS_POSTGRES_URI')
+
+pytestmark = pytest.mark.skipif(
+    not STRESS_POSTGRES_URI,
+    reason="STRESS_POSTGRES_URI not set"
+)
+
+HOT_STOCK = 50
+CHECKOUTS = 300
+BOTTLINGS = 20
+BOTTLE_QUANTITY = 5
+BARREL_DELIVERIES = 10
+CAPACITY_UPGRADES = 5
+THREADS = 32
+
+class TestConcurrencyStress:
+    """Race checkouts for hot SKUs against bottling, barrel and capacity deliveries"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger, monkeypatch):
+        """Load schema into Postgres and route the app's engine to it"""
+        self.logger = test_logger
+        self.engine = create_engine(
+            STRESS_POSTGRES_URI,
+            isolation_level="READ COMMITTED",
+            pool_size=THREADS,
+            max_overflow=THREADS,
+            pool_pre_ping=True
+        )
+        self.load_schema()
+
+        monkeypatch.setattr(db, '_engine', self.engine)
+        monkeypatch.setattr(db, '_read_only_engine', None)
+        monkeypatch.setattr(db, '_replica_engine', None)
+        monkeypatch.setattr(db, '_replica_configured', True)
+        StrategyManager.invalidate_cache()
+        TransitionEngine.invalidate_rules()
+        retry_metrics.reset()
+
+        test_api_key = "stress_api_key"
+        api_keys.append(test_api_key)
+        self.headers = {"access_token": test_api_key}
+
+        self.seed()
+
+        yield
+
+        api_keys.remove(test_api_key)
+        StrategyManager.invalidate_cache()
+        TransitionEngine.invalidate_rules()
+        self.engine.dispose()
+
+    def load_schema(self):
+        """Run schema and seed files through the driver so PL/pgSQL bodies load intact"""
+        project_root = Path(__file__).parent.parent
+        raw = self.engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute((project_root / "schema.sql").read_text())
+            cursor.execute((project_root / "block_potion_priorities_insert.sql").read_text())
+            raw.commit()
+        finally:
+            raw.close()
+
+    def seed(self):
+        """Fund the shop, stock two hot SKUs and open carts and barrel visits"""
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO current_game_time (game_time_id, current_day, current_hour)
+                VALUES (1, 'Hearthday', 0)
+            """))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change, ml_capacity_change, potion_capacity_change)
+                VALUES (1, 'ADMIN_CHANGE', 100000, 9, 19)
+            """))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, ml_change, color_id)
+                SELECT 1, 'ML_ADJUSTMENT', 20000, color_id FROM color_definitions
+            """))
+
+            hot = conn.execute(sqlalchemy.text("""
+                SELECT sku, red_ml, green_ml, blue_ml, dark_ml
+                FROM potions
+                ORDER BY potion_id
+                LIMIT 2
+            """)).mappings().all()
+            self.hot_skus = [p['sku'] for p in hot]
+            self.hot_types = [
+                [p['red_ml'], p['green_ml'], p['blue_ml'], p['dark_ml']] for p in hot
+            ]
+
+            for potion_type in self.hot_types:
+                BottlerManager.process_bottling(
+                    conn,
+                    {"potion_type": potion_type, "quantity": HOT_STOCK},
+                    1
+                )
+
+            visit_record_id = conn.execute(sqlalchemy.text("""
+                INSERT INTO customer_visits (visit_id, time_id, customers)
+                VALUES (1, 1, '[]')
+                RETURNING visit_record_id
+            """)).scalar_one()
+
+            self.cart_ids = []
+            for i in range(CHECKOUTS):
+                identity_id = conn.execute(sqlalchemy.text("""
+                    INSERT INTO customer_identities (identity_hash, customer_name, character_class, first_seen_time_id)
+                    VALUES (:identity_hash, :name, 'Fighter', 1)
+                    RETURNING identity_id
+                """), {
+                    "identity_hash": CartManager.identity_hash(f"shopper_{i}", 'Fighter'),
+                    "name": f"shopper_{i}"
+                }).scalar_one()
+                customer_id = conn.execute(sqlalchemy.text("""
+                    INSERT INTO customers (visit_record_id, visit_id, time_id, identity_id, level)
+                    VALUES (:visit_record_id, 1, 1, :identity_id, 1)
+                    RETURNING customer_id
+                """), {"visit_record_id": visit_record_id, "identity_id": identity_id}).scalar_one()
+                cart_id = conn.execute(sqlalchemy.text("""
+                    INSERT INTO carts (visit_id, customer_id, time_id)
+                    VALUES (1, :customer_id, 1)
+                    RETURNING cart_id
+                """), {"customer_id": customer_id}).scalar_one()
+
+                # Alternate item order so lock ordering is exercised
+                skus = self.hot_skus if i % 2 == 0 else list(reversed(self.hot_skus))
+                for sku in skus:
+                    CartManager.update_cart_item(conn, cart_id, sku, 1, 1, 1)
+                self.cart_ids.append(cart_id)
+
+            self.barrel_visits = []
+            for _ in range(BARREL_DELIVERIES):
+                visit_id = conn.execute(sqlalchemy.text("""
+                    INSERT INTO barrel_visits (time_id, wholesale_catalog)
+                    VALUES (1, '[]')
+                    RETURNING visit_id
+                """)).scalar_one()
+                conn.execute(sqlalchemy.text("""
+                    INSERT INTO barrel_details (visit_id, sku, ml_per_barrel, potion_type, price, quantity, color_id)
+                    VALUES (
+                        :visit_id, 'SMALL_RED_BARREL', 500, :potion_type, 100, 10,
+                        (SELECT color_id FROM color_definitions WHERE color_name = 'RED')
+                    )
+                """), {"visit_id": visit_id, "potion_type": json.dumps([1, 0, 0, 0])})
+                self.barrel_visits.append(visit_id)
+
+    def checkout(self, cart_id: int) -> str:
+        """Check out one cart through the shared retry policy"""
+        try:
+            db.run_in_transaction(
+                lambda conn: CartManager.process_checkout(conn, cart_id, "gold", 1),
+                "stress.checkout"
+            )
+            return "ok"
+        except HTTPException as e:
+            if e.status_code == 400:
+                return "rejected"
+            raise
+
+    def deliver_barrels(self, visit_id: int) -> str:
+        """Deliver one barrel order through the shared retry policy"""
+        barrels = [{
+            "sku": "SMALL_RED_BARREL",
+            "ml_per_barrel": 500,
+            "potion_type": [1, 0, 0, 0],
+            "price": 100,
+            "quantity": 1
+        }]
+        db.run_in_transaction(
+            lambda conn: BarrelManager.process_barrel_purchases(conn, barrels, 1, visit_id, visit_id),
+            "stress.barrels"
+        )
+        return "ok"
+
+    async def post(self, client: httpx.AsyncClient, path: str, payload) -> str:
+        """Post to the API and classify the response"""
+        response = await client.post(path, json=payload, headers=self.headers)
+        if response.status_code == 200:
+            return "ok"
+        if response.status_code == 400:
+            return "rejected"
+        return f"error_{response.status_code}"
+
+    async def run_workload(self) -> list:
+        """Fire checkouts and barrel deliveries on threads, bottling and capacity over async HTTP"""
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=THREADS)
+
+        try:
+            async with httpx.AsyncClient(app=app, base_url="http://stress") as client:
+                tasks = [
+                    loop.run_in_executor(executor, self.checkout, cart_id)
+                    for cart_id in self.cart_ids
+                ]
+                tasks += [
+                    loop.run_in_executor(executor, self.deliver_barrels, visit_id)
+                    for visit_id in self.barrel_visits
+                ]
+                tasks += [
+                    self.post(
+                        client,
+                        f"/bottler/deliver/{1000 + i}",
+                        [{"potion_type": self.hot_types[i % 2], "quantity": BOTTLE_QUANTITY}]
+                    )
+                    for i in range(BOTTLINGS)
+                ]
+                tasks += [
+                    self.post(
+                        client,
+                        f"/inventory/deliver/{2000 + i}",
+                        {"potion_capacity": 1, "ml_capacity": 0}
+                    )
+                    for i in range(CAPACITY_UPGRADES)
+                ]
+                return await asyncio.gather(*tasks)
+        finally:
+            executor.shutdown(wait=True)
+
+    def assert_invariants(self):
+        """Check ledger and inventory agree and nothing went negative"""
+        with self.engine.begin() as conn:
+            state = conn.execute(sqlalchemy.text(
+                "SELECT * FROM current_state"
+            )).mappings().one()
+            LedgerManager.refresh_balances(conn)
+            balances = LedgerManager.get_balances(conn)
+            mismatches = conn.execute(sqlalchemy.text("""
+                SELECT p.sku, p.current_quantity, COALESCE(SUM(le.potion_change), 0) as ledger_quantity
+                FROM potions p
+                LEFT JOIN ledger_entries le ON le.potion_id = p.potion_id
+                GROUP BY p.potion_id, p.sku, p.current_quantity
+                HAVING p.current_quantity != COALESCE(SUM(le.potion_change), 0)
+            """)).mappings().all()
+            oversold = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM potions WHERE current_quantity < 0"
+            )).scalar_one()
+
+        self.logger.info(f"Final state: {dict(state)}")
+
+        assert state['gold'] >= 0
+        for color in ('red_ml', 'green_ml', 'blue_ml', 'dark_ml'):
+            assert state[color] >= 0, f"{color} negative"
+        assert oversold == 0
+        assert not mismatches, f"Inventory drifted from ledger: {mismatches}"
+        for key in ('gold', 'total_potions', 'total_ml', 'ml_capacity_units', 'potion_capacity_units'):
+            assert balances[key] == state[key], f"ledger_balances.{key} not refreshed"
+
+        return state
+
+    def test_checkout_bottling_barrel_capacity_race(self):
+        """Test concurrent writes keep ledger invariants and report contention"""
+        started = time.perf_counter()
+        outcomes = asyncio.run(self.run_workload())
+        elapsed = time.perf_counter() - started
+
+        checkouts = outcomes[:CHECKOUTS]
+        sold = checkouts.count("ok")
+        errors = [o for o in outcomes if o.startswith("error")]
+        totals = retry_metrics.snapshot()['totals']
+
+        report = (
+            f"{len(outcomes)} requests in {elapsed:.2f}s "
+            f"({len(outcomes) / elapsed:.1f} req/s) - "
+            f"checkouts ok: {sold}, rejected: {checkouts.count('rejected')}, "
+            f"retries: {totals['retries']}, deadlocks: {totals['deadlocks']}, "
+            f"serialization failures: {totals['serialization_failures']}, "
+            f"lock timeouts: {totals['lock_timeouts']}, exhausted: {totals['exhausted']}"
+        )
+        self.logger.info(report)
+
+        assert not errors, f"Unexpected failures: {errors}"
+        assert totals['exhausted'] == 0
+
+        self.assert_invariants()
+
+        # Each cart buys one of each hot SKU, so sales are bounded by stock ever bottled
+        max_stock = HOT_STOCK + (BOTTLINGS // 2) * BOTTLE_QUANTITY
+        assert sold <= max_stock
+        assert sold >= HOT_STOCK
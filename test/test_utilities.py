@@ -0,0 +1,810 @@
+import json
+import pytest
+import sqlalchemy
+from fastapi import HTTPException
+from sqlalchemy import event
+from src.utilities import (
+    RequestContext, StrategyManager, TransitionEngine, LedgerManager, CartManager,
+    OrderManager, ExportManager, SalesManager, DemandForecaster, TimeManager
+)
+from test.sqlite_setup import create_test_db
+
+class TestRequestContext:
+    """Test request-scoped memoization of time, strategy and state"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database with current time and statement counter"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+        self.statements = []
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(
+                "INSERT INTO current_game_time (game_time_id, current_day, current_hour) VALUES (1, 'Hearthday', 0)"
+            ))
+
+        event.listen(self.engine, 'before_cursor_execute', self.count_statement)
+
+        yield
+
+        event.remove(self.engine, 'before_cursor_execute', self.count_statement)
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        """Record each executed statement"""
+        self.statements.append(statement)
+
+    def test_values_loaded_once(self):
+        """Test repeated access runs each query only once"""
+        with self.engine.begin() as conn:
+            ctx = RequestContext(conn)
+
+            for _ in range(3):
+                assert ctx.time_id == 1
+                assert ctx.strategy['strategy_name'] == 'PREMIUM'
+                assert ctx.state['gold'] == 100
+
+        self.logger.info(f"Executed {len(self.statements)} statements")
+        assert len(self.statements) == 3
+
+    def test_invalidate_reloads_state(self):
+        """Test invalidate drops cached state and strategy but keeps time"""
+        with self.engine.begin() as conn:
+            ctx = RequestContext(conn)
+            assert ctx.state['gold'] == 100
+            assert ctx.time_id == 1
+
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change)
+                VALUES (1, 'GOLD_CHANGE', 50)
+            """))
+            assert ctx.state['gold'] == 100
+
+            ctx.invalidate()
+            assert ctx.state['gold'] == 150
+            assert ctx.time_id == 1
+
+        assert len(self.statements) == 4
+
+class TestStrategyManager:
+    """Test current strategy pointer and in-process cache"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+        yield
+        StrategyManager.invalidate_cache()
+
+    def test_pointer_follows_activation(self):
+        """Test activation moves pointer and keeps history"""
+        with self.engine.begin() as conn:
+            assert StrategyManager.get_active_strategy(conn)['strategy_name'] == 'PREMIUM'
+
+            StrategyManager.activate_strategy(conn, 2, 1)
+            strategy = StrategyManager.get_active_strategy(conn)
+
+            history = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM active_strategy"
+            )).scalar_one()
+            pointers = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM current_strategy"
+            )).scalar_one()
+
+        self.logger.info(f"Active strategy after activation: {strategy}")
+        assert strategy['strategy_id'] == 2
+        assert history == 2
+        assert pointers == 1
+
+    def test_activation_cached_after_commit_only(self):
+        """Test an activation is not cached before commit or after rollback"""
+        with self.engine.connect() as conn:
+            transaction = conn.begin()
+            StrategyManager.get_active_strategy(conn)
+            StrategyManager.activate_strategy(conn, 2, 1)
+            assert StrategyManager.get_active_strategy(conn)['strategy_id'] == 2
+            transaction.rollback()
+
+        with self.engine.begin() as conn:
+            assert StrategyManager.get_active_strategy(conn)['strategy_id'] == 1
+
+    def test_cache_serves_within_ttl(self):
+        """Test cached strategy is reused until invalidated"""
+        with self.engine.begin() as conn:
+            StrategyManager.get_active_strategy(conn)
+
+            # Bypass activate_strategy so the cache is not invalidated
+            conn.execute(sqlalchemy.text(
+                "INSERT INTO active_strategy (strategy_id, game_time_id) VALUES (2, 1)"
+            ))
+            assert StrategyManager.get_active_strategy(conn)['strategy_id'] == 1
+
+            StrategyManager.invalidate_cache()
+            assert StrategyManager.get_active_strategy(conn)['strategy_id'] == 2
+
+class TestTransitionEngine:
+    """Test data-driven strategy transitions and running balances"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+
+    def test_balances_refresh_per_tick(self):
+        """Test ledger writes leave ledger_balances alone until a tick refreshes it"""
+        with self.engine.begin() as conn:
+            before = LedgerManager.get_balances(conn)
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change, ml_change, color_id)
+                VALUES (1, 'BARREL_PURCHASE', -60, 500, 1)
+            """))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, ml_change, potion_change, potion_id, color_id)
+                VALUES (1, 'POTION_BOTTLED', -200, 2, 1, 1)
+            """))
+            unchanged = LedgerManager.get_balances(conn)
+
+            LedgerManager.refresh_balances(conn)
+            balances = LedgerManager.get_balances(conn)
+            state = conn.execute(sqlalchemy.text(
+                "SELECT * FROM current_state"
+            )).mappings().one()
+
+        self.logger.info(f"Balances: {balances}")
+        assert unchanged == before
+        for key, value in balances.items():
+            assert value == state[key], f"{key} mismatch"
+
+    def test_rules_match_seeded_thresholds(self):
+        """Test seeded rules fire on the documented thresholds"""
+        with self.engine.begin() as conn:
+            rules = TransitionEngine.get_rules(conn)
+
+        premium = rules[1]
+        base = dict(LedgerManager.EMPTY_BALANCES, ml_capacity_units=1, potion_capacity_units=1)
+        assert not TransitionEngine.rule_met(premium, base)
+        assert TransitionEngine.rule_met(premium, dict(base, gold=250))
+        assert TransitionEngine.rule_met(premium, dict(base, total_potions=5))
+        assert TransitionEngine.rule_met(premium, dict(base, total_ml=500))
+
+        penetration = rules[2]
+        assert not TransitionEngine.rule_met(penetration, dict(base, gold=10000))
+        assert TransitionEngine.rule_met(
+            penetration,
+            dict(base, ml_capacity_units=2, potion_capacity_units=2)
+        )
+
+        tiered = rules[3]
+        assert TransitionEngine.rule_met(
+            tiered,
+            dict(base, ml_capacity_units=4, potion_capacity_units=3)
+        )
+        assert 4 not in rules
+
+    def test_require_all_thresholds(self):
+        """Test require_all_thresholds needs every set threshold"""
+        rule = {
+            'gold_threshold': 100,
+            'potion_threshold': None,
+            'ml_threshold': 500,
+            'ml_capacity_threshold': 1,
+            'potion_capacity_threshold': 1,
+            'require_all_thresholds': True
+        }
+        balances = dict(
+            LedgerManager.EMPTY_BALANCES,
+            gold=100,
+            ml_capacity_units=1,
+            potion_capacity_units=1
+        )
+        assert not TransitionEngine.rule_met(rule, balances)
+        assert TransitionEngine.rule_met(rule, dict(balances, total_ml=500))
+
+class TestLedgerEpochs:
+    """Test weekly ledger epochs, checkpoints and archiving"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database with ml and gold movements in the first epoch"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change, ml_change, color_id)
+                VALUES (1, 'BARREL_PURCHASE', -60, 500, 1)
+            """))
+
+    def read_state(self, conn):
+        """Read current_state as a dict"""
+        return dict(conn.execute(sqlalchemy.text(
+            "SELECT * FROM current_state"
+        )).mappings().one())
+
+    def test_seal_checkpoints_open_epoch(self):
+        """Test sealing checkpoints the open epoch and routes new entries to the next"""
+        with self.engine.begin() as conn:
+            before = self.read_state(conn)
+            LedgerManager.seal_epoch(conn, 1)
+            checkpoint = LedgerManager.get_checkpoint(conn)
+            sealed = self.read_state(conn)
+
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO ledger_entries (time_id, entry_type, gold_change)
+                VALUES (1, 'GOLD_CHANGE', 25)
+            """))
+            epochs = conn.execute(sqlalchemy.text(
+                "SELECT epoch_id, COUNT(*) FROM ledger_entries GROUP BY epoch_id ORDER BY epoch_id"
+            )).all()
+            after = self.read_state(conn)
+
+        self.logger.info(f"Checkpoint: {checkpoint}")
+        assert checkpoint['epoch_id'] == 1
+        assert checkpoint['entry_count'] == 2
+        assert checkpoint['gold'] == 40
+        assert checkpoint['dark_ml'] == 500
+        assert sealed == before
+        assert [tuple(row) for row in epochs] == [(1, 2), (2, 1)]
+        assert after['gold'] == before['gold'] + 25
+
+    def test_week_start_detection(self):
+        """Test a new week starts whenever the clock wraps, not only on Hearthday 0"""
+        assert TimeManager.starts_week(84, 1, 'Hearthday', 0)
+        assert TimeManager.starts_week(84, 2, 'Hearthday', 2)
+        assert TimeManager.starts_week(80, 5, 'Hearthday', 8)
+        assert not TimeManager.starts_week(1, 2, 'Hearthday', 2)
+        assert not TimeManager.starts_week(1, 1, 'Hearthday', 0)
+        assert TimeManager.starts_week(None, 1, 'Hearthday', 0)
+        assert not TimeManager.starts_week(None, 2, 'Hearthday', 2)
+
+    def test_empty_epoch_not_sealed(self):
+        """Test sealing again without new entries is a no-op"""
+        with self.engine.begin() as conn:
+            assert LedgerManager.seal_epoch(conn, 1) is not None
+            assert LedgerManager.seal_epoch(conn, 1) is None
+            assert LedgerManager.get_open_epoch(conn) == 2
+
+    def test_archive_keeps_state(self):
+        """Test archived epochs leave the live ledger without changing balances"""
+        with self.engine.begin() as conn:
+            LedgerManager.seal_epoch(conn, 1)
+            before = self.read_state(conn)
+            archive_prefix = LedgerManager.archive_epoch(conn, 1)
+
+            live = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM ledger_entries"
+            )).scalar_one()
+            archived = conn.execute(sqlalchemy.text(
+                f"SELECT COUNT(*) FROM {archive_prefix}_transactions"
+            )).scalar_one()
+
+            assert LedgerManager.archive_epoch(conn, 1) == archive_prefix
+            assert self.read_state(conn) == before
+
+        assert live == 0
+        assert archived == 2
+
+    def test_entries_split_into_streams(self):
+        """Test each entry only writes the streams it changes"""
+        with self.engine.begin() as conn:
+            self.earn(conn, 2, 25)
+            streams = {
+                table: conn.execute(sqlalchemy.text(
+                    f"SELECT COUNT(*) FROM {table}"
+                )).scalar_one()
+                for table in LedgerManager.LEDGER_TABLES
+            }
+            entry = conn.execute(sqlalchemy.text("""
+                SELECT gold_change, ml_change, potion_change, ml_capacity_change
+                FROM ledger_entries
+                ORDER BY entry_id DESC
+                LIMIT 1
+            """)).one()
+
+        self.logger.info(f"Stream row counts: {streams}")
+        assert streams['ledger_transactions'] == 3
+        assert streams['ledger_gold'] == 3
+        assert streams['ledger_ml'] == 1
+        assert streams['ledger_potions'] == 0
+        assert tuple(entry) == (25, None, None, None)
+
+    def advance(self, conn, time_id):
+        """Record a tick and its balance snapshot"""
+        tick_id = conn.execute(sqlalchemy.text("""
+            INSERT INTO current_game_time (game_time_id, current_day, current_hour)
+            SELECT time_id, in_game_day, in_game_hour FROM game_time WHERE time_id = :time_id
+            RETURNING id
+        """), {"time_id": time_id}).scalar_one()
+        LedgerManager.record_snapshot(conn, tick_id, time_id)
+
+    def earn(self, conn, time_id, gold):
+        """Write a gold entry at time_id"""
+        conn.execute(sqlalchemy.text("""
+            INSERT INTO ledger_entries (time_id, entry_type, gold_change)
+            VALUES (:time_id, 'GOLD_CHANGE', :gold)
+        """), {"time_id": time_id, "gold": gold})
+
+    def test_state_at_past_and_current_tick(self):
+        """Test past ticks read the following snapshot and the current tick replays"""
+        with self.engine.begin() as conn:
+            self.advance(conn, 2)
+            self.earn(conn, 2, 10)
+            self.advance(conn, 3)
+            self.earn(conn, 3, 5)
+            self.earn(conn, 3, 5)
+
+            first = LedgerManager.get_state_at(conn, 1)
+            past = LedgerManager.get_state_at(conn, 2)
+            current = LedgerManager.get_state_at(conn)
+            live = self.read_state(conn)
+
+        self.logger.info(f"State at current tick: {current}")
+        assert first['gold'] == 40
+        assert first['dark_ml'] == 500
+        assert past['source'] == "snapshot"
+        assert past['gold'] == 50
+        assert current['time_id'] == 3
+        assert current['source'] == "replay"
+        assert current['replayed_entries'] == 2
+        for key in ('gold', 'dark_ml', 'total_ml', 'total_potions', 'max_potions', 'max_ml'):
+            assert current[key] == live[key], f"{key} mismatch"
+
+    def test_state_at_replays_across_week_wrap(self):
+        """Test the current tick replays by entry id across a new week and a seal"""
+        with self.engine.begin() as conn:
+            self.advance(conn, 84)
+            self.earn(conn, 84, 10)
+            self.earn(conn, 1, 7)
+            unsealed = LedgerManager.get_state_at(conn)
+
+            LedgerManager.seal_epoch(conn, 1)
+            self.earn(conn, 1, 3)
+            current = LedgerManager.get_state_at(conn)
+            live = self.read_state(conn)
+
+        assert unsealed['replayed_entries'] == 2
+        assert unsealed['gold'] == 57
+        assert current['replayed_entries'] == 1
+        for key in ('gold', 'dark_ml', 'total_ml', 'total_potions', 'max_potions', 'max_ml'):
+            assert current[key] == live[key], f"{key} mismatch"
+
+    def test_state_at_unrecorded_time(self):
+        """Test a time with no recorded tick is not found"""
+        with self.engine.begin() as conn:
+            with pytest.raises(HTTPException) as exc:
+                LedgerManager.get_state_at(conn, 50)
+        assert exc.value.status_code == 404
+
+    def test_open_epoch_not_archived(self):
+        """Test the open epoch cannot be archived"""
+        with self.engine.begin() as conn:
+            with pytest.raises(HTTPException) as exc:
+                LedgerManager.archive_epoch(conn, 1)
+        assert exc.value.status_code == 400
+
+class TestCartCheckout:
+    """Test optimistic cart updates and guarded checkout decrements"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database with stocked potions and an open cart"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(
+                "UPDATE potions SET current_quantity = 5 WHERE potion_id IN (1, 2)"
+            ))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO customer_visits (visit_id, time_id, customers)
+                VALUES (1, 1, '[]')
+            """))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO customer_identities (identity_hash, customer_name, character_class)
+                VALUES (1, 'Ada', 'Wizard')
+            """))
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO customers (visit_record_id, visit_id, time_id, identity_id, level)
+                VALUES (1, 1, 1, 1, 3)
+            """))
+            self.cart_id = conn.execute(sqlalchemy.text("""
+                INSERT INTO carts (visit_id, customer_id, time_id)
+                VALUES (1, 1, 1)
+                RETURNING cart_id
+            """)).scalar_one()
+            self.skus = conn.execute(sqlalchemy.text(
+                "SELECT sku FROM potions WHERE potion_id IN (1, 2) ORDER BY potion_id"
+            )).scalars().all()
+
+    def add_items(self, quantities: list):
+        """Add items to the cart through CartManager"""
+        with self.engine.begin() as conn:
+            for sku, quantity in zip(self.skus, quantities):
+                CartManager.update_cart_item(conn, self.cart_id, sku, quantity, 1, 1)
+
+    def quantities(self) -> list:
+        """Get current quantities of the stocked potions"""
+        with self.engine.begin() as conn:
+            return conn.execute(sqlalchemy.text(
+                "SELECT current_quantity FROM potions WHERE potion_id IN (1, 2) ORDER BY potion_id"
+            )).scalars().all()
+
+    def test_checkout_decrements_stock(self):
+        """Test checkout decrements each SKU and records sales"""
+        self.add_items([2, 3])
+
+        with self.engine.begin() as conn:
+            result = CartManager.process_checkout(conn, self.cart_id, "gold", 1)
+            balances = conn.execute(sqlalchemy.text(
+                "SELECT total_potions FROM current_state"
+            )).mappings().one()
+
+        self.logger.info(f"Checkout result: {result}")
+        assert result['total_potions_bought'] == 5
+        assert self.quantities() == [3, 2]
+        assert balances['total_potions'] == -5
+
+        with self.engine.begin() as conn:
+            repeat = CartManager.process_checkout(conn, self.cart_id, "gold", 1)
+        assert repeat == result
+        assert self.quantities() == [3, 2]
+
+    def test_checkout_rolls_up_sales(self):
+        """Test checkout adds its lines to the tick's sales rollup"""
+        self.add_items([2, 3])
+
+        with self.engine.begin() as conn:
+            CartManager.process_checkout(conn, self.cart_id, "gold", 1)
+            rollup = conn.execute(sqlalchemy.text(
+                "SELECT epoch_id, time_id, potion_id, units_sold FROM sales_rollup ORDER BY potion_id"
+            )).all()
+            trailing = SalesManager.get_trailing_sales(conn, 1, 12)
+            blocks = SalesManager.get_block_sales(conn, 1)
+
+        self.logger.info(f"Rollup: {rollup}, trailing: {trailing}, blocks: {blocks}")
+        assert [tuple(row) for row in rollup] == [(1, 1, 1, 2), (1, 1, 2, 3)]
+        assert trailing[2]['units_sold'] == 3
+        assert trailing[2]['velocity'] == 3 / 12
+        assert {(row['potion_id'], row['day'], row['block']) for row in blocks} == {
+            (1, 'Hearthday', 'NIGHT'), (2, 'Hearthday', 'NIGHT')
+        }
+
+    def test_trailing_window_spans_epochs(self):
+        """Test trailing windows start in the previous epoch when needed"""
+        assert SalesManager.window_start(2, 3, 5) == (1, 83)
+        assert SalesManager.window_start(2, 10, 5) == (2, 6)
+        assert SalesManager.window_start(1, 3, 12) == (1, 1)
+
+    def test_retry_replays_journal(self):
+        """Test retried checkout returns the journaled result without new ledger entries"""
+        self.add_items([1, 1])
+
+        with self.engine.begin() as conn:
+            result = CartManager.process_checkout(conn, self.cart_id, "gold", 1, "order-1")
+            ledger_count = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM ledger_entries"
+            )).scalar_one()
+
+        with self.engine.begin() as conn:
+            replay = CartManager.get_journaled_checkout(conn, self.cart_id, "order-1")
+            repeat = CartManager.process_checkout(conn, self.cart_id, "gold", 1, "order-1")
+            journal = conn.execute(sqlalchemy.text(
+                "SELECT status, total_gold FROM checkout_journal WHERE cart_id = :cart_id"
+            ), {"cart_id": self.cart_id}).mappings().one()
+            assert conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM ledger_entries"
+            )).scalar_one() == ledger_count
+
+        self.logger.info(f"Journal entry: {dict(journal)}")
+        assert replay == result
+        assert repeat == result
+        assert journal['status'] == 'COMPLETED'
+        assert journal['total_gold'] == result['total_gold_paid']
+
+    def test_idempotency_key_bound_to_cart(self):
+        """Test reusing an idempotency key for another cart is rejected"""
+        self.add_items([1, 1])
+
+        with self.engine.begin() as conn:
+            CartManager.process_checkout(conn, self.cart_id, "gold", 1, "order-1")
+
+        with pytest.raises(HTTPException) as exc:
+            with self.engine.begin() as conn:
+                CartManager.get_journaled_checkout(conn, self.cart_id + 1, "order-1")
+        assert exc.value.status_code == 409
+
+    def test_insufficient_stock_rolls_back(self):
+        """Test a failed guarded decrement leaves stock and cart untouched"""
+        self.add_items([2, 3])
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(
+                "UPDATE potions SET current_quantity = 1 WHERE potion_id = 2"
+            ))
+
+        with pytest.raises(HTTPException) as exc:
+            with self.engine.begin() as conn:
+                CartManager.process_checkout(conn, self.cart_id, "gold", 1)
+
+        assert exc.value.status_code == 400
+        assert self.quantities() == [5, 1]
+
+        with self.engine.begin() as conn:
+            checked_out = conn.execute(sqlalchemy.text(
+                "SELECT checked_out FROM carts WHERE cart_id = :cart_id"
+            ), {"cart_id": self.cart_id}).scalar_one()
+            journaled = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM checkout_journal"
+            )).scalar_one()
+        assert not checked_out
+        assert journaled == 0
+
+class TestDemandForecaster:
+    """Test smoothed demand per potion, day and block and its blend with sales_mix"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database with Hearthday NIGHT sales in two sealed epochs"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+
+        with self.engine.begin() as conn:
+            for epoch_id, potion_id, units in ((1, 1, 10), (2, 1, 20), (2, 2, 10)):
+                conn.execute(sqlalchemy.text("""
+                    INSERT INTO sales_rollup (epoch_id, time_id, potion_id, units_sold, gold)
+                    VALUES (:epoch_id, 1, :potion_id, :units, :units)
+                """), {"epoch_id": epoch_id, "potion_id": potion_id, "units": units})
+            conn.execute(sqlalchemy.text("UPDATE ledger_balances SET epoch_id = 3"))
+            self.night = conn.execute(sqlalchemy.text(
+                "SELECT block_id FROM time_blocks WHERE name = 'NIGHT'"
+            )).scalar_one()
+
+    def test_smooths_sealed_epochs(self):
+        """Test each sealed epoch is folded in once with exponential smoothing"""
+        with self.engine.begin() as conn:
+            forecast = DemandForecaster.get_forecast(conn)
+            conn.execute(sqlalchemy.text("""
+                INSERT INTO sales_rollup (epoch_id, time_id, potion_id, units_sold, gold)
+                VALUES (3, 1, 1, 100, 100)
+            """))
+            repeat = DemandForecaster.get_forecast(conn)
+
+        self.logger.info(f"Forecast: {forecast}")
+        assert forecast[(1, 'Hearthday', self.night)] == pytest.approx(13.0)
+        assert forecast[(2, 'Hearthday', self.night)] == pytest.approx(10.0)
+        assert repeat == forecast
+
+    def test_reset_drops_forecast(self):
+        """Test a reset recorded by another worker drops the cached forecast"""
+        with self.engine.begin() as conn:
+            assert DemandForecaster.get_forecast(conn)
+            conn.execute(sqlalchemy.text("DELETE FROM sales_rollup"))
+            LedgerManager.record_reset(conn)
+            forecast = DemandForecaster.get_forecast(conn)
+
+        assert forecast == {}
+
+    def test_blend_moves_mix_toward_demand(self):
+        """Test blended sales_mix keeps the total and leans toward forecast shares"""
+        priorities = [
+            {"potion_id": 1, "sales_mix": 0.2},
+            {"potion_id": 2, "sales_mix": 0.3},
+            {"potion_id": 3, "sales_mix": 0.5}
+        ]
+        with self.engine.begin() as conn:
+            blended = DemandForecaster.blend(conn, priorities, 'Hearthday', self.night)
+            unforecast = DemandForecaster.blend(conn, priorities, 'Crownday', self.night)
+
+        mix = [p['sales_mix'] for p in blended]
+        assert mix == pytest.approx([0.1 + 0.5 * 13 / 23, 0.15 + 0.5 * 10 / 23, 0.25])
+        assert sum(mix) == pytest.approx(1.0)
+        assert unforecast == priorities
+
+class TestOrderManager:
+    """Test order_id idempotency for deliveries"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+
+    def test_claim_then_replay(self):
+        """Test first delivery claims the order and retries replay its response"""
+        with self.engine.begin() as conn:
+            assert OrderManager.claim_order(conn, "bottler.deliver", 7) is None
+            OrderManager.complete_order(conn, "bottler.deliver", 7, {"success": True})
+
+        with self.engine.begin() as conn:
+            replay = OrderManager.claim_order(conn, "bottler.deliver", 7)
+            other_endpoint = OrderManager.claim_order(conn, "barrels.deliver", 7)
+
+        assert replay == {"success": True}
+        assert other_endpoint is None
+
+    def test_failed_delivery_releases_claim(self):
+        """Test a rolled back delivery can be retried"""
+        with pytest.raises(HTTPException):
+            with self.engine.begin() as conn:
+                OrderManager.claim_order(conn, "inventory.deliver", 3)
+                raise HTTPException(status_code=400, detail="Insufficient gold")
+
+        with self.engine.begin() as conn:
+            assert OrderManager.claim_order(conn, "inventory.deliver", 3) is None
+
+class TestCustomerVisitIngestion:
+    """Test bulk customer visit ingestion and payload modes"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database and a large visit"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+        self.customers = [
+            {"customer_name": f"customer_{i}", "character_class": "Rogue", "level": i % 20 + 1}
+            for i in range(2500)
+        ]
+
+    @pytest.mark.parametrize("mode", ['none', 'compressed', 'json'])
+    def test_bulk_insert_and_payload(self, mode):
+        """Test every customer row is written and payload is kept only as configured"""
+        with self.engine.begin() as conn:
+            visit_record_id = CartManager.record_customer_visit(
+                conn, 1, self.customers, 1, mode
+            )['visit_record_id']
+            count = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM customers WHERE visit_record_id = :id"
+            ), {"id": visit_record_id}).scalar_one()
+            visit = conn.execute(sqlalchemy.text(
+                "SELECT customer_count FROM customer_visits WHERE visit_record_id = :id"
+            ), {"id": visit_record_id}).mappings().one()
+            payload = CartManager.get_visit_payload(conn, visit_record_id)
+
+        self.logger.info(f"Mode {mode}: {count} customer rows")
+        assert count == len(self.customers)
+        assert visit['customer_count'] == len(self.customers)
+        if mode == 'none':
+            assert payload is None
+        else:
+            assert payload == self.customers
+
+    def test_repeat_visitors_share_identity(self):
+        """Test returning customers reuse their identity row across visits"""
+        with self.engine.begin() as conn:
+            CartManager.record_customer_visit(conn, 1, self.customers, 1)
+            returning = [dict(c, level=20) for c in self.customers[:100]]
+            visit_index = CartManager.record_customer_visit(conn, 2, returning, 1)
+            identities = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM customer_identities"
+            )).scalar_one()
+            facts = conn.execute(sqlalchemy.text(
+                "SELECT COUNT(*) FROM customers"
+            )).scalar_one()
+
+        assert identities == len(self.customers)
+        assert facts == len(self.customers) + len(returning)
+        assert ("customer_0", "Rogue", 20) in visit_index['customers']
+
+    def test_unknown_mode_rejected(self):
+        """Test invalid payload mode raises"""
+        with pytest.raises(ValueError):
+            with self.engine.begin() as conn:
+                CartManager.record_customer_visit(conn, 1, self.customers[:1], 1, 'xml')
+
+class TestCartCreation:
+    """Test customer resolution for cart creation"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database with one recorded visit"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+        self.customer = {"customer_name": "Ada", "character_class": "Wizard", "level": 3}
+        self.statements = []
+
+        with self.engine.begin() as conn:
+            self.visit_index = CartManager.record_customer_visit(
+                conn, 10, [self.customer, dict(self.customer, level=4)], 1
+            )
+
+        yield
+
+        CartManager.clear_visit_index()
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        """Record each executed statement"""
+        self.statements.append(statement)
+
+    def cart(self, cart_id: int) -> dict:
+        """Get cart visit and customer"""
+        with self.engine.begin() as conn:
+            return dict(conn.execute(sqlalchemy.text("""
+                SELECT c.visit_id, ci.customer_name, cu.level
+                FROM carts c
+                JOIN customers cu ON c.customer_id = cu.customer_id
+                JOIN customer_identities ci ON cu.identity_id = ci.identity_id
+                WHERE c.cart_id = :cart_id
+            """), {"cart_id": cart_id}).mappings().one())
+
+    def test_cached_visit_single_insert(self):
+        """Test a cached visit creates the cart with one statement"""
+        CartManager.cache_visit_index(self.visit_index)
+
+        event.listen(self.engine, 'before_cursor_execute', self.count_statement)
+        try:
+            with self.engine.begin() as conn:
+                cart_id = CartManager.create_cart(conn, self.customer, 1)
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', self.count_statement)
+
+        assert len(self.statements) == 1
+        assert self.cart(cart_id) == {"visit_id": 10, "customer_name": "Ada", "level": 3}
+
+    def test_uncached_visit_resolves_from_database(self):
+        """Test cart creation without a cached index finds the customer"""
+        with self.engine.begin() as conn:
+            cart_id = CartManager.create_cart(conn, self.customer, 1)
+
+        assert self.cart(cart_id) == {"visit_id": 10, "customer_name": "Ada", "level": 3}
+
+    def test_stale_cache_falls_back(self):
+        """Test a newer visit recorded elsewhere wins over the cached index"""
+        CartManager.cache_visit_index(self.visit_index)
+
+        # Visit recorded without publishing, as by another worker
+        with self.engine.begin() as conn:
+            CartManager.record_customer_visit(conn, 11, [self.customer], 1)
+            cart_id = CartManager.create_cart(conn, self.customer, 1)
+
+        assert self.cart(cart_id)['visit_id'] == 11
+
+class TestExportManager:
+    """Test chunked NDJSON and CSV exports"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self, test_logger):
+        """Setup test database with gold entries across three ticks"""
+        self.engine = create_test_db()
+        self.logger = test_logger
+
+        with self.engine.begin() as conn:
+            for time_id, gold in ((2, 10), (3, 20), (4, 30)):
+                conn.execute(sqlalchemy.text("""
+                    INSERT INTO ledger_entries (time_id, entry_type, gold_change)
+                    VALUES (:time_id, 'GOLD_CHANGE', :gold)
+                """), {"time_id": time_id, "gold": gold})
+
+    def export(self, query, export_format, **time_range):
+        """Collect an export's chunks"""
+        with self.engine.connect() as conn:
+            return list(ExportManager.stream(conn, query, export_format, **time_range))
+
+    def test_ledger_ndjson_time_range(self):
+        """Test NDJSON export filters entries by time_id range"""
+        chunks = self.export(ExportManager.LEDGER_QUERY, 'ndjson', from_time_id=3, to_time_id=4)
+        rows = [json.loads(line) for line in "".join(chunks).splitlines()]
+
+        self.logger.info(f"Exported rows: {rows}")
+        assert [row['gold_change'] for row in rows] == [20, 30]
+        assert rows[0]['entry_type'] == 'GOLD_CHANGE'
+        assert rows[0]['ml_change'] is None
+
+    def test_csv_chunks(self, monkeypatch):
+        """Test CSV export emits a header then one chunk per fetched partition"""
+        monkeypatch.setattr(ExportManager, 'CHUNK_ROWS', 1)
+        chunks = self.export(ExportManager.LEDGER_QUERY, 'csv', from_time_id=2)
+
+        assert chunks[0].startswith("entry_id,epoch_id,time_id,entry_type")
+        assert len(chunks) == 4
+        assert all(chunk.count("\n") == 1 for chunk in chunks)
+
+    def test_orders_empty(self):
+        """Test order export without orders yields only the CSV header"""
+        chunks = self.export(ExportManager.ORDERS_QUERY, 'csv')
+
+        assert chunks == [
+            "order_type,order_id,visit_id,time_id,sku,quantity,unit_price,"
+            "total,payment,purchase_success,created_at\n"
+        ]